@@ -4,10 +4,18 @@ import os
 import requests
 from dotenv import load_dotenv
 import firebase_admin
-from firebase_admin import credentials, firestore, storage
+from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
 import json
-from datetime import datetime, timezone
-import pandas as pd
+import atexit
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import firestore_client
+import user_listener
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -87,37 +95,16 @@ def create_user_with_email_and_password(email, password):
     return response.json()
 
 # --- Firestoreの操作関数 ---
+FIRESTORE_BATCH_LIMIT = 500  # WriteBatch 1回あたりの書き込み上限
+
 def get_user_data_from_firestore(uid):
     global db
     doc_ref = db.collection('users').document(uid)
     doc = doc_ref.get()
 
     if doc.exists:
+        # 月初のリセットは reset_monthly_quota.py がまとめて行うので、ここでは読むだけ
         data = doc.to_dict()
-        now = datetime.now(timezone.utc)
-        last_reset_str = data.get("last_reset")
-        needs_reset = False
-        if last_reset_str:
-            last_reset = datetime.fromisoformat(last_reset_str.replace('Z', '+00:00'))
-            if last_reset.year < now.year or last_reset.month < now.month:
-                needs_reset = True
-        else:
-            needs_reset = True
-
-        if needs_reset:
-            plan = data.get("plan", "Free")
-            plan_monthly_uses = {
-                "Free": 10, "Guest": 0, "Light": 50, "Pro": 200, "Team": 500, "Enterprise": 1000
-            }
-            new_remaining_uses = plan_monthly_uses.get(plan, 0)
-
-            doc_ref.update({
-                "remaining_uses": new_remaining_uses,
-                "last_reset": now.isoformat()
-            })
-            data["remaining_uses"] = new_remaining_uses
-            st.toast(f"利用回数がリセットされました。今月の残回数: {new_remaining_uses}回")
-
         st.session_state.plan = data.get("plan", "Free")
         st.session_state.remaining_uses = data.get("remaining_uses", 0)
     else:
@@ -132,87 +119,459 @@ def get_user_data_from_firestore(uid):
         })
     return True
 
-def update_user_uses_in_firestore(uid, uses_to_deduct=1):
-    global db
-    doc_ref = db.collection('users').document(uid)
-    try:
-        doc_ref.update({
-            "remaining_uses": firestore.Increment(-uses_to_deduct),
-            "last_used_at": firestore.SERVER_TIMESTAMP
+# --- 利用回数（クォータ）エンジン ---
+# reserve → commit / release の2段階で利用回数を扱う。
+# reserve はトランザクション内で残回数を確認して差し引き、予約を users/{uid}/quota_reservations/{key} に記録する。
+# 同じ idempotency_key での再実行は既存の予約を返すだけなので、二重に差し引かれない。
+# 処理が成功したら commit（使わなかった分は返却）、失敗したら release（全額返却）する。
+# 予約には期限を書き、どちらもされずに期限を過ぎた予約は release_stale_reservations.py が返却する。
+QUOTA_LEASE_PLANS = ["Enterprise"]  # ローカルにまとめて確保したトークンから払い出すプラン
+QUOTA_LEASE_SIZE = int(os.getenv("QUOTA_LEASE_SIZE", "20"))
+QUOTA_LEASE_TTL_SECONDS = int(os.getenv("QUOTA_LEASE_TTL_SECONDS", "300"))
+QUOTA_RESERVATION_TTL_SECONDS = int(os.getenv("QUOTA_RESERVATION_TTL_SECONDS", "3600"))
+
+_quota_leases = {}  # uid -> {"key", "size", "available", "remaining", "expires_at", "reserved_at"}
+_lease_reservations = {}  # idempotency_key -> {"uid", "amount", "lease_key", "reserved_at"}（確定・返却したら消す）
+_quota_locks = {}  # uid -> Lock（リースと払い出し記録の保護用。Firestoreの呼び出し中は保持しない）
+_quota_locks_guard = threading.Lock()
+_lease_sweeper_started = False
+
+
+def _quota_lock_for(uid):
+    with _quota_locks_guard:
+        return _quota_locks.setdefault(uid, threading.Lock())
+
+
+class QuotaExceededError(Exception):
+    """残回数が足りない"""
+
+    def __init__(self, remaining):
+        super().__init__(f"残り回数が不足しています（残り{remaining}回）")
+        self.remaining = remaining
+
+
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+
+def _reservation_ref(uid, key):
+    return firestore_client.quota_reservation_ref(uid, key, db)
+
+
+def _reserve_in_transaction(uid, amount, key, ttl=QUOTA_RESERVATION_TTL_SECONDS):
+    """
+    トランザクションで残回数を確認・差し引きし、予約を記録する。戻り値は差し引き後の残回数。
+    ttl 秒を過ぎても確定・返却されない予約は、期限切れとして返却される。
+    """
+    user_ref = db.collection('users').document(uid)
+    reservation_ref = _reservation_ref(uid, key)
+
+    @firestore.transactional
+    def _reserve(transaction):
+        user_snapshot = user_ref.get(transaction=transaction)
+        reservation_snapshot = reservation_ref.get(transaction=transaction)
+        remaining = (user_snapshot.to_dict() or {}).get("remaining_uses", 0)
+        if reservation_snapshot.exists and reservation_snapshot.to_dict().get("status") != "released":
+            # 同じキーで予約・確定済み（リトライ・rerun）なら何もしない。返却済みの予約は取り直す
+            return remaining
+        if remaining < amount:
+            raise QuotaExceededError(remaining)
+        transaction.update(user_ref, {
+            "remaining_uses": remaining - amount,
+            "last_used_at": firestore.SERVER_TIMESTAMP,
         })
-        return True
+        transaction.set(reservation_ref, {
+            "amount": amount, "used": 0, "status": "reserved",
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl),
+        })
+        return remaining - amount
+
+    return _reserve(db.transaction())
+
+
+def _settle_in_transaction(uid, key, used):
+    """予約を確定する。used 未満しか使わなかった分は残回数に返却する。確定済みなら何もしない"""
+    return firestore_client.settle_quota_reservation(uid, key, used, db)
+
+
+def _settle_lease(uid, lease):
+    """リースを返却し、払い出さなかったトークンを残回数に戻す（ロックの外で呼ぶ）"""
+    _settle_in_transaction(uid, lease["key"], lease["size"] - lease["available"])
+
+
+def _acquire_lease(uid, amount):
+    """Firestoreからリース分をまとめて確保する（ロックの外で呼ぶ）"""
+    lease_key = f"lease-{new_idempotency_key()}"
+    size = max(QUOTA_LEASE_SIZE, amount)
+    # リースの期限後も払い出し済みの処理が確定するまで待てるよう、Firestore側の期限は長めに取る
+    ttl = QUOTA_LEASE_TTL_SECONDS + QUOTA_RESERVATION_TTL_SECONDS
+    _ensure_lease_sweeper()
+    try:
+        remaining = _reserve_in_transaction(uid, size, lease_key, ttl)
+    except QuotaExceededError as e:
+        # リース分が確保できなければ残っている分だけを確保する
+        if e.remaining < amount:
+            raise
+        size = e.remaining
+        remaining = _reserve_in_transaction(uid, size, lease_key, ttl)
+    return {
+        "key": lease_key, "size": size, "available": size, "remaining": remaining,
+        "expires_at": time.monotonic() + QUOTA_LEASE_TTL_SECONDS, "reserved_at": datetime.now(timezone.utc),
+    }
+
+
+def _reserve_from_lease(uid, amount, key):
+    lock = _quota_lock_for(uid)
+    while True:
+        with lock:
+            lease = _quota_leases.get(uid)
+            if key in _lease_reservations:
+                return lease["remaining"] + lease["available"] if lease else st.session_state.get("remaining_uses", 0)
+            stale = None
+            if lease and (lease["expires_at"] <= time.monotonic() or lease["available"] < amount):
+                stale = _quota_leases.pop(uid)
+                lease = None
+            if lease is not None:
+                lease["available"] -= amount
+                _lease_reservations[key] = {
+                    "uid": uid, "amount": amount, "lease_key": lease["key"], "reserved_at": lease["reserved_at"],
+                }
+                return lease["remaining"] + lease["available"]
+
+        # Firestoreとのやり取りはロックを離して行い、他のリクエスト（同じユーザーの別タブ等）を待たせない
+        if stale is not None:
+            _settle_lease(uid, stale)
+        new_lease = _acquire_lease(uid, amount)
+        with lock:
+            if uid not in _quota_leases:
+                _quota_leases[uid] = new_lease
+                new_lease = None
+        if new_lease is not None:
+            # 確保している間に別のスレッドがリースを用意していた。こちらは使わずに返す
+            _settle_lease(uid, new_lease)
+
+
+def reserve_uses(uid, amount, idempotency_key, plan=None):
+    """
+    利用回数を amount 回分予約し、予約後の残回数を返す。
+    残回数不足は QuotaExceededError、Firestoreのエラー時はメッセージを表示してNoneを返す。
+    Enterpriseプランはまとめて確保したリースから払い出し、毎回ユーザードキュメントに書き込まない。
+    """
+    plan = plan or st.session_state.get("plan")
+    try:
+        if plan in QUOTA_LEASE_PLANS:
+            remaining = _reserve_from_lease(uid, amount, idempotency_key)
+        else:
+            remaining = _reserve_in_transaction(uid, amount, idempotency_key)
+    except QuotaExceededError as e:
+        st.session_state.remaining_uses = e.remaining
+        raise
+    except Exception as e:
+        st.error(f"利用回数の確保に失敗しました: {e}")
+        return None
+    st.session_state.remaining_uses = remaining
+    return remaining
+
+
+def _settle_uses(uid, idempotency_key, used=None):
+    """予約（リースからの払い出しを含む）を確定し、返却した回数を返す"""
+    direct_refund = 0
+    with _quota_lock_for(uid):
+        local = _lease_reservations.pop(idempotency_key, None)
+        if local is not None:
+            used = local["amount"] if used is None else min(used, local["amount"])
+            refund = local["amount"] - used
+            lease = _quota_leases.get(uid)
+            if lease is not None and lease["key"] == local["lease_key"]:
+                lease["available"] += refund
+            else:
+                # 払い出し元のリースは返却済み（使用済み扱いで精算済み）なので、直接残回数に戻す
+                direct_refund = refund
+    if local is None:
+        return _settle_in_transaction(uid, idempotency_key, float("inf") if used is None else used)
+    if direct_refund:
+        # 月次リセットをまたいだ払い出しは返却しない（settle_quota_reservation と同じ扱い）
+        refund -= direct_refund - firestore_client.refund_uses(uid, direct_refund, local["reserved_at"], db)
+    return refund
+
+
+def commit_uses(uid, idempotency_key, used=None):
+    """予約を確定する。used を指定すると、予約数との差分は返却される"""
+    try:
+        refund = _settle_uses(uid, idempotency_key, used)
+    except Exception as e:
+        st.error(f"利用回数の確定に失敗しました: {e}")
+        return False
+    st.session_state.remaining_uses = st.session_state.get("remaining_uses", 0) + refund
+    return True
+
+
+def settle_uses(uid, idempotency_key, used=None):
+    """
+    commit_uses の画面を持たない版（ワーカースレッドのコールバックから呼ぶ）。
+    session_state には触れず、失敗はログに残してFalseを返す（確定されなかった予約は期限切れで返却される）。
+    """
+    try:
+        _settle_uses(uid, idempotency_key, used)
     except Exception as e:
-        st.error(f"利用回数の更新に失敗しました: {e}")
+        logging.warning("Failed to settle quota reservation %s for %s: %s", idempotency_key, uid, e)
         return False
+    return True
+
+
+def release_uses(uid, idempotency_key):
+    """予約を取り消し、差し引いた回数をすべて返却する（処理失敗時）"""
+    return commit_uses(uid, idempotency_key, used=0)
+
+
+def flush_quota_leases(expired_only=False):
+    """ローカルに確保しているリースをすべて返却する（プロセス終了時など）。expired_only なら期限切れのものだけ"""
+    leases = []
+    for uid in list(_quota_leases):
+        with _quota_lock_for(uid):
+            lease = _quota_leases.get(uid)
+            if lease is None or (expired_only and lease["expires_at"] > time.monotonic()):
+                continue
+            del _quota_leases[uid]
+        leases.append((uid, lease))
+    for uid, lease in leases:
+        try:
+            _settle_lease(uid, lease)
+        except Exception as e:
+            logging.warning("Failed to settle quota lease for %s: %s", uid, e)
+
+
+def _lease_sweeper():
+    while True:
+        time.sleep(QUOTA_LEASE_TTL_SECONDS)
+        flush_quota_leases(expired_only=True)
+
+
+def _ensure_lease_sweeper():
+    """
+    期限切れのリースを定期的に返却するスレッドを最初のリース確保時に起動する。
+    同じユーザーの次の予約が来なくても、払い出さなかった分がFirestoreの期限切れ返却まで取り残されないようにする。
+    """
+    global _lease_sweeper_started
+    with _quota_locks_guard:
+        if _lease_sweeper_started:
+            return
+        _lease_sweeper_started = True
+    threading.Thread(target=_lease_sweeper, name="quota-lease-sweeper", daemon=True).start()
+
+
+atexit.register(flush_quota_leases)
+
 
 def add_diagnosis_record_to_firestore(uid, record_data):
+    """
+    診断記録を1件保存する。record_data に 'id' があればそのドキュメントIDで作成し、
+    既に存在する場合（同じリクエストの再実行）は書き込まずに成功扱いとする。
+    """
     global db
-    doc_ref = db.collection('users').document(uid).collection('diagnoses').document()
+    diagnoses_ref = db.collection('users').document(uid).collection('diagnoses')
+    doc_id = record_data.pop('id', None)
     try:
         record_data["created_at"] = firestore.SERVER_TIMESTAMP
-        doc_ref.set(record_data)
+        record_data["updated_at"] = firestore.SERVER_TIMESTAMP
+        if doc_id:
+            diagnoses_ref.document(doc_id).create(record_data)
+        else:
+            diagnoses_ref.document().set(record_data)
+        return True
+    except AlreadyExists:
         return True
     except Exception as e:
         st.error(f"診断記録のFirestore保存に失敗しました: {e}")
         return False
 
-def get_diagnosis_records_from_firestore(uid):
-    """Firestoreから特定ユーザーの実績記録をすべて取得する"""
+def add_diagnosis_records_batch(uid, records):
+    """
+    複数の診断記録をWriteBatchでまとめて保存する（1バッチ最大500件）。
+    'id' を持つ記録は create で書き込み、既存ドキュメントがあればそのチャンクだけ1件ずつ作り直して重複を除く。
+    """
+    global db
+    diagnoses_ref = db.collection('users').document(uid).collection('diagnoses')
+    try:
+        for start in range(0, len(records), FIRESTORE_BATCH_LIMIT):
+            chunk = []
+            for record_data in records[start:start + FIRESTORE_BATCH_LIMIT]:
+                doc_id = record_data.pop('id', None)
+                record_data["created_at"] = firestore.SERVER_TIMESTAMP
+                record_data["updated_at"] = firestore.SERVER_TIMESTAMP
+                chunk.append((diagnoses_ref.document(doc_id) if doc_id else diagnoses_ref.document(), record_data))
+
+            batch = db.batch()
+            for doc_ref, record_data in chunk:
+                batch.create(doc_ref, record_data)
+            try:
+                batch.commit()
+            except AlreadyExists:
+                for doc_ref, record_data in chunk:
+                    try:
+                        doc_ref.create(record_data)
+                    except AlreadyExists:
+                        pass
+        return True
+    except Exception as e:
+        st.error(f"診断記録のFirestore一括保存に失敗しました: {e}")
+        return False
+
+# 一覧表示に使う項目（長いコメントやサブスコアは詳細表示時に個別に読み込む）
+RECORD_GRID_FIELDS = [
+    "banner_name", "pattern", "score", "predicted_ctr",
+    "platform", "category", "industry", "age_group", "purpose", "genre",
+    "result", "follower_gain", "memo", "image_url", "thumbnail_url", "image_path", "thumbnail_path", "created_at",
+    "updated_at",  # ローカルレプリカの差分同期用
+]
+RECORD_PAGE_SIZES = [25, 50, 100, 200]
+
+
+def get_diagnosis_records_page(uid, page_size, start_after=None, fields=None):
+    """
+    実績記録を新しい順に1ページ分だけ取得する（fields を省略すると一覧用の項目のみ）。
+    戻り値は (記録のリスト, 次ページのカーソル)。次ページがなければカーソルはNone。
+    """
+    global db
+    query = (
+        db.collection('users').document(uid).collection('diagnoses')
+        .order_by("created_at", direction=firestore.Query.DESCENDING)
+        .select(fields or RECORD_GRID_FIELDS)
+    )
+    if start_after is not None:
+        query = query.start_after(start_after)
+    # 1件多く取得して次ページの有無を判定する
+    docs = list(query.limit(page_size + 1).stream())
+    records = []
+    for doc in docs[:page_size]:
+        record = doc.to_dict()
+        record["id"] = doc.id
+        record["update_time"] = doc.update_time
+        records.append(record)
+    next_cursor = docs[page_size - 1] if len(docs) > page_size else None
+    return records, next_cursor
+
+
+def get_diagnosis_records_updated_since(uid, since, page_size, start_after=None):
+    """
+    updated_at が since より新しい実績記録を更新順に1ページ分取得する（一覧用の項目のみ）。
+    戻り値は get_diagnosis_records_page と同じ (記録のリスト, 次ページのカーソル)。
+    """
     global db
+    query = (
+        db.collection('users').document(uid).collection('diagnoses')
+        .where("updated_at", ">", since)
+        .order_by("updated_at")
+        .select(RECORD_GRID_FIELDS)
+    )
+    if start_after is not None:
+        query = query.start_after(start_after)
+    docs = list(query.limit(page_size + 1).stream())
     records = []
-    docs = db.collection('users').document(uid).collection('diagnoses').order_by("created_at", direction=firestore.Query.DESCENDING).stream()
-    for doc in docs:
+    for doc in docs[:page_size]:
         record = doc.to_dict()
-        record["id"] = doc.id # ドキュメントIDも追加
+        record["id"] = doc.id
+        record["update_time"] = doc.update_time
         records.append(record)
-    return records
+    next_cursor = docs[page_size - 1] if len(docs) > page_size else None
+    return records, next_cursor
+
 
-def save_diagnosis_records_to_firestore(uid, records_df):
-    """DataFrameの内容でFirestoreの実績記録を上書き保存する"""
+def get_diagnosis_record(uid, doc_id):
+    """実績記録1件のすべての項目を取得する（存在しなければNone）"""
     global db
-    user_diagnoses_ref = db.collection('users').document(uid).collection('diagnoses')
+    doc = db.collection('users').document(uid).collection('diagnoses').document(doc_id).get()
+    if not doc.exists:
+        return None
+    record = doc.to_dict()
+    record["id"] = doc.id
+    return record
 
-    # 現在のコレクション内のドキュメントをすべて削除
-    for doc in user_diagnoses_ref.stream():
-        doc.reference.delete()
 
-    # DataFrameの各行を新しいドキュメントとして追加
-    for _, row in records_df.iterrows():
-        record_data = row.to_dict()
-        
-        # 'id'列はFirestoreに不要なので削除
-        doc_id = record_data.pop('id', None)
-        
-        # ★★★ ここから変更 ★★★
-        # 既存のタイムスタンプを保持し、ない場合のみ新規作成
-        if 'created_at' in record_data and pd.notna(record_data['created_at']):
-            # DataFrameから来たタイムスタンプをそのまま利用
-            pass
-        else:
-            # 新規行の場合はサーバータイムスタンプを設定
-            record_data['created_at'] = firestore.SERVER_TIMESTAMP
-        # ★★★ ここまで変更 ★★★
+class RecordConflictError(Exception):
+    """保存しようとした記録が、読み込み後に別のタブ・端末で更新または削除されていた"""
 
-        # もし元のドキュメントIDがあればそれを使う（通常は新しいIDが自動生成される）
-        if doc_id and pd.notna(doc_id):
-            user_diagnoses_ref.document(doc_id).set(record_data)
-        else:
-            user_diagnoses_ref.add(record_data)
-            
-    return True
 
+def save_diagnosis_record_changes(uid, inserts, updates, deletes, versions):
+    """
+    実績記録の差分（追加・更新・削除）だけをWriteBatchで書き込む（1バッチ最大500件）。
+    inserts は新規記録のリスト、updates は {ドキュメントID: 変更した項目} 、deletes はドキュメントIDのリスト。
+    versions は読み込み時の {ドキュメントID: update_time} で、更新・削除はその時点から変わっていない場合のみ適用する。
+    他で変更されていた場合はそのバッチ全体を適用せず RecordConflictError を送出する。
+    """
+    global db
+    diagnoses_ref = db.collection('users').document(uid).collection('diagnoses')
+
+    def _option(doc_id):
+        update_time = versions.get(doc_id)
+        return db.write_option(last_update_time=update_time) if update_time else None
+
+    writes = []
+    for doc_id, fields in updates.items():
+        if fields:
+            fields = {**fields, "updated_at": firestore.SERVER_TIMESTAMP}
+            writes.append(("update", diagnoses_ref.document(doc_id), fields, _option(doc_id)))
+    for doc_id in deletes:
+        writes.append(("delete", diagnoses_ref.document(doc_id), None, _option(doc_id)))
+    for record_data in inserts:
+        record_data = dict(record_data)
+        if record_data.get("created_at") is None:
+            record_data["created_at"] = firestore.SERVER_TIMESTAMP
+        record_data["updated_at"] = firestore.SERVER_TIMESTAMP
+        writes.append(("create", diagnoses_ref.document(), record_data, None))
+
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for kind, doc_ref, fields, option in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            if kind == "update":
+                batch.update(doc_ref, fields, option=option)
+            elif kind == "delete":
+                batch.delete(doc_ref, option=option)
+            else:
+                batch.create(doc_ref, fields)
+        try:
+            batch.commit()
+        except (FailedPrecondition, NotFound) as e:
+            raise RecordConflictError(
+                f"他のタブまたは端末で先に更新された記録があるため、{len(writes) - start}件の変更を保存できませんでした。"
+            ) from e
+    return len(writes)
+
+
+# --- プラン・残回数のライブ更新 ---
+# 別タブでの利用やWebhookによるプラン変更を、共有リスナー（user_listener）経由でサイドバーに反映する
+USER_LIVE_REFRESH_SECONDS = float(os.getenv("USER_LIVE_REFRESH_SECONDS", "5"))
+
+
+def refresh_user_from_listener():
+    """リスナーが受け取ったユーザードキュメントが新しければセッションの plan / remaining_uses に取り込む"""
+    session_id = user_listener.current_session_id()
+    uid = st.session_state.get("user")
+    if not session_id or not uid:
+        return
+    user_listener.subscribe(session_id, uid, db.collection('users').document(uid))
+    version, data = user_listener.latest(uid)
+    if data is None or st.session_state.get("user_doc_version") == version:
+        return
+    st.session_state.user_doc_version = version
+    st.session_state.plan = data.get("plan", "Free")
+    remaining = data.get("remaining_uses", 0)
+    with _quota_lock_for(uid):
+        # リースで確保済みの分はドキュメントから差し引かれているが、まだ使えるので表示に足す
+        lease = _quota_leases.get(uid)
+        if lease:
+            remaining += lease["available"]
+    st.session_state.remaining_uses = remaining
+
+
+@st.fragment(run_every=USER_LIVE_REFRESH_SECONDS)
+def _plan_status():
+    # 一定間隔でこの部分だけを再実行する（読むのはメモリ上の最新値のみ）
+    refresh_user_from_listener()
+    st.write(f"**現在のプラン:** {st.session_state.plan}")
+    st.write(f"**今月の残回数:** {st.session_state.remaining_uses}回")
 
-def upload_image_to_firebase_storage(uid, image_bytes_io, filename):
-    try:
-        bucket = storage.bucket()
-        blob = bucket.blob(f"users/{uid}/diagnoses_images/{filename}")
-        image_bytes_io.seek(0)
-        blob.upload_from_file(image_bytes_io, content_type="image/png")
-        blob.make_public()
-        return blob.public_url
-    except Exception as e:
-        st.error(f"Firebase Storageへの画像アップロードに失敗しました: {e}")
-        return None
 
 # --- StreamlitのUI表示と認証フロー ---
 def login_page():
@@ -264,6 +623,9 @@ def login_page():
                     st.error(f"予期せぬエラーが発生しました: {e}")
 
 def logout():
+    session_id = user_listener.current_session_id()
+    if session_id:
+        user_listener.unsubscribe(session_id)
     for key in list(st.session_state.keys()):
         del st.session_state[key]
     st.success("ログアウトしました。")
@@ -276,8 +638,8 @@ def check_login():
     else:
         st.sidebar.write(f"ようこそ, {st.session_state.email}!")
         st.sidebar.markdown("---")
-        st.sidebar.write(f"**現在のプラン:** {st.session_state.plan}")
-        st.sidebar.write(f"**今月の残回数:** {st.session_state.remaining_uses}回")
+        with st.sidebar:
+            _plan_status()
         
         st.sidebar.page_link("pages/3_プラン購入.py", label="💎 プランの確認・購入はこちら", icon="💎")
         st.sidebar.markdown("---")
@@ -0,0 +1,76 @@
+# backfill_thumbnails.py
+# 既存の実績記録に一覧用サムネイルを後付けするバッチ（thumbnail_url のない記録が対象）
+#
+#   python backfill_thumbnails.py [--uid UID] [--limit N] [--dry-run]
+#
+# Firestore/Storageへの接続は firestore_client と同じ FIREBASE_SERVICE_ACCOUNT_JSON、
+# バケットは FIREBASE_STORAGE_BUCKET を使う。
+import argparse
+import logging
+
+import requests
+from firebase_admin import firestore
+
+import banner_storage
+import firestore_client
+import image_utils
+
+DOWNLOAD_TIMEOUT_SECONDS = 30
+
+
+def _pending_records(db, uid=None):
+    """thumbnail_url がなく image_url がある記録を (ユーザーID, DocumentSnapshot) で返す"""
+    if uid:
+        query = db.collection('users').document(uid).collection('diagnoses')
+    else:
+        query = db.collection_group('diagnoses')
+    for doc in query.select(["image_url", "thumbnail_url"]).stream():
+        data = doc.to_dict()
+        if data.get("image_url") and not data.get("thumbnail_url"):
+            yield doc.reference.parent.parent.id, doc
+
+
+def backfill(uid=None, limit=None, dry_run=False):
+    """サムネイルを生成・アップロードして記録に thumbnail_path / thumbnail_url を書き込む。処理件数と失敗件数を返す"""
+    db = firestore_client.get_firestore_db()
+    done = failed = 0
+    for owner, doc in _pending_records(db, uid):
+        if limit is not None and done + failed >= limit:
+            break
+        image_url = doc.get("image_url")
+        try:
+            response = requests.get(image_url, timeout=DOWNLOAD_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            thumb_bytes, thumb_mime, _ = image_utils.record_thumbnail(response.content)
+            # 元画像の内容から決まるパスに置く（同じ画像の記録が複数あってもサムネイルは1つ）
+            path = banner_storage.thumbnail_path(owner, banner_storage.content_hash(response.content), thumb_mime)
+            if dry_run:
+                logging.info("[dry-run] %s -> %s (%d bytes)", doc.reference.path, path, len(thumb_bytes))
+            else:
+                banner_storage.upload(path, thumb_bytes, thumb_mime)
+                doc.reference.update({
+                    "thumbnail_path": path,
+                    "thumbnail_url": banner_storage.url_for(path),
+                    "updated_at": firestore.SERVER_TIMESTAMP,  # ローカルレプリカの差分同期で拾わせる
+                })
+            done += 1
+        except Exception as e:
+            logging.warning("Thumbnail backfill failed for %s: %s", doc.reference.path, e)
+            failed += 1
+    return done, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="既存の実績記録に一覧用サムネイルを生成する")
+    parser.add_argument("--uid", help="対象ユーザーID（省略時は全ユーザー）")
+    parser.add_argument("--limit", type=int, help="処理する最大件数")
+    parser.add_argument("--dry-run", action="store_true", help="生成のみ行い、アップロード・更新はしない")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    done, failed = backfill(args.uid, args.limit, args.dry_run)
+    logging.info("Thumbnail backfill finished: %d done, %d failed", done, failed)
+
+
+if __name__ == "__main__":
+    main()
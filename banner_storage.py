@@ -0,0 +1,120 @@
+# banner_storage.py
+# バナー画像のFirebase Storage保存（コンテンツハッシュ名で重複排除・再開可能アップロード・URL生成）
+import hashlib
+import os
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import quote
+
+from firebase_admin import storage
+from google.api_core.exceptions import PreconditionFailed
+
+# --- 設定（環境変数で上書き可能） ---
+STORAGE_BUCKET = os.getenv("FIREBASE_STORAGE_BUCKET")
+# "signed"（既定）: 非公開バケットのまま、表示のたびに期限付き署名URLを発行する
+# "public": バケット単位で allUsers に roles/storage.legacyObjectReader を付与しておき、公開URLを使う。
+#   Storage Object Viewer（roles/storage.objectViewer）は一覧取得（storage.objects.list）も許し、
+#   全ユーザーのバナーのパスが列挙できてしまうので付与しないこと
+STORAGE_URL_MODE = os.getenv("STORAGE_URL_MODE", "signed")
+SIGNED_URL_TTL_SECONDS = int(os.getenv("STORAGE_SIGNED_URL_TTL_SECONDS", str(6 * 3600)))
+SIGNED_URL_CACHE_MAX_ENTRIES = 4096
+# これを超えるファイルはチャンク分割の再開可能アップロードにする（チャンクは256KiBの倍数）
+RESUMABLE_THRESHOLD_BYTES = int(os.getenv("STORAGE_RESUMABLE_THRESHOLD_BYTES", str(5 * 1024 * 1024)))
+RESUMABLE_CHUNK_BYTES = 4 * 1024 * 1024
+# 内容が変わらないパスなので、ブラウザ・CDNに長期間キャッシュさせてよい
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+
+_known_paths = set()  # このプロセスで存在を確認済みのパス（exists() の問い合わせを省く）
+_signed_urls = {}  # path -> (url, 期限)
+_lock = threading.Lock()
+
+
+def _bucket():
+    return storage.bucket(STORAGE_BUCKET)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_path(uid, digest, content_type):
+    """元画像の保存先。同じ内容の画像は常に同じパスになる"""
+    return f"users/{uid}/diagnoses_images/{digest}.{EXTENSIONS.get(content_type, 'bin')}"
+
+
+def thumbnail_path(uid, digest, content_type):
+    """元画像のハッシュに紐づくサムネイルの保存先（元画像の隣に置く）"""
+    return f"users/{uid}/diagnoses_images/{digest}_thumb.{EXTENSIONS.get(content_type, 'bin')}"
+
+
+def exists(path):
+    with _lock:
+        if path in _known_paths:
+            return True
+    if _bucket().blob(path).exists():
+        with _lock:
+            _known_paths.add(path)
+        return True
+    return False
+
+
+def upload(path, data, content_type):
+    """
+    data を path に保存する。既に存在すればアップロードしない。
+    大きなファイルは再開可能アップロードでチャンクごとに送る。戻り値はアップロードしたらTrue
+    """
+    if exists(path):
+        return False
+    blob = _bucket().blob(path)
+    if len(data) > RESUMABLE_THRESHOLD_BYTES:
+        blob.chunk_size = RESUMABLE_CHUNK_BYTES
+    blob.cache_control = CACHE_CONTROL
+    # if_generation_match=0: 同時に同じ内容をアップロードした場合は先勝ち（中身は同じなので失敗しても問題ない）
+    try:
+        blob.upload_from_string(data, content_type=content_type, if_generation_match=0)
+    except PreconditionFailed:
+        pass
+    with _lock:
+        _known_paths.add(path)
+    return True
+
+
+def url_for(path):
+    """
+    保存先パスの表示用URLを返す。オブジェクトごとのACL設定（make_public）は行わない。
+    public モードはAPIを呼ばずに組み立て、signed モードは期限付きURLを期限の手前まで使い回す。
+    """
+    if STORAGE_URL_MODE == "public":
+        return f"https://storage.googleapis.com/{_bucket().name}/{quote(path)}"
+    now = time.time()
+    with _lock:
+        cached = _signed_urls.get(path)
+        if cached and cached[1] - now > SIGNED_URL_TTL_SECONDS / 4:
+            return cached[0]
+    url = _bucket().blob(path).generate_signed_url(
+        version="v4", expiration=timedelta(seconds=SIGNED_URL_TTL_SECONDS), method="GET"
+    )
+    with _lock:
+        if len(_signed_urls) >= SIGNED_URL_CACHE_MAX_ENTRIES:
+            _signed_urls.clear()
+        _signed_urls[path] = (url, now + SIGNED_URL_TTL_SECONDS)
+    return url
+
+
+def resolve_url(record, kind="image"):
+    """
+    記録の画像URLを返す。kind は "image" か "thumbnail"。
+    保存先パス（image_path / thumbnail_path）があればそこからURLを作り、古い記録は保存済みのURLを使う。
+    """
+    path = record.get(f"{kind}_path")
+    if path:
+        return url_for(path)
+    return record.get(f"{kind}_url")
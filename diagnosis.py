@@ -0,0 +1,649 @@
+# diagnosis.py
+# バナー診断パイプライン（画像アップロード → GPT-4o採点 → Firestore記録）
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import auth_utils
+import banner_storage
+import image_utils
+import llm_client
+import phash_index
+import record_replica
+import result_cache
+
+# --- 定数 ---
+MODEL_NAME = "gpt-4o"
+REPAIR_MODEL_NAME = "gpt-4o-mini"  # 応答形式の修復だけなので安価なモデルで十分
+SYSTEM_PROMPT = "あなたは広告のプロです。"
+
+# 評価基準ごとのサブスコア（キー → 表示名）
+CRITERIA = {
+    "clarity": "内容が一瞬で伝わるか",
+    "readability": "コピーの見やすさ",
+    "call_to_action": "行動喚起",
+    "consistency": "写真とテキストの整合性",
+    "balance": "情報量のバランス",
+}
+
+# Structured Outputs で強制する応答スキーマ
+DIAGNOSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "string", "description": "総合スコア（A/B/C形式なら A+〜C-、100点満点なら 0〜100 の整数）"},
+        "comment": {"type": "string", "description": "2～3行の改善コメント"},
+        "predicted_ctr": {"type": ["number", "null"], "description": "予想CTR（%）。求められていなければ null"},
+        "sub_scores": {
+            "type": "object",
+            "properties": {key: {"type": "integer", "description": f"{name}（0〜100）"} for key, name in CRITERIA.items()},
+            "required": list(CRITERIA),
+            "additionalProperties": False,
+        },
+    },
+    "required": ["score", "comment", "predicted_ctr", "sub_scores"],
+    "additionalProperties": False,
+}
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "banner_diagnosis", "strict": True, "schema": DIAGNOSIS_SCHEMA},
+}
+
+DEMO_RESPONSE = json.dumps({
+    "score": "A+",
+    "comment": "プロフェッショナルなデザインで非常に優秀です。",
+    "predicted_ctr": 5.5,
+    "sub_scores": {"clarity": 90, "readability": 85, "call_to_action": 80, "consistency": 90, "balance": 85},
+}, ensure_ascii=False)
+
+# 同時に走らせる診断の上限（プロセス全体で共有）
+MAX_PARALLEL_DIAGNOSES = 4
+_executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_DIAGNOSES, thread_name_prefix="diagnosis")
+# Storageへのアップロードは採点と並行させるため別プールで実行する（診断プール内での待ち合わせによるデッドロック防止）
+_upload_executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_DIAGNOSES, thread_name_prefix="diagnosis-upload")
+
+# 一括診断の設定
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "100"))
+# 一括診断は専用のプールで実行し、大量の画像が通常の採点（A/B）を待たせないようにする
+BATCH_MAX_PARALLEL_DIAGNOSES = int(os.getenv("BATCH_MAX_PARALLEL_DIAGNOSES", "2"))
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_PARALLEL_DIAGNOSES, thread_name_prefix="diagnosis-batch")
+BATCH_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# 同じ内容の診断記録を1件にまとめる時間枠（秒）。枠内の連打・再送は同じドキュメントIDになる
+RECORD_DEDUP_WINDOW_SECONDS = int(os.getenv("RECORD_DEDUP_WINDOW_SECONDS", "600"))
+
+
+def sanitize(value):
+    """Replaces None or specific strings with 'エラー' (Error)"""
+    if value is None or value == "取得できず":
+        return "エラー"
+    return value
+
+
+def build_ai_prompt(age_group, purpose, score_format, add_ctr=False, check_typos=False):
+    """採点用のプロンプトを組み立てる"""
+    ctr_instruction = "また、このバナー広告の予想CTR（クリックスルー率）もパーセンテージで示してください。" if add_ctr else ""
+    typo_instruction = "生成する改善コメントに誤字脱字がないか厳密にチェックしてください。" if check_typos else ""
+
+    return f"""
+以下のバナー画像をプロ視点で採点してください。
+この広告のターゲット年代は「{age_group}」で、主な目的は「{purpose}」です。
+
+【評価基準】
+1. 内容が一瞬で伝わるか
+2. コピーの見やすさ
+3. 行動喚起
+4. 写真とテキストの整合性
+5. 情報量のバランス
+
+【ターゲット年代「{age_group}」と目的「{purpose}」を考慮した具体的なフィードバックをお願いします。】
+{ctr_instruction}
+{typo_instruction}
+
+【出力形式】
+次のキーを持つJSONで回答してください。
+- score: 総合スコア（{score_format}形式）
+- comment: 改善コメント（2～3行でお願いします）
+- predicted_ctr: {"予想CTR（%の数値、例: 2.5）" if add_ctr else "null"}
+- sub_scores: 評価基準1〜5それぞれの点数（0〜100の整数）"""
+
+
+def parse_ai_response(content, score_format="A/B/C"):
+    """
+    AIのJSON応答を検証し、score / comment / ctr / sub_scores のdictにして返す。
+    形式が不正な場合は理由を添えて ValueError を送出する。
+    """
+    try:
+        data = json.loads(content)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"JSONとして解釈できません: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("JSONオブジェクトではありません")
+
+    errors = []
+    score = str(data.get("score", "")).strip()
+    if score_format == "100点満点":
+        if not score.isdigit() or not 0 <= int(score) <= 100:
+            errors.append("score は0〜100の整数にしてください")
+    elif not re.fullmatch(r"[ABC][+-]?", score):
+        errors.append("score は A/B/C（+/-付き可）にしてください")
+
+    comment = data.get("comment")
+    if not isinstance(comment, str) or not comment.strip():
+        errors.append("comment が空です")
+
+    ctr = data.get("predicted_ctr")
+    if ctr is not None and (isinstance(ctr, bool) or not isinstance(ctr, (int, float)) or not 0 <= ctr <= 100):
+        errors.append("predicted_ctr は0〜100の数値かnullにしてください")
+
+    sub_scores = data.get("sub_scores")
+    if not isinstance(sub_scores, dict):
+        errors.append("sub_scores がありません")
+    else:
+        for key in CRITERIA:
+            value = sub_scores.get(key)
+            if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 100:
+                errors.append(f"sub_scores.{key} は0〜100の整数にしてください")
+
+    if errors:
+        raise ValueError(" / ".join(errors))
+    return {
+        "score": score,
+        "comment": comment.strip(),
+        "ctr": float(ctr) if ctr is not None else None,
+        "sub_scores": {key: sub_scores[key] for key in CRITERIA},
+    }
+
+
+def repair_response(client, content, error):
+    """スキーマに合わない応答を安価なモデルで1回だけ修復する（画像は送らない）"""
+    response = llm_client.chat_completion(
+        client,
+        model=REPAIR_MODEL_NAME,
+        messages=[
+            {"role": "system", "content": "与えられた応答を、内容を変えずに指定のJSONスキーマへ整形してください。"},
+            {"role": "user", "content": f"問題点: {error}\n\n元の応答:\n{content}"},
+        ],
+        response_format=RESPONSE_FORMAT,
+        max_tokens=600,
+    )
+    return response.choices[0].message.content
+
+
+def partial_comment(content):
+    """ストリーミング途中のJSONから、受信済みの改善コメント部分だけを取り出す（表示用）"""
+    match = re.search(r'"comment"\s*:\s*"((?:[^"\\]|\\.)*)', content)
+    if not match:
+        return ""
+    text = match.group(1)
+    try:
+        return json.loads(f'"{text}"')
+    except json.JSONDecodeError:
+        # 末尾でエスケープシーケンスが途切れている場合
+        return text.replace("\\n", "\n")
+
+
+def format_ctr(value):
+    """予想CTRを表示用の文字列にする（旧形式の '3.2%' 文字列にも対応）"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return f"{value:.1f}%"
+    return str(value)
+
+
+def request_score(client, prompt, image_bytes, mime_type="image/png", detail=image_utils.VISION_DETAIL, on_delta=None):
+    """
+    GPT-4oに画像とプロンプトを送り、応答テキストを返す（clientがNoneならデモ応答）。
+    on_delta を渡すとストリーミングで受信し、届いた断片ごとに on_delta(text) を呼ぶ。
+    """
+    if not client:
+        if on_delta:
+            on_delta(DEMO_RESPONSE)
+        return DEMO_RESPONSE
+    img_str = base64.b64encode(image_bytes).decode()
+    response = llm_client.chat_completion(
+        client,
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{img_str}", "detail": detail}}
+            ]}
+        ],
+        max_tokens=600,
+        response_format=RESPONSE_FORMAT,
+        stream=on_delta is not None,
+    )
+    if on_delta is None:
+        return response.choices[0].message.content
+
+    parts = []
+    for chunk in response:
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        if text:
+            parts.append(text)
+            on_delta(text)
+    return "".join(parts)
+
+
+def find_previous_diagnoses(uid, phash):
+    """知覚ハッシュが近い過去の診断を (距離, record) のリストで返す"""
+    return phash_index.find_similar(uid, phash)
+
+
+def reuse_params(age_group, purpose, score_format, add_ctr=False):
+    """近似重複の結果流用で一致を求める採点条件（実績記録にも同じ値が残る）"""
+    return {"age_group": age_group, "purpose": purpose, "score_format": score_format, "add_ctr": bool(add_ctr)}
+
+
+def prepare_payload(file_bytes, prompt, uid=None, params=None, image_key=None, phash=None):
+    """
+    モデルへ送る軽量画像を作り、結果キャッシュのキーとヒット結果を添えて返す。
+    params（reuse_params の戻り値）を渡すと、条件が同じ近似重複の過去結果も流用の対象にする。
+    image_key（image_utils.upload_key）と計算済みの phash を渡すと、表示用と同じデコード結果を使い回す。
+    """
+    payload_bytes, mime_type, stats = image_utils.optimize_for_vision(file_bytes, key=image_key)
+    cache_key = result_cache.make_cache_key(payload_bytes, prompt, MODEL_NAME)
+    phash = phash or image_utils.perceptual_hash(file_bytes, key=image_key)
+    cached = result_cache.get(cache_key)
+
+    # 完全一致がなくても、設定により近似重複の過去結果を流用する
+    if cached is None and uid and params is not None and phash_index.REUSE_NEAR_DUPLICATE_RESULT:
+        previous = phash_index.find_reusable(uid, phash, params)
+        if previous is not None:
+            cached = {
+                "score": previous.get("score"), "comment": previous.get("comment"),
+                "ctr": previous.get("predicted_ctr") if params.get("add_ctr") else None,
+                "sub_scores": previous.get("sub_scores"), "ai_response": None,
+            }
+
+    return {
+        "bytes": payload_bytes, "mime_type": mime_type, "stats": stats,
+        "cache_key": cache_key, "cached": cached, "phash": phash,
+    }
+
+
+def prepare_payloads(files_bytes, prompt, uid=None, params=None):
+    """prepare_payload を一括診断用のプールで並列に実行する"""
+    return list(_batch_executor.map(lambda file_bytes: prepare_payload(file_bytes, prompt, uid, params), files_bytes))
+
+
+def uses_required(payloads):
+    """準備済みペイロードのうち、利用回数を消費する件数を返す"""
+    if result_cache.CACHE_HIT_CONSUMES_QUOTA:
+        return len(payloads)
+    return sum(1 for payload in payloads if payload["cached"] is None)
+
+
+def billable_count(results):
+    """利用回数を消費する結果の件数（エラー・実行中の採点への合流は返却、キャッシュヒットは設定次第）"""
+    return sum(
+        1 for result in results
+        if not result.get("error") and not result.get("joined")
+        and (not result.get("cached") or result_cache.CACHE_HIT_CONSUMES_QUOTA)
+    )
+
+
+def upload_banner_images(uid, file_bytes):
+    """
+    元画像と実績記録の一覧用サムネイルを、内容のハッシュから決まるパスに保存する。
+    同じ画像を採点し直した場合は既存のファイルを使い、アップロードもサムネイル生成も行わない。
+    戻り値は image_url / thumbnail_url / image_path / thumbnail_path のdict（失敗した項目はNone）。
+    """
+    uploaded = dict.fromkeys(["image_url", "thumbnail_url", "image_path", "thumbnail_path"])
+    digest = banner_storage.content_hash(file_bytes)
+    try:
+        content_type = image_utils.image_mime_type(file_bytes)
+        data = None
+        if content_type in banner_storage.EXTENSIONS:
+            try:
+                # 元画像はURLで共有されるので、撮影位置などのメタデータを除いてから保存する
+                data = image_utils.strip_metadata(file_bytes)
+            except ValueError as e:
+                logging.warning("Could not strip image metadata, storing as PNG: %s", e)
+        if data is None:
+            # Storageで扱いにくい形式・構造を解釈できない画像はPNGに変換して保存する（メタデータも残らない）
+            buffer = io.BytesIO()
+            image_utils.load_image(file_bytes).save(buffer, format="PNG")
+            data, content_type = buffer.getvalue(), "image/png"
+        path = banner_storage.image_path(uid, digest, content_type)
+        banner_storage.upload(path, data, content_type)
+        uploaded.update(image_path=path, image_url=banner_storage.url_for(path))
+    except Exception as e:
+        logging.warning("Banner upload failed: %s", e)
+        return uploaded
+
+    try:
+        thumb_mime = "image/webp" if image_utils.RECORD_THUMBNAIL_FORMAT == "WEBP" else "image/jpeg"
+        path = banner_storage.thumbnail_path(uid, digest, thumb_mime)
+        if not banner_storage.exists(path):
+            thumb_bytes, thumb_mime, _ = image_utils.record_thumbnail(file_bytes)
+            banner_storage.upload(path, thumb_bytes, thumb_mime)
+        uploaded.update(thumbnail_path=path, thumbnail_url=banner_storage.url_for(path))
+    except Exception as e:
+        logging.warning("Thumbnail upload failed: %s", e)
+    return uploaded
+
+
+def run_diagnosis(client, uid, pattern, file_bytes, prompt, record_data=None, add_ctr=False, payload=None,
+                  label=None, defer_save=False, on_delta=None, score_format="A/B/C", request_key=None):
+    """
+    1パターン分の診断を実行する。
+    Storageへのアップロード（サムネイル含む）はバックグラウンドで進め、その間に採点を行う。
+    アップロード結果はFirestore記録の直前でのみ待ち合わせる。
+    defer_save=True の場合は記録を保存せず result["record"] に入れて返す（一括書き込み用）。
+    UI描画は行わないので、ワーカースレッドから呼び出してよい。
+    """
+    label = label or f"{pattern}パターン"
+    result = {"pattern": pattern, "label": label, "image_url": None, "saved": False, "error": None, "warning": None}
+    try:
+        # モデルにはbase64を渡すのでURLは不要。アップロードは採点を待たせない
+        upload_future = _submit_with_ctx(_upload_executor, upload_banner_images, uid, file_bytes)
+
+        # モデルへは縮小・JPEG化した軽量版を送る（Storageには元画像のPNGを保存）
+        if payload is None:
+            payload = prepare_payload(file_bytes, prompt)
+        result["payload_stats"] = payload["stats"]
+
+        cached = payload["cached"] or result_cache.get(payload["cache_key"])
+        if cached is not None:
+            # 同じ画像・同じ条件で採点済みならモデル呼び出しを省略
+            result.update(cached)
+            result["cached"] = True
+        else:
+            content = request_score(client, prompt, payload["bytes"], payload["mime_type"], on_delta=on_delta)
+            try:
+                parsed = parse_ai_response(content, score_format)
+            except ValueError as e:
+                # 形式崩れで有料の採点を無駄にしないよう、安価な修復を1回だけ試みる
+                content = repair_response(client, content, str(e))
+                parsed = parse_ai_response(content, score_format)
+            result["ai_response"] = content
+            result.update(parsed)
+            result["cached"] = False
+            if client:
+                result_cache.put(payload["cache_key"], result)
+
+        uploaded = upload_future.result()
+        image_url = uploaded["image_url"]
+        result["image_url"] = image_url
+        if not image_url:
+            result["warning"] = "画像のアップロードに失敗したため、実績記録には画像が保存されません。"
+
+        if record_data is not None:
+            record = dict(record_data)
+            record.setdefault("pattern", pattern)
+            if request_key:
+                # 同じリクエストの記録は同じドキュメントIDになり、二重に作成されない
+                record["id"] = request_key
+            record.update({
+                "score": sanitize(result["score"]), "comment": sanitize(result["comment"]),
+                "predicted_ctr": result["ctr"] if add_ctr else None,
+                "sub_scores": result.get("sub_scores"),
+                # 近似重複の結果流用で条件の一致を確かめるために残す
+                "score_format": score_format, "add_ctr": bool(add_ctr),
+                **uploaded, "phash": payload["phash"],
+            })
+            if defer_save:
+                result["record"] = record
+                return result
+            result["saved"] = auth_utils.add_diagnosis_record_to_firestore(uid, record)
+            if result["saved"]:
+                phash_index.add(uid, {**record, "created_at": datetime.now()})
+                record_replica.invalidate(uid)  # 実績記録ページの表示に反映させる
+    except Exception as e:
+        result["error"] = f"AI採点中にエラーが発生しました（{label}）: {str(e)}"
+    return result
+
+
+def make_request_key(uid, job):
+    """ユーザー・画像・採点条件・記録内容から、診断リクエストを表すキーを作る"""
+    material = json.dumps({
+        "uid": uid,
+        "payload": job["payload"]["cache_key"],  # 正規化画像 + プロンプト + モデル
+        "pattern": job["pattern"],
+        "record": job.get("record_data"),
+        "add_ctr": job.get("add_ctr", False),
+        "score_format": job.get("score_format"),
+    }, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def assign_request_keys(jobs, press_id, now=None):
+    """
+    各ジョブにキーを割り当て、このボタン押下の利用回数予約の冪等キーを返す。
+    - flight_key: 内容だけのキー。実行中の同一リクエストへの合流（single-flight）に使う
+    - request_key: flight_key と時間枠（RECORD_DEDUP_WINDOW_SECONDS）から作る記録のドキュメントID。
+      連打や再送で同じ内容を続けて採点しても、同じ枠内なら記録は1件しか作られない
+    利用回数は press_id（ボタン押下ごとの乱数）ごとに予約するので、同じバナーを後日採点し直せば改めて消費される。
+    """
+    bucket = int((now or time.time()) // RECORD_DEDUP_WINDOW_SECONDS)
+    for job in jobs:
+        job["flight_key"] = make_request_key(job["uid"], job)
+        job["request_key"] = hashlib.sha256(f"{job['flight_key']}\0{bucket}".encode("utf-8")).hexdigest()
+    combined = "\0".join([press_id, *sorted(job["flight_key"] for job in jobs)])
+    return hashlib.sha256(combined.encode("utf-8")).hexdigest()
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _single_flight(key, submit):
+    """
+    同じキーの処理が実行中ならそのFutureに合流し、なければ submit() で開始する。
+    戻り値は (Future, 合流したか)
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None and not future.done():
+            return future, True
+        future = submit()
+        _inflight[key] = future
+
+    def _forget(done_future):
+        with _inflight_lock:
+            if _inflight.get(key) is done_future:
+                del _inflight[key]
+
+    future.add_done_callback(_forget)
+    return future, False
+
+
+def _submit_job(job, on_delta=None, executor=None):
+    key = job.get("flight_key")
+    job = {name: value for name, value in job.items() if name != "flight_key"}
+    submit = lambda: _submit_with_ctx(executor or _executor, run_diagnosis, **job, on_delta=on_delta)
+    return _single_flight(key, submit) if key else (submit(), False)
+
+
+def _future_result(future, pattern, joined=False):
+    try:
+        result = future.result()
+    except Exception as e:
+        return {"pattern": pattern, "error": f"AI採点中にエラーが発生しました（{pattern}パターン）: {e}"}
+    if joined:
+        # 他の押下で実行中だった採点に合流した結果。モデル呼び出しも記録も先行側で1回だけなので消費しない
+        result = {**result, "joined": True}
+    return result
+
+
+def _settle_when_done(submitted, quota):
+    """
+    投入したジョブがすべて終わったら、実際に採点できた分だけ利用回数を確定する（残りは返却）。
+    ワーカー側のコールバックで確定するので、画面の中断（rerun・タブを閉じる）で採点中の分が返却されることはない。
+    """
+    uid, key = quota
+    if not submitted:
+        auth_utils.settle_uses(uid, key, 0)
+        return
+    pending = [len(submitted)]
+    lock = threading.Lock()
+
+    def _done(_future):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        results = [_future_result(future, pattern, joined) for future, pattern, joined in submitted]
+        auth_utils.settle_uses(uid, key, billable_count(results))
+
+    for future, _, _ in submitted:
+        future.add_done_callback(_done)
+
+
+def _submit_jobs(jobs, quota=None, executor=None, on_delta=None):
+    """
+    ジョブをすべて投入し、(Future, pattern, 合流したか) のリストを返す。
+    quota=(uid, 冪等キー) を渡すと、全ジョブの完了時にその予約を確定する。
+    on_delta(pattern, text) を渡すと、採点中の応答を受け取る。
+    """
+    submitted = []
+    try:
+        for job in jobs:
+            pattern = job["pattern"]
+            callback = (lambda text, pattern=pattern: on_delta(pattern, text)) if on_delta else None
+            future, joined = _submit_job(job, on_delta=callback, executor=executor)
+            submitted.append((future, pattern, joined))
+    finally:
+        # 途中で投入に失敗した場合も、投入済みの分だけで確定する（1件も投入できなければ全額返却）
+        if quota:
+            _settle_when_done(submitted, quota)
+    return submitted
+
+
+def _iter_completed(submitted):
+    futures = {future: (pattern, joined) for future, pattern, joined in submitted}
+    for future in as_completed(futures):
+        yield _future_result(future, *futures[future])
+
+
+def run_diagnoses_concurrently(jobs, batch=False, quota=None):
+    """
+    複数パターンの診断を共有スレッドプールで同時に実行し、終わった順に結果を返すイテレータを返す。
+    jobs は run_diagnosis のキーワード引数を持つdictのリスト。
+    batch=True なら一括診断用のプールで実行する。
+    同じ flight_key の診断が実行中なら、新たに実行せずその結果を待つ。
+    ジョブは呼び出した時点で投入され、quota=(uid, 冪等キー) の予約は全ジョブの完了時に確定される。
+    """
+    executor = _batch_executor if batch else _executor
+    return _iter_completed(_submit_jobs(jobs, quota, executor=executor))
+
+
+def stream_diagnoses_concurrently(jobs, quota=None):
+    """
+    run_diagnoses_concurrently のストリーミング版。
+    ("delta", pattern, これまでの応答テキスト) と ("result", pattern, result) のイベントを届いた順に返すイテレータを返す。
+    実行中の同一リクエストに合流した場合、deltaは届かず結果のみとなる。
+    UIの描画はこのイテレータを回す側（メインスレッド）で行う。
+    """
+    events = queue.Queue()
+    submitted = _submit_jobs(jobs, quota, on_delta=lambda pattern, text: events.put(("delta", pattern, text)))
+    for future, pattern, joined in submitted:
+        # 例外時も必ず結果イベントを送り、呼び出し側の待ち合わせを終わらせる
+        future.add_done_callback(
+            lambda f, pattern=pattern, joined=joined: events.put(("result", pattern, _future_result(f, pattern, joined)))
+        )
+    return _iter_events(events, [pattern for _, pattern, _ in submitted])
+
+
+def _iter_events(events, patterns):
+    received = {pattern: "" for pattern in patterns}
+    remaining = len(patterns)
+    while remaining:
+        kind, pattern, payload = events.get()
+        if kind == "delta":
+            received[pattern] += payload
+            yield "delta", pattern, received[pattern]
+        elif kind == "result":
+            remaining -= 1
+            yield "result", pattern, payload
+
+
+def extract_batch_images(uploaded_files):
+    """
+    一括診断用に、複数アップロード・ZIPから画像を取り出して (画像リスト, スキップしたファイル名リスト) を返す。
+    画像リストは (ファイル名, バイト列) のタプル。ZIP内の画像以外は読み飛ばし、
+    サイズ・解像度の上限を超える画像はデコードせずにスキップする。壊れたZIP・エントリもスキップする。BATCH_MAX_FILES 件で打ち切る。
+    """
+    images = []
+    skipped = []
+
+    def _accept(name, file_bytes):
+        try:
+            image_utils.validate_image(file_bytes)
+        except (image_utils.ImageTooLargeError, OSError):
+            skipped.append(name)
+            return
+        images.append((name, file_bytes))
+
+    for uploaded_file in uploaded_files:
+        if len(images) >= BATCH_MAX_FILES:
+            break
+        if uploaded_file.name.lower().endswith(".zip"):
+            try:
+                archive = zipfile.ZipFile(uploaded_file)
+            except zipfile.BadZipFile:
+                skipped.append(uploaded_file.name)
+                continue
+            with archive:
+                for info in archive.infolist():
+                    if len(images) >= BATCH_MAX_FILES:
+                        break
+                    name = os.path.basename(info.filename)
+                    if info.is_dir() or name.startswith(".") or not name.lower().endswith(BATCH_IMAGE_EXTENSIONS):
+                        continue
+                    # 展開前に宣言サイズで判定する（ZIP爆弾対策）
+                    if info.file_size > image_utils.IMAGE_MAX_UPLOAD_BYTES:
+                        skipped.append(name)
+                        continue
+                    try:
+                        data = archive.read(info)
+                    except (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError):
+                        # CRC不一致・壊れた圧縮データ・未対応の圧縮方式・暗号化されたエントリ
+                        skipped.append(name)
+                        continue
+                    _accept(name, data)
+        else:
+            _accept(uploaded_file.name, uploaded_file.getvalue())
+    return images, skipped
+
+
+def save_batch_records(uid, results):
+    """一括診断で保留した記録をバッチ書き込みし、各resultの saved を更新する"""
+    pending = [result for result in results if result.get("record")]
+    if not pending:
+        return 0
+    if not auth_utils.add_diagnosis_records_batch(uid, [result["record"] for result in pending]):
+        return 0
+    for result in pending:
+        result["saved"] = True
+        phash_index.add(uid, {**result["record"], "created_at": datetime.now()})
+    record_replica.invalidate(uid)
+    return len(pending)
+
+
+def _submit_with_ctx(executor, fn, *args, **kwargs):
+    """呼び出し元セッションのScriptRunContextを引き継いでタスクを投入する（ワーカー内の st.error 等を表示させるため）"""
+    ctx = get_script_run_ctx()
+
+    def _task():
+        add_script_run_ctx(ctx=ctx)
+        return fn(*args, **kwargs)
+
+    return executor.submit(_task)
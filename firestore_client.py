@@ -2,6 +2,7 @@
 import os
 import json
 import logging
+from datetime import datetime, timezone
 
 # dotenvはローカル開発用。Streamlit Cloudではsecrets使うので無くてもOK
 try:
@@ -60,19 +61,168 @@ def get_firestore_db():
         )
     return _db
 
+# プランごとの月間利用回数
+PLAN_MONTHLY_USES = {
+    "Free": 10, "Guest": 0, "Light": 50, "Pro": 200, "Team": 500, "Enterprise": 1000
+}
+
+# --- 利用回数の予約（users/{uid}/quota_reservations/{key}） ---
+# 予約には期限（expires_at）を書いておき、確定も返却もされないまま期限を過ぎたもの
+# （処理中にプロセスが落ちた等）は release_expired_reservations で返却する。
+QUOTA_RESERVATIONS_COLLECTION = "quota_reservations"
+
+
+def quota_reservation_ref(uid, key, db=None):
+    db = db or get_firestore_db()
+    return db.collection('users').document(uid).collection(QUOTA_RESERVATIONS_COLLECTION).document(key)
+
+
+def reserved_before_reset(user_data, reserved_at):
+    """
+    予約した後に月次リセットで残回数がプランの上限に戻されていればTrue。
+    その予約の返却分を新しい月の残回数に足すと上限を超えてしまうので、返却しない。
+    """
+    last_reset = user_data.get("last_reset")
+    if not last_reset or reserved_at is None:
+        return False
+    last = datetime.fromisoformat(last_reset.replace('Z', '+00:00'))
+    if last.tzinfo is None:
+        last = last.replace(tzinfo=timezone.utc)
+    return reserved_at < last
+
+
+def settle_quota_reservation(uid, key, used, db=None):
+    """
+    予約を確定し、返却した回数を返す。used 未満しか使わなかった分は残回数に返却する。
+    確定・返却済み（または存在しない）予約なら何もせず0を返す。
+    予約後に月次リセットがあった場合は、確定だけして返却はしない。
+    """
+    db = db or get_firestore_db()
+    user_ref = db.collection('users').document(uid)
+    reservation_ref = quota_reservation_ref(uid, key, db)
+
+    @firestore.transactional
+    def _settle(transaction):
+        reservation_snapshot = reservation_ref.get(transaction=transaction)
+        if not reservation_snapshot.exists:
+            return 0
+        reservation = reservation_snapshot.to_dict()
+        if reservation.get("status") != "reserved":
+            return 0
+        user_data = user_ref.get(transaction=transaction).to_dict() or {}
+        amount = reservation.get("amount", 0)
+        refund = max(0, amount - min(used, amount))
+        settled = {
+            "used": amount - refund,
+            "status": "committed" if amount - refund else "released",
+            "settled_at": firestore.SERVER_TIMESTAMP,
+        }
+        if refund and reserved_before_reset(user_data, reservation.get("created_at")):
+            settled["refund_dropped"] = refund
+            refund = 0
+        if refund:
+            transaction.update(user_ref, {"remaining_uses": firestore.Increment(refund)})
+        transaction.update(reservation_ref, settled)
+        return refund
+
+    return _settle(db.transaction())
+
+
+def refund_uses(uid, amount, reserved_at, db=None):
+    """
+    予約の記録を持たない返却（精算済みのリースから払い出した分）を残回数に戻し、返却した回数を返す。
+    reserved_at の後に月次リセットがあれば返却しない。
+    """
+    db = db or get_firestore_db()
+    user_ref = db.collection('users').document(uid)
+
+    @firestore.transactional
+    def _refund(transaction):
+        user_data = user_ref.get(transaction=transaction).to_dict() or {}
+        if reserved_before_reset(user_data, reserved_at):
+            return 0
+        transaction.update(user_ref, {"remaining_uses": firestore.Increment(amount)})
+        return amount
+
+    return _refund(db.transaction())
+
+
+def release_expired_reservations(now=None, db=None):
+    """
+    期限切れのまま残っている予約をすべて返却し、返却した予約の件数を返す。
+    collection group クエリ（status == "reserved" かつ expires_at < now）なので、
+    quota_reservations に status・expires_at の複合インデックス（コレクショングループ）が必要。
+    """
+    db = db or get_firestore_db()
+    now = now or datetime.now(timezone.utc)
+    query = (
+        db.collection_group(QUOTA_RESERVATIONS_COLLECTION)
+        .where("status", "==", "reserved")
+        .where("expires_at", "<", now)
+    )
+    released = 0
+    for doc in query.stream():
+        uid = doc.reference.parent.parent.id
+        try:
+            settle_quota_reservation(uid, doc.id, 0, db)
+            released += 1
+        except Exception as e:
+            logging.warning("Failed to release expired reservation %s/%s: %s", uid, doc.id, e)
+    return released
+
+
+# Stripeの顧客ID → ユーザーID の逆引き索引（stripe_customers/{customer_id} = {"uid": ...}）
+STRIPE_CUSTOMERS_COLLECTION = "stripe_customers"
+
+
+def link_stripe_customer(uid, customer_id, transaction=None):
+    """
+    顧客IDとユーザーを結びつける（逆引き索引とユーザードキュメントの両方に書く）。
+    transaction を渡すとその中で書き込む。
+    """
+    db = get_firestore_db()
+    index_ref = db.collection(STRIPE_CUSTOMERS_COLLECTION).document(customer_id)
+    user_ref = db.collection('users').document(uid)
+    index_data = {"uid": uid, "linked_at": firestore.SERVER_TIMESTAMP}
+    if transaction is not None:
+        transaction.set(index_ref, index_data)
+        transaction.set(user_ref, {"stripe_customer_id": customer_id}, merge=True)
+    else:
+        index_ref.set(index_data)
+        user_ref.set({"stripe_customer_id": customer_id}, merge=True)
+
+
+def find_uid_by_customer(customer_id):
+    """
+    顧客IDからユーザーIDを引く（索引のドキュメント1件を読むだけ）。
+    索引がない古いユーザーは stripe_customer_id で検索し、見つかれば索引を作っておく。
+    索引の補完で書き込むため、トランザクションの中からは呼ばないこと。
+    """
+    if not customer_id:
+        return None
+    db = get_firestore_db()
+    index_doc = db.collection(STRIPE_CUSTOMERS_COLLECTION).document(customer_id).get()
+    if index_doc.exists:
+        return index_doc.to_dict().get("uid")
+    docs = db.collection('users').where('stripe_customer_id', '==', customer_id).limit(1).stream()
+    user_doc = next(docs, None)
+    if user_doc is None:
+        return None
+    db.collection(STRIPE_CUSTOMERS_COLLECTION).document(customer_id).set(
+        {"uid": user_doc.id, "linked_at": firestore.SERVER_TIMESTAMP}
+    )
+    return user_doc.id
+
+
 # 既存の関数は互換維持
 def update_user_plan(customer_id, plan_name, remaining_uses):
     """
-    users コレクションで stripe_customer_id == customer_id のユーザを1件探して
-    plan / remaining_uses を更新。
+    Stripeの顧客IDに対応するユーザーの plan / remaining_uses を更新する（逆引き索引で直接特定）。
     """
     try:
-        db = get_firestore_db()
-        users_ref = db.collection('users')
-        docs = users_ref.where('stripe_customer_id', '==', customer_id).limit(1).stream()
-        user_doc = next(docs, None)
-        if user_doc:
-            user_doc.reference.update({'plan': plan_name, 'remaining_uses': remaining_uses})
+        uid = find_uid_by_customer(customer_id)
+        if uid:
+            get_firestore_db().collection('users').document(uid).update({'plan': plan_name, 'remaining_uses': remaining_uses})
             return True
         return False
     except Exception as e:
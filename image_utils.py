@@ -0,0 +1,553 @@
+# image_utils.py
+# 画像の前処理ユーティリティ（Vision API向けのペイロード最適化・デコード/サムネイルキャッシュ・知覚ハッシュ）
+import hashlib
+import io
+import logging
+import os
+import struct
+import threading
+import warnings
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageOps, features
+
+try:
+    import resource  # プロセスのピークRSS取得用（Unixのみ）
+except ImportError:
+    resource = None
+
+# --- Vision API向け前処理の設定（環境変数で上書き可能） ---
+# detail="low" は512px四方の1タイル、"high" は2048px四方に収めた後、短辺768pxに縮小され512pxタイルで課金される
+VISION_DETAIL = os.getenv("VISION_IMAGE_DETAIL", "high")
+VISION_MAX_LONG_EDGE = int(os.getenv("VISION_IMAGE_MAX_LONG_EDGE", "2048"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_IMAGE_JPEG_QUALITY", "85"))
+
+_LOW_DETAIL_SIZE = 512
+_HIGH_DETAIL_BOX = 2048
+_HIGH_DETAIL_SHORT_EDGE = 768
+
+
+# --- メモリ上限つきデコード ---
+# これを超えるファイルはデコードせずに拒否する
+IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# これを超える画素数は展開せずに拒否する（解凍爆弾対策。PillowのDecompressionBomb判定にも使う）
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(100_000_000)))
+# これを超える画素数は縮小してから保持する（JPEGはdraftで縮小デコード）。
+# JPEG以外はデコード前に縮小できないため、これを超える画素数は拒否する
+IMAGE_DECODE_PIXEL_BUDGET = int(os.getenv("IMAGE_DECODE_PIXEL_BUDGET", str(16_000_000)))
+
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+
+class ImageTooLargeError(ValueError):
+    """画像がバイト数・画素数の上限を超えている"""
+
+
+def _open_checked(file_bytes):
+    """ヘッダだけを読み、バイト数・画素数の上限を確認した未デコードの画像を返す"""
+    if len(file_bytes) > IMAGE_MAX_UPLOAD_BYTES:
+        raise ImageTooLargeError(
+            f"画像ファイルが大きすぎます（{len(file_bytes) / 1024 / 1024:.1f}MB / 上限 {IMAGE_MAX_UPLOAD_BYTES / 1024 / 1024:.0f}MB）"
+        )
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            image = Image.open(io.BytesIO(file_bytes))
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        raise ImageTooLargeError("画像の解像度が大きすぎます。")
+    if image.width * image.height > IMAGE_MAX_PIXELS:
+        raise ImageTooLargeError(f"画像の解像度が大きすぎます（{image.width}×{image.height}）")
+    if image.format != "JPEG" and image.width * image.height > IMAGE_DECODE_PIXEL_BUDGET:
+        # PNG等は全画素を展開しないと縮小できず、展開だけで数百MBを確保してしまう
+        raise ImageTooLargeError(
+            f"JPEG以外の画像は{IMAGE_DECODE_PIXEL_BUDGET / 1_000_000:.0f}メガピクセルまでです（{image.width}×{image.height}）"
+        )
+    return image
+
+
+def validate_image(file_bytes):
+    """デコードせずに上限を確認する（超過時は ImageTooLargeError）"""
+    _open_checked(file_bytes)
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def decode_image(file_bytes, pixel_budget=IMAGE_DECODE_PIXEL_BUDGET):
+    """
+    上限を確認してから画像をデコードし、(画像, 統計dict) を返す。
+    画素数が pixel_budget を超える場合、JPEGは draft() で縮小デコードし、
+    それ以外もデコード直後に予算内まで縮小してフル解像度を保持し続けない。
+    JPEG以外で IMAGE_DECODE_PIXEL_BUDGET を超えるものは、展開する前に _open_checked で拒否される。
+    """
+    image = _open_checked(file_bytes)
+    original_size = image.size
+    rss_before = _peak_rss_kb()
+
+    pixels = image.width * image.height
+    if pixels > pixel_budget:
+        scale = (pixel_budget / pixels) ** 0.5
+        target = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        if image.format == "JPEG":
+            # DCT段階で1/2〜1/8に縮小してデコードする（target以上の最小サイズになる）
+            image.draft(image.mode, target)
+        image.load()
+        decoded_size = image.size
+        if image.width * image.height > pixel_budget:
+            image.thumbnail(target, Image.LANCZOS)
+    else:
+        image.load()
+        decoded_size = image.size
+
+    bands = len(image.getbands())
+    rss_after = _peak_rss_kb()
+    stats = {
+        "original_size": original_size,
+        "decoded_size": decoded_size,
+        "final_size": image.size,
+        # 展開時に確保された画素バッファの見積もり（縮小時は縮小前後の両方を同時に保持する）
+        "estimated_peak_bytes": decoded_size[0] * decoded_size[1] * bands
+        + (image.width * image.height * bands if image.size != decoded_size else 0),
+        "rss_peak_increase_kb": (rss_after - rss_before) if rss_before is not None else None,
+    }
+    logging.info(
+        "Decoded image %s -> %s (decoded at %s), est. peak %.1fMB, process peak RSS +%sKB",
+        original_size, image.size, decoded_size, stats["estimated_peak_bytes"] / 1024 / 1024,
+        stats["rss_peak_increase_kb"],
+    )
+    return image, stats
+
+
+# --- デコード済み画像・サムネイルのキャッシュ ---
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# ディスク層は IMAGE_CACHE_DIR を設定したときだけ有効（サムネイルをコンテンツアドレスで保存）
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR")
+IMAGE_DISK_CACHE_MAX_BYTES = int(os.getenv("IMAGE_DISK_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+DISPLAY_MAX_EDGE = 800
+
+# 実績記録の一覧用サムネイル（アップロード時に生成してStorageに保存する）
+RECORD_THUMBNAIL_MAX_EDGE = int(os.getenv("RECORD_THUMBNAIL_MAX_EDGE", "320"))
+RECORD_THUMBNAIL_QUALITY = int(os.getenv("RECORD_THUMBNAIL_QUALITY", "75"))
+RECORD_THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+
+
+class ImageCache:
+    """
+    デコード済みPIL画像をバイト数上限つきLRUで保持する（プロセス内共有）。
+    返した画像は複数セッションで共有されるため、呼び出し側で書き換えないこと。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        size = self._sizeof(image)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._sizeof(self._entries.pop(key))
+            self._entries[key] = image
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= self._sizeof(evicted)
+
+
+class DiskThumbnailCache:
+    """
+    サムネイルをコンテンツハッシュ名で保存するディスク層。合計サイズが上限を超えたら古い順に削除する。
+    合計サイズはメモリ上で数えておき、ディレクトリ全体の走査は上限超過時と一定回数の書き込みごとにだけ行う。
+    """
+
+    # 他プロセスとの共有などで数え方がずれても、この回数ごとに実際のサイズで数え直す
+    RESCAN_EVERY_PUTS = 500
+    # 削除するときは上限のこの割合まで減らし、上限付近で書き込みのたびに走査し直さないようにする
+    EVICT_TO_RATIO = 0.9
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._scan())
+        self._puts_since_scan = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _scan(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            image = Image.open(path)
+            image.load()
+            os.utime(path)  # LRUとして扱うため最終利用時刻を更新
+            return image
+        except (FileNotFoundError, OSError):
+            return None
+
+    def put(self, key, image):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            image.save(tmp_path, format="PNG")
+            size = os.path.getsize(tmp_path)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("Disk thumbnail cache write failed: %s", e)
+            return
+        with self._lock:
+            self.total_bytes += size - replaced
+            self._puts_since_scan += 1
+            needs_scan = self.total_bytes > self.max_bytes or self._puts_since_scan >= self.RESCAN_EVERY_PUTS
+        if needs_scan:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                target = self.max_bytes * self.EVICT_TO_RATIO
+                for _, size, path in sorted(entries):
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                    except OSError:
+                        pass
+            self.total_bytes = total
+            self._puts_since_scan = 0
+
+
+_memory_cache = ImageCache(IMAGE_CACHE_MAX_BYTES)
+_disk_cache = DiskThumbnailCache(IMAGE_CACHE_DIR, IMAGE_DISK_CACHE_MAX_BYTES) if IMAGE_CACHE_DIR else None
+
+
+def content_key(file_bytes):
+    """画像バイト列のコンテンツハッシュ"""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def upload_key(uploaded_file):
+    """
+    アップロードのキャッシュキー。Streamlitのアップロードはfile_idで同一性を判定できる（ハッシュ計算を省ける）。
+    同じアップロードのデコード結果を1つにまとめるため、表示・採点・知覚ハッシュのすべてでこのキーを使う
+    """
+    file_id = getattr(uploaded_file, "file_id", None)
+    return f"upload:{file_id}" if file_id else content_key(uploaded_file.getvalue())
+
+
+def image_mime_type(file_bytes):
+    """ヘッダから画像形式を判定してMIMEタイプを返す（判定できなければNone）"""
+    try:
+        with Image.open(io.BytesIO(file_bytes)) as image:
+            return Image.MIME.get(image.format)
+    except Exception:
+        return None
+
+
+def load_image(file_bytes, key=None):
+    """バイト列をデコードしたPIL画像を返す（上限超過は ImageTooLargeError。キャッシュ済みなら再デコードしない）"""
+    key = key or content_key(file_bytes)
+    image = _memory_cache.get(f"full:{key}")
+    if image is None:
+        image, _ = decode_image(file_bytes)
+        _memory_cache.put(f"full:{key}", image)
+    return image
+
+
+def thumbnail(file_bytes, max_edge=DISPLAY_MAX_EDGE, key=None):
+    """表示用サムネイルを返す。メモリ → ディスク → 生成 の順に探す"""
+    key = key or content_key(file_bytes)
+    memory_key = f"thumb:{max_edge}:{key}"
+    image = _memory_cache.get(memory_key)
+    if image is not None:
+        return image
+
+    disk_key = hashlib.sha256(f"{max_edge}:{key}".encode("utf-8")).hexdigest()
+    if _disk_cache is not None:
+        image = _disk_cache.get(disk_key)
+
+    if image is None:
+        image = ImageOps.exif_transpose(load_image(file_bytes, key))
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if _disk_cache is not None:
+            _disk_cache.put(disk_key, image)
+
+    _memory_cache.put(memory_key, image)
+    return image
+
+
+def upload_thumbnail(uploaded_file, max_edge=DISPLAY_MAX_EDGE):
+    """st.file_uploader のアップロードから表示用サムネイルを返す（rerunごとのデコード・縮小を省く）"""
+    return thumbnail(uploaded_file.getvalue(), max_edge, key=upload_key(uploaded_file))
+
+
+def asset_thumbnail(path, max_edge=DISPLAY_MAX_EDGE):
+    """ロゴなどの静的アセットをプロセス内で一度だけ縮小して返す（更新時刻が変われば作り直す）"""
+    key = f"asset:{os.path.abspath(path)}:{os.path.getmtime(path)}"
+    image = _memory_cache.get(f"thumb:{max_edge}:{key}")
+    if image is None:
+        with open(path, "rb") as f:
+            image = thumbnail(f.read(), max_edge, key=key)
+    return image
+
+
+def flatten_to_rgb(image):
+    """透過画像は白背景に合成してRGBにする（JPEGはアルファを持てない）"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    return image
+
+
+def record_thumbnail(file_bytes, max_edge=RECORD_THUMBNAIL_MAX_EDGE, key=None):
+    """
+    実績記録の一覧に載せる小さなサムネイルをエンコードし、(バイト列, MIMEタイプ, 拡張子) を返す。
+    PillowがWebPに対応していればWebP、なければJPEG。
+    """
+    image = flatten_to_rgb(thumbnail(file_bytes, max_edge, key=key))
+    output = io.BytesIO()
+    if RECORD_THUMBNAIL_FORMAT == "WEBP":
+        image.save(output, format="WEBP", quality=RECORD_THUMBNAIL_QUALITY, method=4)
+        return output.getvalue(), "image/webp", "webp"
+    image.save(output, format="JPEG", quality=RECORD_THUMBNAIL_QUALITY, optimize=True)
+    return output.getvalue(), "image/jpeg", "jpg"
+
+
+# --- 保存する元画像のメタデータ除去 ---
+_ORIENTATION_TAG = 0x0112
+_JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}  # APP1（EXIF・XMP）、APP13（IPTC）、COM（コメント）
+_PNG_METADATA_CHUNKS = {b"eXIf", b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+_WEBP_METADATA_CHUNKS = {b"EXIF", b"XMP "}
+_WEBP_EXIF_FLAG, _WEBP_XMP_FLAG = 0x08, 0x04
+
+
+def _orientation_exif(orientation):
+    """向き（Orientation）タグだけを持つTIFF形式のEXIF"""
+    return b"MM\x00*" + struct.pack(">IHHHIHHI", 8, 1, _ORIENTATION_TAG, 3, 1, orientation, 0, 0)
+
+
+def _strip_jpeg(data, orientation):
+    out = [data[:2]]  # SOI
+    pending = None
+    if orientation != 1:
+        exif = b"Exif\x00\x00" + _orientation_exif(orientation)
+        pending = b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("JPEGのセグメント構造を解釈できません")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # 詰め物のバイト
+            pos += 1
+            continue
+        if pending and marker != 0xE0:
+            # APP0（JFIF）の直後に向きだけのEXIFを置く
+            out.append(pending)
+            pending = None
+        if marker == 0xDA:
+            # SOS以降は画素データなので、そのまま写す
+            out.append(data[pos:])
+            return b"".join(out)
+        end = pos + 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if marker not in _JPEG_METADATA_MARKERS:
+            out.append(data[pos:end])
+        pos = end
+    raise ValueError("JPEGに画素データ（SOS）が見つかりません")
+
+
+def _strip_png(data, orientation):
+    out = [data[:8]]  # シグネチャ
+    pending = None
+    if orientation != 1:
+        exif = _orientation_exif(orientation)
+        pending = struct.pack(">I", len(exif)) + b"eXIf" + exif + struct.pack(">I", zlib.crc32(b"eXIf" + exif))
+    pos = 8
+    while pos + 12 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        end = pos + 12 + length
+        if pending and chunk_type == b"IDAT":
+            out.append(pending)  # eXIf は最初のIDATより前に置く決まり
+            pending = None
+        if chunk_type not in _PNG_METADATA_CHUNKS:
+            out.append(data[pos:end])
+        pos = end
+        if chunk_type == b"IEND":
+            return b"".join(out)
+    raise ValueError("PNGの終端（IEND）が見つかりません")
+
+
+def _strip_webp(data, orientation):
+    chunks = []
+    pos = 12  # RIFFヘッダ
+    while pos + 8 <= len(data):
+        chunk_type, length = struct.unpack("<4sI", data[pos:pos + 8])
+        end = pos + 8 + length + (length & 1)
+        if chunk_type not in _WEBP_METADATA_CHUNKS:
+            chunks.append([chunk_type, data[pos + 8:pos + 8 + length]])
+        pos = end
+    if not chunks:
+        raise ValueError("WebPのチャンク構造を解釈できません")
+    if chunks[0][0] == b"VP8X":
+        # 拡張形式はヘッダのフラグにメタデータの有無を持つ。向きが必要ならEXIFを末尾に付け直す
+        flags = chunks[0][1][0] & ~(_WEBP_EXIF_FLAG | _WEBP_XMP_FLAG)
+        if orientation != 1:
+            flags |= _WEBP_EXIF_FLAG
+            chunks.append([b"EXIF", _orientation_exif(orientation)])
+        chunks[0][1] = bytes([flags]) + chunks[0][1][1:]
+    body = b"".join(
+        struct.pack("<4sI", chunk_type, len(payload)) + payload + b"\x00" * (len(payload) & 1)
+        for chunk_type, payload in chunks
+    )
+    return b"RIFF" + struct.pack("<I", len(body) + 4) + b"WEBP" + body
+
+
+_METADATA_STRIPPERS = {"JPEG": _strip_jpeg, "PNG": _strip_png, "WEBP": _strip_webp}
+
+
+def strip_metadata(file_bytes):
+    """
+    撮影位置（GPS）・機種などのEXIF、XMP、IPTC、コメントを除いた画像のバイト列を返す。
+    画素データは再エンコードせず、メタデータのブロックだけを取り除く（画質は変わらず、デコードもしない）。
+    表示が回転しないよう、向き（Orientation）だけは残す。GIFはEXIFを持たないのでそのまま返す。
+    構造を解釈できない画像は ValueError。
+    """
+    with Image.open(io.BytesIO(file_bytes)) as image:
+        strip = _METADATA_STRIPPERS.get(image.format)
+        if strip is None:
+            return file_bytes
+        orientation = image.getexif().get(_ORIENTATION_TAG, 1)
+    if orientation not in range(1, 9):
+        orientation = 1
+    try:
+        return strip(file_bytes, orientation)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"{image.format}の構造を解釈できません: {e}") from e
+
+
+def vision_target_size(width, height, detail=VISION_DETAIL, max_long_edge=VISION_MAX_LONG_EDGE):
+    """モデル側のタイル分割規則に合わせた縮小後サイズを返す（拡大はしない）"""
+    if detail == "low":
+        box = min(_LOW_DETAIL_SIZE, max_long_edge)
+        scale = min(1.0, box / max(width, height))
+    else:
+        box = min(_HIGH_DETAIL_BOX, max_long_edge)
+        scale = min(1.0, box / max(width, height))
+        # サーバ側でも短辺768pxまで縮小されるので、それ以上の解像度は送るだけ無駄
+        scale = min(scale, _HIGH_DETAIL_SHORT_EDGE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def optimize_for_vision(file_bytes, detail=VISION_DETAIL, max_long_edge=VISION_MAX_LONG_EDGE, quality=VISION_JPEG_QUALITY,
+                        key=None):
+    """
+    アップロード画像をVision APIに送る形に最適化する。
+    タイルグリッドに合わせた縮小、メタデータ除去、JPEG再エンコードを行い、
+    (最適化後のバイト列, MIMEタイプ, 統計dict) を返す。
+    """
+    # EXIFの回転情報を画素に反映してから捨てる（exif_transposeはコピーを返すのでキャッシュを汚さない）
+    image = ImageOps.exif_transpose(load_image(file_bytes, key))
+
+    image = flatten_to_rgb(image)
+
+    target_size = vision_target_size(image.width, image.height, detail, max_long_edge)
+    if target_size != image.size:
+        image = image.resize(target_size, Image.LANCZOS)
+
+    # 新しいバッファに保存し直すことでEXIF/ICC/テキストチャンク等のメタデータを落とす
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    optimized_bytes = output.getvalue()
+
+    stats = {
+        "original_bytes": len(file_bytes),
+        "optimized_bytes": len(optimized_bytes),
+        "bytes_saved": len(file_bytes) - len(optimized_bytes),
+        "size": target_size,
+        "detail": detail,
+    }
+    logging.info(
+        "Vision payload optimized: %d -> %d bytes (saved %d), size=%s, detail=%s",
+        stats["original_bytes"], stats["optimized_bytes"], stats["bytes_saved"], target_size, detail,
+    )
+    return optimized_bytes, "image/jpeg", stats
+
+
+# --- 知覚ハッシュ（近似重複検出用） ---
+PHASH_SIZE = 8
+_PHASH_SAMPLE = 32
+
+
+def _dct_matrix(n):
+    """n×n のDCT-II変換行列"""
+    k = np.arange(n).reshape(-1, 1)
+    i = np.arange(n).reshape(1, -1)
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0, :] = np.sqrt(1 / n)
+    return matrix
+
+
+_DCT = _dct_matrix(_PHASH_SAMPLE)
+
+
+def perceptual_hash(file_bytes, key=None):
+    """
+    pHash（64bit）を16桁の16進文字列で返す。
+    再書き出し・軽微なトリミング・JPEG画質の違い程度ならハミング距離が小さく保たれる。
+    """
+    image = ImageOps.exif_transpose(load_image(file_bytes, key)).convert("L").resize((_PHASH_SAMPLE, _PHASH_SAMPLE), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.float64)
+    coefficients = _DCT @ pixels @ _DCT.T
+    # 低周波成分（DC成分を除く）を中央値で2値化
+    low = coefficients[:PHASH_SIZE, :PHASH_SIZE].flatten()
+    bits = low > np.median(low[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:016x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    """16進文字列のハッシュ同士のハミング距離"""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
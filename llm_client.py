@@ -0,0 +1,300 @@
+# llm_client.py
+# OpenAI呼び出しの共通レイヤー（共有クライアント・リトライ・バックオフ・期限・サーキットブレーカー・レート制限・メトリクス）
+import importlib.util
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+import openai
+import streamlit as st
+
+# --- 設定（環境変数で上書き可能） ---
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_DEFAULT_DEADLINE = float(os.getenv("LLM_DEFAULT_DEADLINE_SECONDS", "90"))
+LLM_BACKOFF_BASE = 0.5
+LLM_BACKOFF_MAX = 20.0
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+
+# HTTP接続プールの設定
+OPENAI_POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX_CONNECTIONS", "20"))
+OPENAI_POOL_MAX_KEEPALIVE = int(os.getenv("OPENAI_POOL_MAX_KEEPALIVE", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "5"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT_SECONDS", "60"))
+# h2 パッケージが入っていればHTTP/2で多重化する
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# 再試行すれば成功しうるエラー
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class LLMUnavailableError(Exception):
+    """サーキットブレーカーが開いている、または期限内に応答が得られなかった"""
+
+
+class RateLimiter:
+    """トークンバケット方式のレートリミッタ（プロセス全体でOpenAIへのリクエスト数を制限）"""
+
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.tokens = float(self.capacity)
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise LLMUnavailableError("OpenAIへのリクエストが混み合っています。しばらくしてから再度お試しください。")
+            _record_wait(wait)
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    連続失敗が閾値を超えたら一定時間すべての呼び出しを即座に失敗させる。
+    クールダウン後は1件だけ試行を通し（half-open）、成功すれば閉じる。
+    """
+
+    def __init__(self, failure_threshold, cooldown_seconds):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    logging.warning("OpenAI circuit breaker opened after %d consecutive failures", self.failures)
+                self.opened_at = time.monotonic()
+
+
+# --- プロセス全体で共有する状態 ---
+rate_limiter = RateLimiter(OPENAI_REQUESTS_PER_MINUTE)
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN_SECONDS)
+
+_metrics = {
+    "calls": 0, "successes": 0, "failures": 0, "retries": 0, "wait_seconds": 0.0, "rejected": 0,
+    "in_flight": 0, "peak_in_flight": 0,
+}
+_metrics_lock = threading.Lock()
+
+
+def _count(key, amount=1):
+    with _metrics_lock:
+        _metrics[key] += amount
+
+
+def _record_wait(seconds):
+    _count("wait_seconds", seconds)
+
+
+def _enter_request():
+    with _metrics_lock:
+        _metrics["in_flight"] += 1
+        _metrics["peak_in_flight"] = max(_metrics["peak_in_flight"], _metrics["in_flight"])
+
+
+def _exit_request():
+    with _metrics_lock:
+        _metrics["in_flight"] -= 1
+
+
+@st.cache_resource
+def get_client():
+    """
+    プロセス全体で共有するOpenAIクライアントを返す（APIキー未設定ならNone）。
+    rerunやセッションをまたいで接続プールを使い回し、TLSハンドシェイクを毎回やり直さない。
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    http_client = openai.DefaultHttpxClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    )
+    return openai.OpenAI(api_key=api_key, http_client=http_client)
+
+
+def pool_stats(client):
+    """共有クライアントの接続プール使用状況（接続数・使用中・アイドル）を返す"""
+    stats = {"max_connections": OPENAI_POOL_MAX_CONNECTIONS, "http2": HTTP2_AVAILABLE,
+             "connections": 0, "active": 0, "idle": 0}
+    try:
+        # httpx/httpcore は公開APIでプール状態を出さないため内部属性を参照する（取れなければ0のまま）
+        pool = client._client._transport._pool
+        connections = list(pool.connections)
+        stats["connections"] = len(connections)
+        stats["idle"] = sum(1 for connection in connections if connection.is_idle())
+        stats["active"] = stats["connections"] - stats["idle"]
+    except Exception:
+        pass
+    return stats
+
+
+def render_diagnostics():
+    """接続プールとリトライ状況を表示する運用者向けの小さなビュー"""
+    client = get_client()
+    metrics = get_metrics()
+    with st.expander("🔧 OpenAI接続診断"):
+        if client is not None:
+            stats = pool_stats(client)
+            st.write(
+                f"接続: {stats['connections']} / {stats['max_connections']}"
+                f"（使用中 {stats['active']}・アイドル {stats['idle']}・HTTP/2 {'有効' if stats['http2'] else '無効'}）"
+            )
+        st.write(f"実行中リクエスト: {metrics['in_flight']}（ピーク {metrics['peak_in_flight']}）")
+        st.write(
+            f"呼び出し {metrics['calls']} / 成功 {metrics['successes']} / 失敗 {metrics['failures']} / "
+            f"リトライ {metrics['retries']} / 即時拒否 {metrics['rejected']}"
+        )
+        st.write(f"待機時間合計: {metrics['wait_seconds']:.1f}秒 / ブレーカー: {metrics['breaker_state']}")
+
+
+def get_metrics():
+    """呼び出し回数・リトライ回数・待機時間などのスナップショット"""
+    with _metrics_lock:
+        snapshot = dict(_metrics)
+    snapshot["breaker_state"] = breaker.state
+    return snapshot
+
+
+def is_available():
+    """サーキットブレーカーが開いていなければTrue（利用回数を消費する前の確認用）"""
+    return breaker.state != "open"
+
+
+def _retry_after(error):
+    """Retry-After ヘッダ（秒）があれば返す"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _backoff(attempt):
+    """フルジッター付き指数バックオフ"""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+def chat_completion(client, deadline_seconds=LLM_DEFAULT_DEADLINE, **kwargs):
+    """
+    client.chat.completions.create のラッパー。
+    一時的なエラー（429/5xx/タイムアウト/接続エラー）は Retry-After を尊重しつつ指数バックオフで再試行し、
+    全体で deadline_seconds を超えたら LLMUnavailableError を送出する。
+    stream=True の場合、再試行の対象はストリーム確立までとなる。
+    """
+    deadline = time.monotonic() + deadline_seconds
+    _count("calls")
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        # レート制限の待ちや期限切れで抜ける場合にhalf-openの試行枠を握ったままにしないよう、
+        # ブレーカーの確認は送信直前に行う（以降は必ず record_success / record_failure を通る）
+        rate_limiter.acquire(deadline)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not breaker.allow():
+            _count("rejected")
+            raise LLMUnavailableError("AIサービスが一時的に利用できません。しばらくしてから再度お試しください。")
+        try:
+            # リトライはこのレイヤーで管理するため、SDK側の自動リトライは無効にする
+            _enter_request()
+            try:
+                # 期限までの残り時間で打ち切りつつ、接続・読み取りそれぞれのタイムアウトは保つ
+                timeout = httpx.Timeout(min(OPENAI_READ_TIMEOUT, remaining), connect=min(OPENAI_CONNECT_TIMEOUT, remaining))
+                response = client.with_options(max_retries=0, timeout=timeout).chat.completions.create(**kwargs)
+            finally:
+                _exit_request()
+        except RETRYABLE_ERRORS as e:
+            breaker.record_failure()
+            wait = _retry_after(e)
+            if wait is None:
+                wait = _backoff(attempt)
+            if attempt >= LLM_MAX_RETRIES or time.monotonic() + wait >= deadline:
+                _count("failures")
+                raise LLMUnavailableError(f"AIサービスの応答が得られませんでした: {e}") from e
+            logging.info("Retrying OpenAI call in %.1fs after %s (attempt %d)", wait, type(e).__name__, attempt + 1)
+            _count("retries")
+            _record_wait(wait)
+            time.sleep(wait)
+            continue
+        except Exception:
+            # 4xx等の恒久的なエラーはサービス自体は応答しているので、ブレーカー上は成功扱いにしてそのまま呼び出し側へ
+            breaker.record_success()
+            _count("failures")
+            raise
+        breaker.record_success()
+        _count("successes")
+        return response
+
+    _count("failures")
+    raise LLMUnavailableError("AIサービスの応答が期限内に得られませんでした。")
@@ -1,8 +1,16 @@
 import streamlit as st
 import pandas as pd
 import auth_utils
+import banner_storage
+import phash_index
+import record_replica
+import record_schema
+import report_pdf
+import sheets_sync
+from diagnosis import CRITERIA
 from openai import OpenAI
 import os
+from datetime import datetime
 
 # ---------------------------
 # ページ設定 & ログインチェック
@@ -60,48 +68,110 @@ if user_plan not in ["Pro", "Team", "Enterprise"]:
     st.stop() # ★★★ Proプラン未満はここで処理を停止 ★★★
 
 
+# ---------------------------
+# data_editor の編集内容 → Firestore の差分
+# ---------------------------
+def to_firestore_value(column, value):
+    """data_editor の値をFirestoreに書き込める型に変換する"""
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    if column == "created_at":
+        return pd.to_datetime(value).to_pydatetime()
+    if hasattr(value, "item"): # numpyの数値型
+        return value.item()
+    return value
+
+
+def editor_changes(df, editor_state):
+    """data_editor の状態（edited_rows / added_rows / deleted_rows）から追加・更新・削除の差分を作る"""
+    deletes = [df.iloc[int(position)]["id"] for position in editor_state.get("deleted_rows", [])]
+    updates = {}
+    for position, changes in editor_state.get("edited_rows", {}).items():
+        doc_id = df.iloc[int(position)]["id"]
+        if doc_id not in deletes:
+            updates[doc_id] = {
+                column: to_firestore_value(column, value)
+                for column, value in changes.items() if column != "id" and column not in record_schema.DERIVED_FIELDS
+            }
+    inserts = []
+    for row in editor_state.get("added_rows", []):
+        record_data = {
+            column: to_firestore_value(column, value)
+            for column, value in row.items() if column not in ["id", "_index"] + record_schema.DERIVED_FIELDS
+        }
+        if any(value is not None for value in record_data.values()):
+            inserts.append(record_data)
+    return inserts, updates, deletes
+
+
 # ---------------------------
 # --- 以下、Proプラン以上のみが表示・実行 ---
 # ---------------------------
 try:
-    # Firestoreからデータを取得
-    records = auth_utils.get_diagnosis_records_from_firestore(st.session_state["user"])
+    uid = st.session_state["user"]
+    refresh_col, size_col = st.columns([1, 1])
+    with refresh_col:
+        if st.button("🔄 最新の状態に更新"):
+            record_replica.invalidate(uid)
+    with size_col:
+        page_size = st.selectbox(
+            "1ページの表示件数", auth_utils.RECORD_PAGE_SIZES,
+            index=auth_utils.RECORD_PAGE_SIZES.index(50), key="records_page_size"
+        )
+
+    # ローカルのレプリカから読み込む（Firestoreには前回同期以降の差分だけを問い合わせる）
+    # versions は読み込み時点の更新時刻（保存時に他のタブ・端末での変更を検出する）
+    all_df, versions = record_replica.load(uid)
 
-    if not records:
+    if all_df.empty:
         st.info("まだ実績記録がありません。バナー診断ページから採点を行うと自動で記録されます。")
         st.stop()
 
-    # データフレームに変換
-    df = pd.DataFrame(records)
-
-    # created_atがTimestamp型の場合、datetimeに変換
-    if 'created_at' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['created_at']):
-        df['created_at'] = df['created_at'].apply(lambda x: x.to_datetime() if hasattr(x, 'to_datetime') else pd.to_datetime(x))
-
+    page_count = (len(all_df) + page_size - 1) // page_size
+    page_index = min(st.session_state.get("records_page", 0), page_count - 1)
+    df = all_df.iloc[page_index * page_size:(page_index + 1) * page_size].reset_index(drop=True)
+    # 一覧には小さなサムネイルを表示する（URLは表示するページの分だけ保存先パスから作る。未生成の古い記録は元画像）
+    for kind in ["image", "thumbnail"]:
+        url_column, path_column = f"{kind}_url", f"{kind}_path"
+        if url_column not in df.columns:
+            df[url_column] = pd.Series(None, index=df.index, dtype=object)
+        if path_column in df.columns:
+            has_path = df[path_column].notna()
+            df.loc[has_path, url_column] = df.loc[has_path, path_column].map(banner_storage.url_for)
+    df["thumbnail_url"] = df["thumbnail_url"].fillna(df["image_url"])
+    records = df.astype(object).where(df.notna(), None).to_dict("records") # 詳細選択の表示用（欠損はNone）
 
     # 見やすいように列の順番を調整
     desired_order = [
-        "id", "banner_name", "pattern", "score", "comment", "predicted_ctr",
+        "id", "banner_name", "pattern", "score", "score_grade", "score_points", "predicted_ctr",
         "platform", "category", "industry", "age_group", "purpose", "genre",
-        "result", "follower_gain", "memo", "image_url", "created_at"
+        "result", "follower_gain", "memo", "thumbnail_url", "created_at"
     ]
     # dfに存在する列のみで再構成
     existing_cols = [col for col in desired_order if col in df.columns]
-    df_ordered = df[existing_cols]
+    # カテゴリ型の列は data_editor では既存の値だけの選択式になるので、編集用には自由入力の文字列列に戻す
+    df_ordered = df[existing_cols].astype({
+        field: object for field in record_schema.CATEGORICAL_FIELDS if field in existing_cols
+    })
 
 
     st.info("💡 各セルをダブルクリックすると内容を編集できます。編集後は下の「変更を保存する」ボタンを押してください。")
 
-    # データエディタで表示・編集
-    edited_df = st.data_editor(
+    # データエディタで表示・編集（保存のたびにキーを変えて編集状態をリセットする）
+    editor_key = f"diagnosis_editor_{page_index}_{st.session_state.get('diagnosis_editor_version', 0)}"
+    st.data_editor(
         df_ordered,
-        key="diagnosis_editor",
+        key=editor_key,
         num_rows="dynamic", # 行の追加・削除を許可
+        disabled=["id", "thumbnail_url"] + record_schema.DERIVED_FIELDS,
         use_container_width=True,
         column_config={
-            "image_url": st.column_config.ImageColumn(
-                "バナー画像", help="クリックで拡大表示"
+            "thumbnail_url": st.column_config.ImageColumn(
+                "バナー画像", help="クリックで拡大表示（元画像は下の詳細に表示）"
             ),
+            "score_grade": st.column_config.TextColumn("評価", help="A/B/C評価（並べ替えは評価の高低順）"),
+            "score_points": st.column_config.NumberColumn("点数", help="100点満点の点数"),
+            "predicted_ctr": st.column_config.NumberColumn("予想CTR", format="%.1f%%"),
             "created_at": st.column_config.DatetimeColumn(
                 "診断日時",
                 format="YYYY/MM/DD HH:mm",
@@ -114,14 +184,120 @@ try:
         height=600 # 高さを固定してスクロール可能に
     )
 
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    with prev_col:
+        if st.button("← 前のページ", disabled=page_index == 0):
+            st.session_state.records_page = page_index - 1
+            st.rerun()
+    with page_col:
+        st.caption(f"{page_index + 1} / {page_count}ページ（全{len(all_df)}件）")
+    with next_col:
+        if st.button("次のページ →", disabled=page_index >= page_count - 1):
+            st.session_state.records_page = page_index + 1
+            st.rerun()
+
     if st.button("変更を保存する", type="primary"):
-        with st.spinner("保存中..."):
-            # DataFrameの内容でFirestoreを更新
-            if auth_utils.save_diagnosis_records_to_firestore(st.session_state["user"], edited_df):
-                st.success("変更を保存しました！")
-                st.rerun() # 保存後に再読み込みして表示を更新
+        inserts, updates, deletes = editor_changes(df_ordered, st.session_state.get(editor_key, {}))
+        if not (inserts or updates or deletes):
+            st.info("変更はありません。")
+        else:
+            with st.spinner("保存中..."):
+                try:
+                    # 変更した行だけをまとめて書き込む
+                    auth_utils.save_diagnosis_record_changes(uid, inserts, updates, deletes, versions)
+                except auth_utils.RecordConflictError as e:
+                    record_replica.invalidate(uid)
+                    st.error(str(e))
+                    st.info("ページを再読み込みして最新の内容を確認してから、もう一度編集してください。")
+                    st.stop()
+            phash_index.invalidate(uid) # 類似バナー索引を次回再構築
+            record_replica.remove(uid, deletes)
+            record_replica.invalidate(uid)
+            st.session_state.pop("record_details", None)
+            st.session_state.diagnosis_editor_version = st.session_state.get("diagnosis_editor_version", 0) + 1
+            st.success("変更を保存しました！")
+            st.rerun() # 保存後に再読み込みして表示を更新
+
+    # --- 選択した記録の詳細（コメント・サブスコアは必要になった時点で1件だけ読み込む） ---
+    st.markdown("---")
+    st.subheader("🔍 記録の詳細")
+    labels = {
+        record["id"]: f"{record.get('banner_name') or '名称未設定'}（{record.get('pattern') or '-'} / スコア {record.get('score') or '-'}）"
+        for record in records
+    }
+    selected_id = st.selectbox(
+        "詳細を表示する記録", [None] + list(labels),
+        format_func=lambda doc_id: "選択してください" if doc_id is None else labels[doc_id],
+    )
+    if selected_id:
+        details = st.session_state.setdefault("record_details", {})
+        if selected_id not in details:
+            details[selected_id] = auth_utils.get_diagnosis_record(uid, selected_id)
+        record = details[selected_id]
+        if record is None:
+            st.warning("この記録は削除されています。")
+        else:
+            detail_col1, detail_col2 = st.columns([1, 2])
+            with detail_col1:
+                image_url = banner_storage.resolve_url(record, "image")
+                if image_url:
+                    st.image(image_url, use_container_width=True)
+            with detail_col2:
+                st.markdown(f"**スコア：** {record.get('score') or '-'}")
+                if record.get("predicted_ctr") is not None:
+                    st.markdown(f"**予想CTR：** {record['predicted_ctr']}")
+                for criterion, value in (record.get("sub_scores") or {}).items():
+                    st.markdown(f"- {CRITERIA.get(criterion, criterion)}: {value}点")
+                st.markdown("**改善コメント：**")
+                st.write(record.get("comment") or "-")
+
+    # --- PDFレポート（作成はバックグラウンドで行い、完成したらダウンロードできる） ---
+    st.markdown("---")
+    st.subheader("📄 PDFレポート")
+    st.caption(
+        f"実績記録（サムネイル・スコア・コメント・予想CTR・A/Bの比較）を新しい順に最大{report_pdf.REPORT_MAX_RECORDS}件までPDFにまとめます。"
+    )
+    report_job_id = st.session_state.get("report_job_id")
+    report_job = report_pdf.get_job(report_job_id, uid) if report_job_id else None
+
+    if report_job is None or report_job["status"] != "running":
+        if st.button("レポートを作成する"):
+            st.session_state.report_job_id = report_pdf.start_report(uid)
+            st.rerun()
+    if report_job is not None:
+        if report_job["status"] == "running":
+            st.info(f"レポートを作成中です…（{report_job['processed']}件処理済み）ページを操作して構いません。")
+            st.button("状態を更新")
+        elif report_job["status"] == "error":
+            st.error(f"レポートの作成に失敗しました: {report_job['error']}")
+        else:
+            report_bytes = report_pdf.read_report(report_job_id, uid)
+            if report_bytes:
+                st.download_button(
+                    "📥 レポートをダウンロード", data=report_bytes, mime="application/pdf",
+                    file_name=f"banasuko_report_{datetime.now().strftime('%Y%m%d')}.pdf",
+                )
+
+    # --- Googleスプレッドシート連携（Team / Enterprise） ---
+    if user_plan in ["Team", "Enterprise"]:
+        st.markdown("---")
+        st.subheader("📑 Googleスプレッドシート連携")
+        st.caption("実績記録をスプレッドシートに書き出します。2回目以降は前回から変わった行だけを更新します。"
+                   "スプレッドシートはサービスアカウントに編集権限で共有してください。")
+        sheet_input = st.text_input(
+            "スプレッドシートのURLまたはID", value=sheets_sync.get_spreadsheet_id(uid) or "", key="sheets_spreadsheet"
+        )
+        if st.button("スプレッドシートに同期"):
+            spreadsheet_id = sheets_sync.parse_spreadsheet_id(sheet_input)
+            if not spreadsheet_id:
+                st.warning("スプレッドシートのURLまたはIDを入力してください。")
             else:
-                st.error("保存に失敗しました。")
+                with st.spinner("スプレッドシートに同期中..."):
+                    try:
+                        written = sheets_sync.sync(uid, spreadsheet_id)
+                        st.success(f"同期しました（更新した行: {written}行）")
+                    except Exception as e:
+                        st.error(f"スプレッドシートへの同期に失敗しました: {e}")
 
 except Exception as e:
     st.error(f"データの読み込み中にエラーが発生しました: {e}")
@@ -1,6 +1,7 @@
 import streamlit as st
 import sys
 import os
+from urllib.parse import urlencode
 
 # --- ▼▼▼ このブロックを追加 ▼▼▼ ---
 # プロジェクトのルートディレクトリをPythonのパスに追加
@@ -158,6 +159,14 @@ if remaining_uses <= 0:
 # 商品ライブラリからプラン一覧を表示
 columns = st.columns(len(PRODUCT_LIBRARY) or [1]) # Handle empty library
 
+def purchase_link(product):
+    """Payment Linkにユーザーを識別する情報を付ける（Webhookで決済とアカウントを自動で結びつける）"""
+    params = {"client_reference_id": st.session_state.get("user") or ""}
+    if st.session_state.get("email"):
+        params["prefilled_email"] = st.session_state["email"]
+    return f"{product['link']}?{urlencode(params)}"
+
+
 col_index = 0
 for product in PRODUCT_LIBRARY:
     with columns[col_index]:
@@ -178,7 +187,7 @@ for product in PRODUCT_LIBRARY:
             st.markdown("<ul>" + "".join([f"<li>{feature}</li>" for feature in product["features"]]) + "</ul>", unsafe_allow_html=True)
 
         st.markdown(
-            f'<a href="{product["link"]}" target="_blank" class="purchase-button-link">このプランにアップグレード</a>',
+            f'<a href="{purchase_link(product)}" target="_blank" class="purchase-button-link">このプランにアップグレード</a>',
             unsafe_allow_html=True
         )
 
@@ -191,7 +200,7 @@ for product in PRODUCT_LIBRARY:
 st.markdown("---")
 st.info(
     """
-    **【決済後の反映について】** 決済完了後、運営にてお客様の購入情報を確認いたします。  
-    通常、**1〜2営業日以内**にアカウントへ利用回数が反映されますので、しばらくお待ちください。
+    **【決済後の反映について】** 決済が完了すると、通常**数分以内**に自動でアカウントへプランと利用回数が反映されます。  
+    反映されない場合は、お手数ですがお問い合わせページからご連絡ください。
     """
 )
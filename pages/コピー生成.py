@@ -1,7 +1,5 @@
 import streamlit as st
 import os
-from PIL import Image
-from openai import OpenAI
 from datetime import datetime
 import sys
 
@@ -12,6 +10,8 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 # --- ▲▲▲ このブロックを追加 ▲▲▲ ---
 
 import auth_utils  # Firebase 認証/残回数管理
+import llm_client  # OpenAI呼び出しの共通レイヤー
+import image_utils  # 画像デコード/サムネイルのキャッシュ
 
 # ---------------------------
 # ページ設定 & ログインチェック
@@ -19,12 +19,11 @@ import auth_utils  # Firebase 認証/残回数管理
 st.set_page_config(layout="wide", page_title="バナスコAI - コピー生成")
 auth_utils.check_login()
 
-# OpenAI 初期化
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
+# OpenAI 初期化（プロセス共有のクライアントを使う）
+client = llm_client.get_client()
+if client is None:
     st.error("❌ OpenAI APIキーが見つかりませんでした。`.env` を確認してください。")
     st.stop()
-client = OpenAI(api_key=openai_api_key)
 
 # Session Stateの初期化
 if 'select_all_copies' not in st.session_state:
@@ -429,8 +428,11 @@ elif user_plan == "Guest":
 # ---------------------------
 uploaded_image = st.file_uploader("参考にするバナー画像をアップロード（任意）", type=["jpg", "png"])
 if uploaded_image:
-    image = Image.open(uploaded_image)
-    st.image(image, caption="アップロードされた画像", width=300)
+    try:
+        image = image_utils.upload_thumbnail(uploaded_image, max_edge=600)
+        st.image(image, caption="アップロードされた画像", width=300)
+    except (image_utils.ImageTooLargeError, OSError) as e:
+        st.error(f"画像を読み込めません: {e}")
 
 # --- ▼▼▼ 変更点: 業種カテゴリに「不動産」を追加 ▼▼▼ ---
 category = st.selectbox(
@@ -617,10 +619,6 @@ def build_prompt():
 generate_btn = st.button("🚀 コピーを生成する")
 
 if generate_btn:
-    if remaining_uses <= 0:
-        st.warning(f"残り回数がありません。（現在プラン：{user_plan}）")
-        st.info("利用回数を増やすには、プランのアップグレードが必要です。")
-        st.stop()
     if copy_count == 0 and not enable_caption:
         st.warning("コピー生成数が0です。少なくとも1案以上を選択するか、投稿文作成を有効にしてください。")
         st.stop()
@@ -630,28 +628,53 @@ if generate_btn:
         st.warning("コピータイプが1つも選択されていない、かつ投稿文作成も無効です。少なくともどちらか一方を有効にしてください。")
         st.stop()
 
+    if not llm_client.is_available():
+        st.error("AIサービスが一時的に利用できません。利用回数は消費されていません。しばらくしてから再度お試しください。")
+        st.stop()
+
+    # 残回数の確認と差し引きはトランザクションで行い、生成に失敗したら返却する
+    quota_key = auth_utils.new_idempotency_key()
+    try:
+        reserved = auth_utils.reserve_uses(st.session_state["user"], 1, quota_key)
+    except auth_utils.QuotaExceededError:
+        st.warning(f"残り回数がありません。（現在プラン：{user_plan}）")
+        st.info("利用回数を増やすには、プランのアップグレードが必要です。")
+        st.stop()
+    if reserved is None:
+        st.stop()
+
+    generated = False
     with st.spinner("コピー案を生成中..."):
         try:
-            if auth_utils.update_user_uses_in_firestore(st.session_state["user"]):
-                st.session_state.remaining_uses -= 1
-
-                resp = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "あなたは日本語に精通した広告コピーライターです。マーケ基礎と法規を理解し、簡潔で効果的な表現を作ります。"},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.9,
-                )
-                output = resp.choices[0].message.content.strip()
-
-                st.subheader("✍️ 生成結果")
-                st.markdown(output)
-
-                if needs_yakkihou:
-                    st.subheader("🔍 薬機法メモ")
-                    st.info("※ このカテゴリでは『治る／即効／永久／医療行為の示唆』などはNG。効能・効果の断定表現も避けましょう。")
-            else:
-                st.error("利用回数の更新に失敗しました。")
+            stream = llm_client.chat_completion(
+                client,
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": "あなたは日本語に精通した広告コピーライターです。マーケ基礎と法規を理解し、簡潔で効果的な表現を作ります。"},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.9,
+                stream=True,
+            )
+
+            # 生成された分から順に表示する（全文を待たない）
+            st.subheader("✍️ 生成結果")
+            output = st.write_stream(
+                chunk.choices[0].delta.content or ""
+                for chunk in stream if chunk.choices
+            )
+            generated = True
+
+            if needs_yakkihou:
+                st.subheader("🔍 薬機法メモ")
+                st.info("※ このカテゴリでは『治る／即効／永久／医療行為の示唆』などはNG。効能・効果の断定表現も避けましょう。")
+        except llm_client.LLMUnavailableError as e:
+            st.error(f"❌ {e}（利用回数は消費されていません）")
         except Exception as e:
             st.error(f"コピー生成中にエラーが発生しました：{e}")
+        finally:
+            # st.stop() / rerun（BaseException）で中断された場合も予約を残さない
+            if generated:
+                auth_utils.commit_uses(st.session_state["user"], quota_key)
+            else:
+                auth_utils.release_uses(st.session_state["user"], quota_key)
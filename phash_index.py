@@ -0,0 +1,134 @@
+# phash_index.py
+# ユーザーごとの知覚ハッシュ索引（BK木）で、過去の類似バナー診断を高速に探す
+import logging
+import os
+import threading
+
+import auth_utils
+from image_utils import hamming_distance
+
+# この距離以下なら同一バナーの再書き出し・軽微な加工とみなす
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+# 近似重複が見つかった場合にモデル呼び出しを省略して前回の結果を流用するか
+REUSE_NEAR_DUPLICATE_RESULT = os.getenv("PHASH_REUSE_NEAR_DUPLICATE_RESULT", "false").lower() == "true"
+
+# 結果を流用してよいのは、採点条件（プロンプトとスコア形式を決める項目）が同じ記録だけ
+REUSE_MATCH_FIELDS = ["age_group", "purpose", "score_format", "add_ctr"]
+# 索引に載せる項目（表示と結果流用に必要な分だけ）
+INDEXED_FIELDS = [
+    "phash", "banner_name", "pattern", "score", "comment", "predicted_ctr", "sub_scores", "created_at",
+] + REUSE_MATCH_FIELDS
+
+
+class BKTree:
+    """ハミング距離によるBK木。件数Nに対し、閾値が小さければ探索はほぼ O(log N)"""
+
+    def __init__(self):
+        self._root = None  # (hash, [records], {distance: child})
+        self.size = 0
+
+    def add(self, phash, record):
+        self.size += 1
+        if self._root is None:
+            self._root = (phash, [record], {})
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(phash, node[0])
+            if distance == 0:
+                node[1].append(record)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (phash, [record], {})
+                return
+            node = child
+
+    def search(self, phash, max_distance):
+        """距離 max_distance 以内のレコードを (距離, record) のリストで近い順に返す"""
+        if self._root is None:
+            return []
+        matches = []
+        stack = [self._root]
+        while stack:
+            node_hash, records, children = stack.pop()
+            distance = hamming_distance(phash, node_hash)
+            if distance <= max_distance:
+                matches.extend((distance, record) for record in records)
+            # 三角不等式により [d - r, d + r] の枝だけ辿ればよい
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _load_index(uid):
+    tree = BKTree()
+    docs = (
+        auth_utils.db.collection('users').document(uid).collection('diagnoses')
+        .select(INDEXED_FIELDS).stream()
+    )
+    for doc in docs:
+        record = doc.to_dict()
+        if record.get("phash"):
+            record["id"] = doc.id
+            tree.add(record["phash"], record)
+    return tree
+
+
+def get_index(uid):
+    """ユーザーの索引を返す（プロセス内で初回のみFirestoreから構築）"""
+    with _lock:
+        tree = _indexes.get(uid)
+    if tree is None:
+        tree = _load_index(uid)
+        with _lock:
+            tree = _indexes.setdefault(uid, tree)
+    return tree
+
+
+def find_similar(uid, phash, max_distance=PHASH_MAX_DISTANCE):
+    """過去の診断から類似バナーを探す。失敗時は空リスト"""
+    try:
+        tree = get_index(uid)
+        with _lock:
+            return tree.search(phash, max_distance)
+    except Exception as e:
+        logging.warning("Perceptual hash lookup failed: %s", e)
+        return []
+
+
+def find_reusable(uid, phash, params, max_distance=PHASH_MAX_DISTANCE):
+    """
+    採点条件 params（REUSE_MATCH_FIELDS のdict）が一致する類似記録のうち、最も近いものを返す。
+    条件が記録されていない古い記録や、CTRが数値でない記録は流用しない。見つからなければNone
+    """
+    for _, record in find_similar(uid, phash, max_distance):
+        if any(record.get(field) != params.get(field) for field in REUSE_MATCH_FIELDS):
+            continue
+        ctr = record.get("predicted_ctr")
+        if params.get("add_ctr") and (isinstance(ctr, bool) or not isinstance(ctr, (int, float))):
+            continue
+        return record
+    return None
+
+
+def add(uid, record):
+    """新しく保存した診断を索引に追加する（索引未構築なら次回ロード時に読み込まれる）"""
+    if not record.get("phash"):
+        return
+    with _lock:
+        tree = _indexes.get(uid)
+        if tree is not None:
+            tree.add(record["phash"], {field: record.get(field) for field in INDEXED_FIELDS})
+
+
+def invalidate(uid):
+    """実績記録の編集などで索引が古くなった場合に破棄する"""
+    with _lock:
+        _indexes.pop(uid, None)
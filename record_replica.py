@@ -0,0 +1,193 @@
+# record_replica.py
+# ユーザーごとの実績記録をローカルのSQLiteに複製し、updated_at の透かし（watermark）で差分だけ同期する
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+
+import auth_utils
+import record_schema
+
+# --- 設定（環境変数で上書き可能） ---
+RECORDS_REPLICA_DIR = os.getenv("RECORDS_REPLICA_DIR") or os.path.join(tempfile.gettempdir(), "banasuko_records")
+# この間隔を過ぎるまでは、無効化されていない限りFirestoreに問い合わせない
+REPLICA_SYNC_INTERVAL_SECONDS = float(os.getenv("RECORDS_REPLICA_SYNC_INTERVAL_SECONDS", "300"))
+# 他のプロセスでの削除は差分クエリでは検出できないため、この間隔で全件を取り直す
+REPLICA_FULL_RESYNC_SECONDS = float(os.getenv("RECORDS_REPLICA_FULL_RESYNC_SECONDS", str(24 * 3600)))
+SYNC_PAGE_SIZE = 500
+# サーバー時刻とのずれを吸収するため、透かしの少し前から取り直す（重複はupsertで吸収される）
+WATERMARK_MARGIN = timedelta(seconds=60)
+
+_dirty = set()
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(uid):
+    with _locks_guard:
+        return _locks.setdefault(uid, threading.Lock())
+
+
+def _path(uid):
+    os.makedirs(RECORDS_REPLICA_DIR, exist_ok=True)
+    return os.path.join(RECORDS_REPLICA_DIR, f"{hashlib.sha256(uid.encode('utf-8')).hexdigest()[:32]}.sqlite3")
+
+
+def _connect(uid):
+    conn = sqlite3.connect(_path(uid))
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS records ("
+        "id TEXT PRIMARY KEY, created_at TEXT, update_time TEXT, data TEXT NOT NULL)"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def _get_meta(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _upsert(conn, records):
+    rows = []
+    for record in records:
+        record = dict(record)
+        doc_id = record.pop("id")
+        update_time = record.pop("update_time", None)
+        created_at = record.get("created_at")
+        rows.append((
+            doc_id,
+            created_at.isoformat() if isinstance(created_at, datetime) else None,
+            update_time.rfc3339() if isinstance(update_time, DatetimeWithNanoseconds) else None,
+            json.dumps(record, ensure_ascii=False, default=_to_json_value),
+        ))
+    conn.executemany("INSERT OR REPLACE INTO records (id, created_at, update_time, data) VALUES (?, ?, ?, ?)", rows)
+
+
+def _max_updated_at(records, current):
+    for record in records:
+        updated_at = record.get("updated_at")
+        if isinstance(updated_at, datetime) and (current is None or updated_at > current):
+            current = updated_at
+    return current
+
+
+def _full_sync(uid, conn):
+    """全件を一覧用の項目だけページ単位で読み直す"""
+    started_at = datetime.now(timezone.utc)
+    conn.execute("DELETE FROM records")
+    watermark = None
+    cursor = None
+    while True:
+        records, cursor = auth_utils.get_diagnosis_records_page(uid, SYNC_PAGE_SIZE, cursor)
+        _upsert(conn, records)
+        watermark = _max_updated_at(records, watermark)
+        if cursor is None:
+            break
+    # updated_at を持たない古い記録しかない場合は、同期開始時刻を透かしにする
+    return watermark or started_at - WATERMARK_MARGIN
+
+
+def _delta_sync(uid, conn, watermark):
+    """透かし以降に追加・更新された記録だけを取り込む"""
+    cursor = None
+    since = watermark - WATERMARK_MARGIN
+    while True:
+        records, cursor = auth_utils.get_diagnosis_records_updated_since(uid, since, SYNC_PAGE_SIZE, cursor)
+        _upsert(conn, records)
+        watermark = _max_updated_at(records, watermark)
+        if cursor is None:
+            return watermark
+
+
+def sync(uid, force=False):
+    """
+    レプリカをFirestoreと同期する。無効化されているか同期間隔を過ぎていれば差分を、
+    初回・全件再同期の間隔を過ぎていれば全件を取得する。
+    """
+    with _lock_for(uid):
+        conn = _connect(uid)
+        try:
+            now = time.time()
+            watermark = _get_meta(conn, "watermark")
+            last_sync = float(_get_meta(conn, "last_sync") or 0)
+            last_full_sync = float(_get_meta(conn, "last_full_sync") or 0)
+            if not force and uid not in _dirty and now - last_sync < REPLICA_SYNC_INTERVAL_SECONDS:
+                return
+
+            with conn:
+                if watermark is None or now - last_full_sync >= REPLICA_FULL_RESYNC_SECONDS:
+                    new_watermark = _full_sync(uid, conn)
+                    _set_meta(conn, "last_full_sync", str(now))
+                else:
+                    new_watermark = _delta_sync(uid, conn, datetime.fromisoformat(watermark))
+                _set_meta(conn, "watermark", new_watermark.isoformat())
+                _set_meta(conn, "last_sync", str(now))
+            _dirty.discard(uid)
+        finally:
+            conn.close()
+
+
+def invalidate(uid):
+    """記録の追加・更新後に呼ぶ。次回の読み込み時に差分同期が走る"""
+    _dirty.add(uid)
+
+
+def remove(uid, doc_ids):
+    """このプロセスで削除した記録をレプリカからも取り除く"""
+    if not doc_ids:
+        return
+    with _lock_for(uid):
+        conn = _connect(uid)
+        try:
+            with conn:
+                conn.executemany("DELETE FROM records WHERE id = ?", [(doc_id,) for doc_id in doc_ids])
+        finally:
+            conn.close()
+
+
+def load(uid):
+    """
+    同期したうえでレプリカから実績記録を新しい順に読み込み、(型付きDataFrame, {id: update_time}) を返す。
+    update_time は保存時の楽観的排他制御に使う。
+    """
+    try:
+        sync(uid)
+    except Exception as e:
+        # 同期に失敗しても、手元のレプリカがあればそれを表示する
+        logging.warning("Records replica sync failed for %s: %s", uid, e)
+
+    with _lock_for(uid):
+        conn = _connect(uid)
+        try:
+            rows = conn.execute(
+                "SELECT id, update_time, data FROM records ORDER BY created_at IS NULL, created_at DESC"
+            ).fetchall()
+        finally:
+            conn.close()
+
+    records = []
+    versions = {}
+    for doc_id, update_time, data in rows:
+        record = json.loads(data)
+        record["id"] = doc_id
+        records.append(record)
+        versions[doc_id] = DatetimeWithNanoseconds.from_rfc3339(update_time) if update_time else None
+    return record_schema.records_frame(records), versions
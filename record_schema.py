@@ -0,0 +1,58 @@
+# record_schema.py
+# 実績記録のDataFrameの列型（スキーマ）を定義し、生のdictから型付きの列に一括変換する
+import pandas as pd
+
+# 日時列（Firestoreのタイムスタンプ・ISO文字列のどちらでも可）
+DATETIME_FIELDS = ["created_at", "updated_at"]
+# 値の種類が少ない列はカテゴリ型にしてメモリを抑える
+CATEGORICAL_FIELDS = ["pattern", "platform", "category", "industry", "age_group", "purpose", "genre"]
+# 数値列（旧形式の '3.2%' のような文字列も数値にする）
+NUMERIC_FIELDS = ["predicted_ctr"]
+
+# A/B/C評価の順序（低い順）。score_grade はこの順序つきカテゴリになる
+GRADE_ORDER = ["C-", "C", "C+", "B-", "B", "B+", "A-", "A", "A+"]
+
+# score から派生させる列（表示・並べ替え用で、Firestoreには保存しない）
+DERIVED_FIELDS = ["score_grade", "score_points"]
+
+
+def _to_numeric(series):
+    """数値・数値文字列・'%' 付き文字列の混在した列を浮動小数点の列にする（解釈できない値は欠損）"""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("Float64")
+    text = series.astype("string").str.strip().str.rstrip("%").str.replace(",", "", regex=False)
+    return pd.to_numeric(text, errors="coerce").astype("Float64")
+
+
+def apply_schema(df):
+    """
+    実績記録のDataFrameを型付きの列に変換する（行ごとのapplyを使わずに列単位で処理する）。
+    - 日時列は UTC の datetime64 に
+    - predicted_ctr などは Float64 に
+    - score は文字列のまま残し、A/B/C評価を順序つきカテゴリの score_grade、100点満点を Int64 の score_points に分ける
+    - 選択式の項目はカテゴリ型に
+    """
+    df = df.copy()
+    for field in DATETIME_FIELDS:
+        if field in df.columns:
+            df[field] = pd.to_datetime(df[field], utc=True, errors="coerce")
+
+    for field in NUMERIC_FIELDS:
+        if field in df.columns:
+            df[field] = _to_numeric(df[field])
+
+    if "score" in df.columns:
+        score = df["score"].astype("string").str.strip()
+        df["score"] = score
+        df["score_grade"] = pd.Categorical(score.where(score.isin(GRADE_ORDER)), categories=GRADE_ORDER, ordered=True)
+        df["score_points"] = pd.to_numeric(score.where(score.str.fullmatch(r"\d+", na=False)), errors="coerce").astype("Int64")
+
+    for field in CATEGORICAL_FIELDS:
+        if field in df.columns:
+            df[field] = df[field].astype("category")
+    return df
+
+
+def records_frame(records):
+    """記録dictのリストから型付きのDataFrameを作る"""
+    return apply_schema(pd.DataFrame(records))
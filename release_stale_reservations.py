@@ -0,0 +1,22 @@
+# release_stale_reservations.py
+# 確定も返却もされないまま期限（expires_at）を過ぎた利用回数の予約を返却するバッチ
+#
+#   python release_stale_reservations.py
+#
+# 処理中にプロセスが落ちる・再起動される等で残った予約の回数を、ユーザーの残回数に戻す。
+# スケジューラ（cron / Cloud Scheduler 等）から数分〜1時間おきに実行する想定。
+# 返却は予約ごとのトランザクションで行い、返却済みの予約は飛ばすので、何度実行しても二重に返却されない。
+# quota_reservations に status・expires_at の複合インデックス（コレクショングループ）が必要。
+import logging
+
+import firestore_client
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    released = firestore_client.release_expired_reservations()
+    logging.info("Released %d expired quota reservations", released)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+# report_pdf.py
+# 実績記録のPDFレポート作成（fpdf2）。バックグラウンドで作成し、完了後にダウンロードさせる
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos
+from PIL import Image, ImageOps
+
+import auth_utils
+import banner_storage
+import image_utils
+from diagnosis import CRITERIA, format_ctr
+from record_schema import GRADE_ORDER
+
+# --- 設定（環境変数で上書き可能） ---
+# 日本語を描画するためのTrueTypeフォント（未設定なら一般的な配置場所を探す）
+REPORT_FONT_PATH = os.getenv("REPORT_FONT_PATH")
+# Streamlit Cloudでは packages.txt の fonts-ipaexfont-gothic で先頭のフォントが入る
+REPORT_FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSansJP-Regular.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "C:/Windows/Fonts/meiryo.ttc",
+]
+REPORT_MAX_WORKERS = int(os.getenv("REPORT_MAX_WORKERS", "2"))
+REPORT_FETCH_PAGE_SIZE = 200
+# fpdf2は output() まで文書全体と埋め込み画像をメモリに保持するため、1レポートの件数に上限を設ける
+REPORT_MAX_RECORDS = int(os.getenv("REPORT_MAX_RECORDS", "500"))
+REPORT_TTL_SECONDS = int(os.getenv("REPORT_TTL_SECONDS", "3600"))
+# 埋め込み画像（縮小済みJPEG）のキャッシュ。レポートをまたいで再利用する
+REPORT_IMAGE_CACHE_MAX_BYTES = int(os.getenv("REPORT_IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+REPORT_IMAGE_MAX_EDGE = 360
+REPORT_IMAGE_WIDTH_MM = 40
+DOWNLOAD_TIMEOUT_SECONDS = 15
+
+# レポートに載せる項目（画像はサムネイルを優先して使う）
+REPORT_FIELDS = [
+    "banner_name", "pattern", "score", "comment", "predicted_ctr", "sub_scores",
+    "platform", "industry", "purpose", "image_url", "image_path", "thumbnail_url", "thumbnail_path", "created_at",
+]
+
+
+class ReportError(Exception):
+    """レポートを作成できない（フォント未設定など）"""
+
+
+_executor = ThreadPoolExecutor(max_workers=REPORT_MAX_WORKERS, thread_name_prefix="report-pdf")
+_jobs = {}  # job_id -> {"uid", "status", "processed", "path", "error", "finished_at"}
+_jobs_lock = threading.Lock()
+
+
+class _EmbedCache:
+    """縮小済みのJPEGバイト列をバイト数上限つきLRUで保持する"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+
+_embed_cache = _EmbedCache(REPORT_IMAGE_CACHE_MAX_BYTES)
+
+
+def _font_path():
+    for path in [REPORT_FONT_PATH] + REPORT_FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            return path
+    raise ReportError("日本語フォントが見つかりません。REPORT_FONT_PATH にTrueTypeフォントを指定してください。")
+
+
+def _embed_image(record):
+    """記録の画像をレポート用に縮小したJPEGバイト列を返す（取得できなければNone）"""
+    # 内容アドレスのパスがあればそれをキーにする（同じ画像は署名URLが変わっても同じキー）
+    key = record.get("thumbnail_path") or record.get("image_path") or record.get("thumbnail_url") or record.get("image_url")
+    if not key:
+        return None
+    data = _embed_cache.get(key)
+    if data is not None:
+        return data
+    url = banner_storage.resolve_url(record, "thumbnail") or banner_storage.resolve_url(record, "image")
+    try:
+        response = requests.get(url, timeout=DOWNLOAD_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        # 画面表示用の共有キャッシュ（image_utils.thumbnail）は通さず、その場で縮小デコードして捨てる
+        image, _ = image_utils.decode_image(response.content, pixel_budget=(REPORT_IMAGE_MAX_EDGE * 2) ** 2)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((REPORT_IMAGE_MAX_EDGE, REPORT_IMAGE_MAX_EDGE), Image.LANCZOS)
+        output = io.BytesIO()
+        image_utils.flatten_to_rgb(image).save(output, format="JPEG", quality=80, optimize=True)
+        data = output.getvalue()
+    except Exception as e:
+        logging.warning("Report image fetch failed for %s: %s", key, e)
+        return None
+    _embed_cache.put(key, data)
+    return data
+
+
+def _score_rank(score):
+    """A/B/C評価・100点満点のどちらでも比較できる値にする（比較できなければNone）"""
+    score = str(score or "").strip()
+    if score in GRADE_ORDER:
+        return GRADE_ORDER.index(score) / (len(GRADE_ORDER) - 1) * 100
+    if score.isdigit():
+        return int(score)
+    return None
+
+
+def _iter_records(uid):
+    """実績記録を新しい順にページ単位で読み込みながら1件ずつ返す（全件をメモリに載せない）"""
+    cursor = None
+    while True:
+        records, cursor = auth_utils.get_diagnosis_records_page(uid, REPORT_FETCH_PAGE_SIZE, cursor, fields=REPORT_FIELDS)
+        yield from records
+        if cursor is None:
+            return
+
+
+def _iter_groups(records):
+    """同じバナー名で続けて記録されたA/Bパターンを1組にまとめて返す"""
+    pending = None
+    for record in records:
+        if (
+            pending is not None and record.get("banner_name") and record.get("banner_name") == pending.get("banner_name")
+            and {record.get("pattern"), pending.get("pattern")} == {"A", "B"}
+        ):
+            yield sorted([pending, record], key=lambda item: item.get("pattern"))
+            pending = None
+            continue
+        if pending is not None:
+            yield [pending]
+        pending = record
+    if pending is not None:
+        yield [pending]
+
+
+class _ReportPDF(FPDF):
+    def __init__(self, font_path, title):
+        super().__init__(orientation="P", unit="mm", format="A4")
+        self.report_title = title
+        self.add_font("jp", "", font_path)
+        self.set_auto_page_break(auto=True, margin=15)
+
+    def header(self):
+        self.set_font("jp", size=9)
+        self.set_text_color(120, 120, 120)
+        self.cell(0, 6, self.report_title, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        self.set_text_color(0, 0, 0)
+        self.ln(2)
+
+    def footer(self):
+        self.set_y(-12)
+        self.set_font("jp", size=8)
+        self.cell(0, 6, f"{self.page_no()}", align="C")
+
+
+def _render_record(pdf, record):
+    image = _embed_image(record)
+    image_height = 0
+    if image:
+        with Image.open(io.BytesIO(image)) as embedded:
+            image_height = REPORT_IMAGE_WIDTH_MM * embedded.height / embedded.width
+    # 画像と見出しがページをまたがないよう、足りなければ改ページする
+    if pdf.get_y() + max(30, image_height + 5) > pdf.h - pdf.b_margin:
+        pdf.add_page()
+    top = pdf.get_y()
+    text_x = pdf.l_margin
+    if image:
+        pdf.image(io.BytesIO(image), x=pdf.l_margin, y=top, w=REPORT_IMAGE_WIDTH_MM)
+        text_x += REPORT_IMAGE_WIDTH_MM + 5
+    text_width = pdf.w - pdf.r_margin - text_x
+
+    created_at = record.get("created_at")
+    date_text = created_at.strftime("%Y/%m/%d %H:%M") if isinstance(created_at, datetime) else ""
+    pdf.set_xy(text_x, top)
+    pdf.set_font("jp", size=11)
+    title = f"{record.get('banner_name') or '名称未設定'}（{record.get('pattern') or '-'}）"
+    pdf.multi_cell(text_width, 6, title, new_x=XPos.LEFT, new_y=YPos.NEXT)
+    pdf.set_font("jp", size=9)
+    details = [
+        f"スコア: {record.get('score') or '-'}",
+        f"予想CTR: {format_ctr(record.get('predicted_ctr')) or '-'}",
+        date_text,
+    ]
+    pdf.multi_cell(text_width, 5, " / ".join(item for item in details if item), new_x=XPos.LEFT, new_y=YPos.NEXT)
+    sub_scores = record.get("sub_scores") or {}
+    if sub_scores:
+        line = "、".join(f"{CRITERIA.get(key, key)} {value}" for key, value in sub_scores.items())
+        pdf.multi_cell(text_width, 5, line, new_x=XPos.LEFT, new_y=YPos.NEXT)
+    if record.get("comment"):
+        pdf.multi_cell(text_width, 5, str(record["comment"]), new_x=XPos.LEFT, new_y=YPos.NEXT)
+
+    # コメントが長く改ページした場合は、本文の終わりから続ける
+    bottom = pdf.get_y() if pdf.get_y() < top else max(pdf.get_y(), top + image_height)
+    pdf.set_xy(pdf.l_margin, bottom + 4)
+
+
+def _build(job_id, uid, title):
+    font_path = _font_path()
+    pdf = _ReportPDF(font_path, title)
+    pdf.set_title(title)
+    pdf.add_page()
+    pdf.set_font("jp", size=16)
+    pdf.cell(0, 10, title, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font("jp", size=9)
+    pdf.cell(0, 6, f"作成日時: {datetime.now().strftime('%Y/%m/%d %H:%M')}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.ln(4)
+
+    processed = 0
+    truncated = False
+    for group in _iter_groups(_iter_records(uid)):
+        if processed + len(group) > REPORT_MAX_RECORDS:
+            truncated = True
+            break
+        if len(group) == 2:
+            ranks = [_score_rank(record.get("score")) for record in group]
+            pdf.set_font("jp", size=10)
+            summary = "A/Bテスト"
+            if None not in ranks and ranks[0] != ranks[1]:
+                summary += f"（{'A' if ranks[0] > ranks[1] else 'B'}パターンが高評価）"
+            pdf.cell(0, 6, summary, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            for record in group:
+                _render_record(pdf, record)
+        else:
+            _render_record(pdf, group[0])
+        processed += len(group)
+        with _jobs_lock:
+            _jobs[job_id]["processed"] = processed
+
+    if processed == 0:
+        pdf.cell(0, 8, "実績記録がありません。", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    elif truncated:
+        pdf.set_font("jp", size=9)
+        pdf.cell(0, 8, f"※ 新しい順に{processed}件までを掲載しています。", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    fd, path = tempfile.mkstemp(prefix="banasuko_report_", suffix=".pdf")
+    os.close(fd)
+    pdf.output(path)
+    return path
+
+
+def _run(job_id, uid, title):
+    try:
+        path = _build(job_id, uid, title)
+        update = {"status": "done", "path": path}
+    except Exception as e:
+        logging.exception("Report generation failed for %s", uid)
+        update = {"status": "error", "error": str(e)}
+    with _jobs_lock:
+        _jobs[job_id].update(update, finished_at=time.time())
+
+
+def _sweep():
+    """期限切れのレポートファイルとジョブを削除する"""
+    now = time.time()
+    with _jobs_lock:
+        expired = [
+            job_id for job_id, job in _jobs.items()
+            if job.get("finished_at") and now - job["finished_at"] > REPORT_TTL_SECONDS
+        ]
+        for job_id in expired:
+            job = _jobs.pop(job_id)
+            if job.get("path"):
+                try:
+                    os.remove(job["path"])
+                except OSError:
+                    pass
+
+
+def start_report(uid, title="バナー診断レポート"):
+    """レポート作成をバックグラウンドで開始し、ジョブIDを返す（同じユーザーの作成中ジョブがあればそれを返す）"""
+    _sweep()
+    with _jobs_lock:
+        for job_id, job in _jobs.items():
+            if job["uid"] == uid and job["status"] == "running":
+                return job_id
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {"uid": uid, "status": "running", "processed": 0, "path": None, "error": None, "finished_at": None}
+    _executor.submit(_run, job_id, uid, title)
+    return job_id
+
+
+def get_job(job_id, uid):
+    """ジョブの状態を返す（他のユーザーのジョブや期限切れならNone）"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or job["uid"] != uid:
+            return None
+        return dict(job)
+
+
+def read_report(job_id, uid):
+    """完成したレポートのPDFバイト列を返す（未完成・期限切れならNone）"""
+    job = get_job(job_id, uid)
+    if job is None or job["status"] != "done":
+        return None
+    try:
+        with open(job["path"], "rb") as f:
+            return f.read()
+    except OSError:
+        return None
@@ -0,0 +1,188 @@
+# reset_monthly_quota.py
+# 月初に全ユーザーの残回数をプランの月間利用回数に戻すバッチ（ログイン時の遅延リセットの置き換え）
+#
+#   python reset_monthly_quota.py [--period YYYY-MM] [--page-size N] [--dry-run] [--restart]
+#
+# 毎月1日（UTC）にスケジューラ（cron / Cloud Scheduler 等）から実行する想定。
+# usersをドキュメントID順にページ単位で読み、BulkWriterでまとめて書き込む。ページごとに進捗を
+# maintenance/monthly_reset に記録するので、途中で止まっても再実行すれば続きから処理する。
+# last_reset が対象月のユーザーは飛ばすため、同じ月に何度実行しても二重にリセットされない。
+# リセット時点で確定していない予約（採点中の分）は、後から確定しても返却分を新しい月の残回数に足さない
+# （firestore_client.settle_quota_reservation が予約日時と last_reset を比べる）ので、上限を超えることはない。
+import argparse
+import logging
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+from google.rpc import code_pb2
+
+import firestore_client
+
+PAGE_SIZE = 500
+CHECKPOINT_COLLECTION = "maintenance"
+CHECKPOINT_DOC = "monthly_reset"
+# 一時的なエラーはBulkWriter内でこの回数まで再試行する
+BULK_MAX_ATTEMPTS = 5
+RETRYABLE_CODES = {
+    code_pb2.ABORTED, code_pb2.UNAVAILABLE, code_pb2.RESOURCE_EXHAUSTED, code_pb2.DEADLINE_EXCEEDED, code_pb2.INTERNAL,
+}
+
+
+class PageWriteError(Exception):
+    """ページ内に書き込めなかったユーザーが残った（進捗は進めない）"""
+
+
+def _period(value):
+    """"YYYY-MM" を (年, 月) にする"""
+    year, month = value.split("-")
+    return int(year), int(month)
+
+
+def needs_reset(last_reset, period):
+    """last_reset（ISO形式の文字列）が対象月より前ならTrue。未設定もリセット対象"""
+    if not last_reset:
+        return True
+    last = datetime.fromisoformat(last_reset.replace('Z', '+00:00'))
+    return (last.year, last.month) < period
+
+
+def _reset_data(plan, now):
+    return {
+        "remaining_uses": firestore_client.PLAN_MONTHLY_USES.get(plan, 0),
+        "last_reset": now.isoformat(),
+    }
+
+
+def _reset_in_transaction(db, user_ref, period, now):
+    """BulkWriterで競合した（読んだ後に利用回数が動いた）ユーザーを読み直してリセットする"""
+
+    @firestore.transactional
+    def _reset(transaction):
+        snapshot = user_ref.get(transaction=transaction)
+        data = snapshot.to_dict() or {}
+        if not snapshot.exists or not needs_reset(data.get("last_reset"), period):
+            return False
+        transaction.update(user_ref, _reset_data(data.get("plan", "Free"), now))
+        return True
+
+    return _reset(db.transaction())
+
+
+def _on_write_result(written):
+    def _callback(document_reference, write_result, _writer):
+        written.append(document_reference)
+    return _callback
+
+
+def _on_write_error(conflicts, failed):
+    def _callback(error, _writer):
+        if error.code == code_pb2.FAILED_PRECONDITION:
+            # リトライしても同じ前提条件で失敗するだけなので、参照を控えて後でトランザクションで処理する
+            conflicts.append(error.operation.reference)
+            return False
+        if error.code in RETRYABLE_CODES and error.attempts < BULK_MAX_ATTEMPTS:
+            return True
+        failed.append(error.operation.reference)
+        return False
+    return _callback
+
+
+def _write_page(db, targets, period, now, checkpoint):
+    """
+    1ページ分のリセットをBulkWriterで書き込み、リセットした件数を返す。
+    書き込めなかったユーザーが残った場合は PageWriteError を送出し、進捗を進めない（再実行でこのページからやり直す）。
+    """
+    written, conflicts, failed = [], [], []
+    writer = db.bulk_writer()
+    writer.on_write_result(_on_write_result(written))
+    writer.on_write_error(_on_write_error(conflicts, failed))
+    for doc, plan in targets:
+        # 読んだ時点から変わっていない場合だけ書く（その間の利用を上書きしない）
+        writer.update(doc.reference, _reset_data(plan, now), option=db.write_option(last_update_time=doc.update_time))
+    writer.close()
+
+    reset = len(written)
+    for user_ref in conflicts:
+        if _reset_in_transaction(db, user_ref, period, now):
+            reset += 1
+        else:
+            checkpoint["skipped"] += 1
+    if failed:
+        raise PageWriteError(f"{len(failed)} users could not be reset (first: {failed[0].id})")
+    return reset
+
+
+def _load_checkpoint(ref, period_label, restart):
+    doc = ref.get()
+    checkpoint = doc.to_dict() if doc.exists else {}
+    if restart or checkpoint.get("period") != period_label:
+        return {"period": period_label, "last_uid": None, "completed": False, "reset": 0, "skipped": 0}
+    return checkpoint
+
+
+def run(period_label=None, page_size=PAGE_SIZE, dry_run=False, restart=False):
+    """全ユーザーをリセットし、(リセット件数, 対象外件数) を返す。dry_run では書き込み・進捗の記録をしない"""
+    db = firestore_client.get_firestore_db()
+    now = datetime.now(timezone.utc)
+    period_label = period_label or now.strftime("%Y-%m")
+    period = _period(period_label)
+    checkpoint_ref = db.collection(CHECKPOINT_COLLECTION).document(CHECKPOINT_DOC)
+    checkpoint = _load_checkpoint(checkpoint_ref, period_label, restart or dry_run)
+    if checkpoint.get("completed"):
+        logging.info("Monthly reset for %s is already completed", period_label)
+        return checkpoint["reset"], checkpoint["skipped"]
+    if checkpoint["last_uid"]:
+        logging.info("Resuming monthly reset for %s after %s", period_label, checkpoint["last_uid"])
+
+    users = db.collection('users')
+    while True:
+        query = users.order_by("__name__").select(["plan", "last_reset"]).limit(page_size)
+        if checkpoint["last_uid"]:
+            query = query.start_after({"__name__": checkpoint["last_uid"]})
+        docs = list(query.stream())
+        if not docs:
+            break
+
+        targets = []
+        for doc in docs:
+            data = doc.to_dict() or {}
+            if needs_reset(data.get("last_reset"), period):
+                targets.append((doc, data.get("plan", "Free")))
+            else:
+                checkpoint["skipped"] += 1
+
+        if dry_run:
+            for doc, plan in targets:
+                logging.info("[dry-run] %s: %s -> %d", doc.id, plan, firestore_client.PLAN_MONTHLY_USES.get(plan, 0))
+            checkpoint["reset"] += len(targets)
+        elif targets:
+            checkpoint["reset"] += _write_page(db, targets, period, now, checkpoint)
+
+        checkpoint["last_uid"] = docs[-1].id
+        if not dry_run:
+            checkpoint_ref.set({**checkpoint, "updated_at": firestore.SERVER_TIMESTAMP})
+        logging.info("Processed users up to %s (reset %d, skipped %d)", checkpoint["last_uid"], checkpoint["reset"], checkpoint["skipped"])
+        if len(docs) < page_size:
+            break
+
+    checkpoint["completed"] = True
+    if not dry_run:
+        checkpoint_ref.set({**checkpoint, "updated_at": firestore.SERVER_TIMESTAMP})
+    return checkpoint["reset"], checkpoint["skipped"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="全ユーザーの利用回数を今月のプラン上限にリセットする")
+    parser.add_argument("--period", help="対象月 YYYY-MM（省略時は今月・UTC）")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="1ページで読むユーザー数")
+    parser.add_argument("--dry-run", action="store_true", help="対象を表示するだけで書き込まない")
+    parser.add_argument("--restart", action="store_true", help="進捗を無視して最初から処理する")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    reset, skipped = run(args.period, args.page_size, args.dry_run, args.restart)
+    logging.info("Monthly reset finished: %d reset, %d skipped", reset, skipped)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# result_cache.py
+# 診断結果のコンテンツアドレス型キャッシュ（プロセス内LRU + Firestore共有キャッシュ）
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import auth_utils
+
+# --- 設定（環境変数で上書き可能） ---
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv("DIAGNOSIS_CACHE_MAX_ENTRIES", "512"))
+SHARED_CACHE_TTL_DAYS = int(os.getenv("DIAGNOSIS_CACHE_TTL_DAYS", "30"))
+SHARED_CACHE_COLLECTION = "diagnosis_cache"
+# キャッシュヒット時にも利用回数を消費するか（既定: 消費しない）
+CACHE_HIT_CONSUMES_QUOTA = os.getenv("DIAGNOSIS_CACHE_HIT_CONSUMES_QUOTA", "false").lower() == "true"
+
+# キャッシュに保存する項目（ユーザー固有の情報は含めない）
+CACHED_FIELDS = ("score", "comment", "ctr", "sub_scores", "ai_response")
+
+_local_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def make_cache_key(image_bytes, prompt, model):
+    """正規化済み画像バイト列・プロンプト・モデル名からキャッシュキー（SHA-256）を作る"""
+    image_digest = hashlib.sha256(image_bytes).hexdigest()
+    material = "\0".join([image_digest, prompt, model])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def get(key):
+    """キャッシュから結果を取得する。ローカル → Firestore の順に探し、なければNone"""
+    with _lock:
+        if key in _local_cache:
+            _local_cache.move_to_end(key)
+            return dict(_local_cache[key])
+
+    entry = _get_shared(key)
+    if entry is not None:
+        _put_local(key, entry)
+    return entry
+
+
+def put(key, result):
+    """診断結果をローカル・Firestoreの両方に保存する"""
+    entry = {field: result.get(field) for field in CACHED_FIELDS}
+    _put_local(key, entry)
+    _put_shared(key, entry)
+
+
+def _put_local(key, entry):
+    with _lock:
+        _local_cache[key] = dict(entry)
+        _local_cache.move_to_end(key)
+        while len(_local_cache) > LOCAL_CACHE_MAX_ENTRIES:
+            _local_cache.popitem(last=False)
+
+
+def _get_shared(key):
+    try:
+        doc = auth_utils.db.collection(SHARED_CACHE_COLLECTION).document(key).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get("expires_at")
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            return None
+        return {field: data.get(field) for field in CACHED_FIELDS}
+    except Exception as e:
+        logging.warning("Shared diagnosis cache lookup failed: %s", e)
+        return None
+
+
+def _put_shared(key, entry):
+    # expires_at にはFirestoreのTTLポリシーを設定しておくと期限切れドキュメントが自動削除される
+    try:
+        now = datetime.now(timezone.utc)
+        auth_utils.db.collection(SHARED_CACHE_COLLECTION).document(key).set({
+            **entry,
+            "created_at": now,
+            "expires_at": now + timedelta(days=SHARED_CACHE_TTL_DAYS),
+        })
+    except Exception as e:
+        logging.warning("Shared diagnosis cache write failed: %s", e)
@@ -0,0 +1,347 @@
+# sheets_sync.py
+# 実績記録をGoogleスプレッドシートへ差分同期する（変更のあった範囲だけを batch_update でまとめて書き込む）
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from firebase_admin import firestore
+
+import auth_utils
+from diagnosis import CRITERIA, format_ctr
+
+# --- 設定（環境変数で上書き可能） ---
+# Sheets APIの書き込みクォータ（既定: 1ユーザーあたり毎分60リクエスト）に収める
+SHEETS_REQUESTS_PER_MINUTE = int(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "50"))
+# 1回の batch_update に載せる最大セル数（大きすぎるとリクエストサイズ上限に当たる）
+SHEETS_MAX_CELLS_PER_REQUEST = int(os.getenv("SHEETS_MAX_CELLS_PER_REQUEST", "20000"))
+SHEETS_WORKSHEET_TITLE = os.getenv("SHEETS_WORKSHEET_TITLE", "実績記録")
+SYNC_FETCH_PAGE_SIZE = 500
+SYNC_STATE_COLLECTION = "integrations"
+SYNC_STATE_DOC = "sheets"
+# 行の並び順とハッシュは1ドキュメント1MiBの上限に当たらないよう、この行数ごとに
+# users/{uid}/integrations/sheets/rows/{連番} に分けて保存する（1行あたり約100バイト）
+SYNC_STATE_ROWS_PER_SHARD = 2000
+SYNC_STATE_ROWS_COLLECTION = "rows"
+
+# スプレッドシートの列（見出し, 値を作る関数）
+SHEET_COLUMNS = [
+    ("ID", lambda record: record["id"]),
+    ("診断日時", lambda record: record["created_at"].strftime("%Y/%m/%d %H:%M") if isinstance(record.get("created_at"), datetime) else ""),
+    ("バナー名", lambda record: record.get("banner_name") or ""),
+    ("パターン", lambda record: record.get("pattern") or ""),
+    ("スコア", lambda record: record.get("score") or ""),
+    ("予想CTR", lambda record: format_ctr(record.get("predicted_ctr")) or ""),
+] + [
+    (name, lambda record, key=key: (record.get("sub_scores") or {}).get(key, ""))
+    for key, name in CRITERIA.items()
+] + [
+    ("媒体", lambda record: record.get("platform") or ""),
+    ("カテゴリ", lambda record: record.get("category") or ""),
+    ("業界", lambda record: record.get("industry") or ""),
+    ("年代", lambda record: record.get("age_group") or ""),
+    ("目的", lambda record: record.get("purpose") or ""),
+    ("ジャンル", lambda record: record.get("genre") or ""),
+    ("結果", lambda record: record.get("result") or ""),
+    ("フォロワー増加", lambda record: record.get("follower_gain") or ""),
+    ("メモ", lambda record: record.get("memo") or ""),
+    ("改善コメント", lambda record: record.get("comment") or ""),
+    ("画像URL", lambda record: record.get("image_url") or ""),
+]
+SHEET_FIELDS = [
+    "banner_name", "pattern", "score", "predicted_ctr", "sub_scores", "platform", "category", "industry",
+    "age_group", "purpose", "genre", "result", "follower_gain", "memo", "comment", "image_url", "created_at",
+]
+
+
+class SheetsRateLimiter:
+    """毎分の上限に収まるよう、前回のリクエストから一定間隔が空くまで待つ（プロセス全体で共有）"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / max(1, per_minute)
+        self.next_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.next_at - now)
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait:
+            time.sleep(wait)
+
+
+rate_limiter = SheetsRateLimiter(SHEETS_REQUESTS_PER_MINUTE)
+
+
+class GspreadBackend:
+    """gspread経由で実際のスプレッドシートに書き込む"""
+
+    def __init__(self, spreadsheet_id, worksheet_title=SHEETS_WORKSHEET_TITLE):
+        import gspread
+
+        service_account_info = os.getenv("SHEETS_SERVICE_ACCOUNT_JSON") or os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
+        if not service_account_info:
+            raise ValueError("SHEETS_SERVICE_ACCOUNT_JSON が設定されていません。")
+        client = gspread.service_account_from_dict(json.loads(service_account_info))
+        self.spreadsheet = client.open_by_key(spreadsheet_id)
+        try:
+            self.worksheet = self.spreadsheet.worksheet(worksheet_title)
+        except gspread.WorksheetNotFound:
+            rate_limiter.acquire()
+            self.worksheet = self.spreadsheet.add_worksheet(worksheet_title, rows=1000, cols=len(SHEET_COLUMNS))
+
+    def row_count(self):
+        return self.worksheet.row_count
+
+    def resize(self, rows):
+        rate_limiter.acquire()
+        self.worksheet.resize(rows=rows)
+
+    def batch_update(self, data):
+        rate_limiter.acquire()
+        # RAW: メモ・コメントが "=" で始まっても数式として解釈させない
+        self.worksheet.batch_update(data, value_input_option="RAW")
+
+
+class FakeSheetsBackend:
+    """メモリ上の表に書き込むだけの偽物（ローカル検証用）。呼び出し回数と書き込んだ範囲を記録する"""
+
+    def __init__(self, rows=1000):
+        self.rows = rows
+        self.cells = {}  # (row, col) -> value （1始まり）
+        self.requests = []
+
+    def row_count(self):
+        return self.rows
+
+    def resize(self, rows):
+        self.requests.append(("resize", rows))
+        self.rows = rows
+
+    def batch_update(self, data):
+        self.requests.append(("batch_update", [item["range"] for item in data]))
+        for item in data:
+            start_row = int(re.match(r"A(\d+)", item["range"]).group(1))
+            for row_offset, values in enumerate(item["values"]):
+                for col_offset, value in enumerate(values):
+                    self.cells[(start_row + row_offset, col_offset + 1)] = value
+
+    def values(self):
+        """現在の内容を行のリストで返す"""
+        if not self.cells:
+            return []
+        last_row = max(row for row, _ in self.cells)
+        return [
+            [self.cells.get((row, col), "") for col in range(1, len(SHEET_COLUMNS) + 1)]
+            for row in range(1, last_row + 1)
+        ]
+
+
+def _column_letter(index):
+    """1始まりの列番号をA1表記の列名にする"""
+    letters = ""
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def _row_values(record):
+    return [getter(record) for _, getter in SHEET_COLUMNS]
+
+
+def _row_hash(values):
+    # 同期状態には全行分のハッシュを保存するため、行の変化を見分けられる短いハッシュで十分とする
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def _load_records(uid):
+    """全記録を古い順に返す（一覧と同じくページ単位で読み込む）"""
+    records = []
+    cursor = None
+    while True:
+        page, cursor = auth_utils.get_diagnosis_records_page(uid, SYNC_FETCH_PAGE_SIZE, cursor, fields=SHEET_FIELDS)
+        records.extend(page)
+        if cursor is None:
+            break
+    records.reverse()
+    return records
+
+
+def plan_updates(previous_order, previous_hashes, rows):
+    """
+    前回同期した状態（行の並び順・各行のハッシュ）と今回の行から、書き込むべき範囲を求める。
+    rows は [(ドキュメントID, 値のリスト)] を古い順に並べたもの。
+    既存の行は位置を保ち、新しい記録は末尾に追加する。削除があった場合はそれ以降の行を詰めて書き直す。
+    戻り値は (新しい並び順, 新しいハッシュ, 書き込む行番号→値のdict, 消去する行数)。
+    """
+    values_by_id = dict(rows)
+    kept = [doc_id for doc_id in previous_order if doc_id in values_by_id]
+    known = set(kept)
+    order = kept + [doc_id for doc_id, _ in rows if doc_id not in known]
+    hashes = {doc_id: _row_hash(values_by_id[doc_id]) for doc_id in order}
+
+    changed = {}
+    for position, doc_id in enumerate(order):
+        moved = position >= len(previous_order) or previous_order[position] != doc_id
+        if moved or previous_hashes.get(doc_id) != hashes[doc_id]:
+            changed[position + 2] = values_by_id[doc_id]  # 1行目は見出し
+    cleared = max(0, len(previous_order) - len(order))
+    return order, hashes, changed, cleared
+
+
+def _contiguous_ranges(changed, width):
+    """変更行を連続する範囲にまとめ、1リクエストのセル数上限ごとに分けて batch_update 用のdataにする"""
+    max_rows = max(1, SHEETS_MAX_CELLS_PER_REQUEST // width)
+    last_column = _column_letter(width)
+    ranges = []
+    start = previous = None
+    block = []
+    for row in sorted(changed):
+        if start is None or row != previous + 1 or len(block) >= max_rows:
+            if block:
+                ranges.append({"range": f"A{start}:{last_column}{previous}", "values": block})
+            start, block = row, []
+        block.append(changed[row])
+        previous = row
+    if block:
+        ranges.append({"range": f"A{start}:{last_column}{previous}", "values": block})
+    return ranges
+
+
+def _chunk_requests(ranges):
+    """範囲のリストを1リクエストあたりのセル数上限で分ける"""
+    chunk, cells = [], 0
+    for item in ranges:
+        size = len(item["values"]) * len(item["values"][0])
+        if chunk and cells + size > SHEETS_MAX_CELLS_PER_REQUEST:
+            yield chunk
+            chunk, cells = [], 0
+        chunk.append(item)
+        cells += size
+    if chunk:
+        yield chunk
+
+
+def _state_ref(uid):
+    return auth_utils.db.collection('users').document(uid).collection(SYNC_STATE_COLLECTION).document(SYNC_STATE_DOC)
+
+
+class FirestoreSyncStore:
+    """
+    前回同期時の状態をFirestoreに保存する。
+    spreadsheet_id などは users/{uid}/integrations/sheets に、行の並び順とハッシュは配下の rows にシャード分割して置く。
+    """
+
+    def __init__(self, uid):
+        self.uid = uid
+        self._shards = {}  # 読み込んだシャードIDごとの内容（変わったシャードだけを書き直すため）
+
+    def _shards_ref(self):
+        return _state_ref(self.uid).collection(SYNC_STATE_ROWS_COLLECTION)
+
+    def load(self):
+        """(状態dict, 行の並び順, 各行のハッシュ) を返す"""
+        state_doc = _state_ref(self.uid).get()
+        state = state_doc.to_dict() if state_doc.exists else {}
+        order, hashes, self._shards = [], {}, {}
+        for doc in self._shards_ref().order_by("__name__").stream():
+            data = doc.to_dict() or {}
+            self._shards[doc.id] = data
+            order.extend(data.get("order", []))
+            hashes.update(data.get("hashes", {}))
+        if not self._shards and state.get("order"):
+            # 分割保存する前の形式（状態ドキュメントに直接保存）から引き継ぐ
+            order, hashes = state["order"], state.get("hashes", {})
+        return state, order, hashes
+
+    def save(self, state, order, hashes):
+        """並び順とハッシュをシャードに分けて保存する。内容が変わったシャードだけを書き、余ったシャードは消す"""
+        operations = []
+        shards = {}
+        for index, start in enumerate(range(0, len(order), SYNC_STATE_ROWS_PER_SHARD)):
+            shard_id = f"{index:05d}"
+            shard_order = order[start:start + SYNC_STATE_ROWS_PER_SHARD]
+            shards[shard_id] = {"order": shard_order, "hashes": {doc_id: hashes[doc_id] for doc_id in shard_order}}
+            if self._shards.get(shard_id) != shards[shard_id]:
+                operations.append((shard_id, shards[shard_id]))
+        operations += [(shard_id, None) for shard_id in self._shards if shard_id not in shards]
+
+        for start in range(0, len(operations), auth_utils.FIRESTORE_BATCH_LIMIT):
+            batch = auth_utils.db.batch()
+            for shard_id, data in operations[start:start + auth_utils.FIRESTORE_BATCH_LIMIT]:
+                if data is None:
+                    batch.delete(self._shards_ref().document(shard_id))
+                else:
+                    batch.set(self._shards_ref().document(shard_id), data)
+            batch.commit()
+        self._shards = shards
+        _state_ref(self.uid).set({**state, "synced_at": firestore.SERVER_TIMESTAMP})
+
+
+class MemorySyncStore:
+    """同期状態をメモリに持つだけの偽物（ローカル検証用。FakeSheetsBackend と組み合わせて使う）"""
+
+    def __init__(self):
+        self.state, self.order, self.hashes = {}, [], {}
+        self.saves = 0
+
+    def load(self):
+        return dict(self.state), list(self.order), dict(self.hashes)
+
+    def save(self, state, order, hashes):
+        self.state, self.order, self.hashes = dict(state), list(order), dict(hashes)
+        self.saves += 1
+
+
+def get_spreadsheet_id(uid):
+    doc = _state_ref(uid).get()
+    return (doc.to_dict() or {}).get("spreadsheet_id") if doc.exists else None
+
+
+def sync(uid, spreadsheet_id, backend=None, records=None, store=None):
+    """
+    実績記録をスプレッドシートに同期し、書き込んだ行数を返す。
+    前回同期時の状態と比べて変わった行だけを書き込む。スプレッドシートが変わった場合は全行を書き直す。
+    backend・records・store を渡すと、Firestoreやスプレッドシートの代わりにそれを使う
+    （FakeSheetsBackend・記録dictのリスト（古い順）・MemorySyncStore を渡せばローカルで検証できる）。
+    """
+    store = store or FirestoreSyncStore(uid)
+    state, previous_order, previous_hashes = store.load()
+    headers = [header for header, _ in SHEET_COLUMNS]
+    if state.get("spreadsheet_id") != spreadsheet_id or state.get("headers") != headers:
+        state = {}
+        previous_order, previous_hashes = [], {}
+
+    backend = backend or GspreadBackend(spreadsheet_id)
+    records = _load_records(uid) if records is None else records
+    rows = [(record["id"], _row_values(record)) for record in records]
+    order, hashes, changed, cleared = plan_updates(previous_order, previous_hashes, rows)
+
+    width = len(headers)
+    if not state:
+        changed[1] = headers
+    # 削除で短くなった分の末尾の行は空にする
+    for row in range(len(order) + 2, len(order) + 2 + cleared):
+        changed[row] = [""] * width
+
+    needed_rows = len(order) + 1 + cleared
+    if backend.row_count() < needed_rows:
+        backend.resize(needed_rows + 100)
+    for chunk in _chunk_requests(_contiguous_ranges(changed, width)):
+        backend.batch_update(chunk)
+
+    store.save({"spreadsheet_id": spreadsheet_id, "headers": headers, "row_count": len(order)}, order, hashes)
+    logging.info("Sheets sync for %s: %d rows written, %d cleared", uid, len(changed), cleared)
+    return len(changed)
+
+
+def parse_spreadsheet_id(value):
+    """スプレッドシートのURLまたはIDからIDを取り出す"""
+    match = re.search(r"/spreadsheets/d/([A-Za-z0-9_-]+)", value or "")
+    return match.group(1) if match else (value or "").strip() or None
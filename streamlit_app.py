@@ -1,24 +1,12 @@
 import streamlit as st
-import base64
-import io
 import os
-import re
 import requests
-from PIL import Image
-from datetime import datetime
-from openai import OpenAI
 
 import auth_utils # Import Firebase authentication
-
-# Google Apps Script (GAS) and Google Drive information (GAS for legacy spreadsheet, will be removed later if not needed)
-GAS_URL = "https://script.google.com/macros/s/AKfycby_uD6Jtb9GT0-atbyPKOPc8uyVKodwYVIQ2Tpe-_E8uTOPiir0Ce1NAPZDEOlCUxN4/exec" # Update this URL to your latest GAS deployment URL
-
-# Helper function to sanitize values
-def sanitize(value):
-    """Replaces None or specific strings with 'エラー' (Error)"""
-    if value is None or value == "取得できず":
-        return "エラー"
-    return value
+import diagnosis # Banner scoring pipeline
+import image_utils # Image decode / thumbnail cache
+import llm_client # Shared OpenAI call layer (retries / circuit breaker)
+from diagnosis import sanitize
 
 # Streamlit UI configuration
 st.set_page_config(layout="wide", page_title="バナスコAI")
@@ -27,7 +15,7 @@ st.set_page_config(layout="wide", page_title="バナスコAI")
 logo_path = "banasuko_logo_icon.png"
 
 try:
-    logo_image = Image.open(logo_path)
+    logo_image = image_utils.asset_thumbnail(logo_path, max_edge=400) # Decoded and resized once per process
     st.sidebar.image(logo_image, use_container_width=True) # Display logo in sidebar, adjusting to column width
 except FileNotFoundError:
     st.sidebar.error(f"ロゴ画像 '{logo_path}' が見つかりません。ファイルが正しく配置されているか確認してください。")
@@ -37,15 +25,17 @@ except FileNotFoundError:
 auth_utils.check_login()
 
 # --- OpenAI Client Initialization ---
-# Initialize OpenAI client after login check, when OpenAI API key is available from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if openai_api_key:
-    client = OpenAI(api_key=openai_api_key)
-else:
+# The client (and its connection pool) is created once per process and shared across reruns and sessions
+client = llm_client.get_client()
+if client is None:
     # For demo purposes without API key
-    client = None
     st.warning("デモモード - OpenAI APIが設定されていません")
 
+# Connection pool / retry diagnostics for operators
+if os.getenv("SHOW_LLM_DIAGNOSTICS", "false").lower() == "true":
+    with st.sidebar:
+        llm_client.render_diagnostics()
+
 
 # --- Ultimate Professional CSS Theme ---
 st.markdown(
@@ -437,7 +427,6 @@ st.markdown('</div>', unsafe_allow_html=True)
 
 # --- プランと残回数の取得 ---
 user_plan = st.session_state.get("plan", "Guest")
-remaining_uses = st.session_state.get("remaining_uses", 0)
 
 # --- Ultimate Main Content Layout ---
 col1, col2 = st.columns([3, 2], gap="large")
@@ -512,162 +501,236 @@ with col1:
     if 'comment_b' not in st.session_state: st.session_state.comment_b = None
     if 'yakujihou_b' not in st.session_state: st.session_state.yakujihou_b = None
 
-    # --- A Pattern Processing ---
-    if uploaded_file_a:
-        st.markdown("#### 🔷 Aパターン診断")
-        
-        img_col_a, result_col_a = st.columns([1, 2])
-
-        with img_col_a:
-            st.image(Image.open(uploaded_file_a), caption="Aパターン画像", use_container_width=True)
-            if st.button("Aパターンを採点", key="score_a_button"):
-                if remaining_uses <= 0:
-                    st.warning(f"残り回数がありません。（{user_plan}プラン）")
-                    st.info("利用回数を増やすには、プランのアップグレードが必要です。")
-                else:
-                    if auth_utils.update_user_uses_in_firestore(st.session_state["user"]):
-                        st.session_state.remaining_uses -= 1 # UI上の残回数を即時更新
-                        image_a_bytes = io.BytesIO()
-                        Image.open(uploaded_file_a).save(image_a_bytes, format="PNG")
-                        image_filename_a = f"banner_A_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-                        
-                        image_url_a = auth_utils.upload_image_to_firebase_storage(
-                            st.session_state["user"], image_a_bytes, image_filename_a
-                        )
-
-                        if image_url_a:
-                            with st.spinner("AIがAパターンを採点中です..."):
-                                try:
-                                    ctr_instruction = "また、このバナー広告の予想CTR（クリックスルー率）もパーセンテージで示してください。" if add_ctr else ""
-                                    typo_instruction = "生成する改善コメントに誤字脱字がないか厳密にチェックしてください。" if check_typos else ""
-                                    
-                                    ai_prompt_text = f"""
-以下のバナー画像をプロ視点で採点してください。
-この広告のターゲット年代は「{age_group}」で、主な目的は「{purpose}」です。
-
-【評価基準】
-1. 内容が一瞬で伝わるか
-2. コピーの見やすさ
-3. 行動喚起
-4. 写真とテキストの整合性
-5. 情報量のバランス
-
-【ターゲット年代「{age_group}」と目的「{purpose}」を考慮した具体的なフィードバックをお願いします。】
-{ctr_instruction}
-{typo_instruction}
-
-【出力形式】
----
-スコア：{score_format}
-改善コメント：2～3行でお願いします
-{ "予想CTR：X.X%" if add_ctr else "" }
----"""
-                                    if client:
-                                        img_str_a = base64.b64encode(image_a_bytes.getvalue()).decode()
-                                        response_a = client.chat.completions.create(
-                                            model="gpt-4o",
-                                            messages=[
-                                                {"role": "system", "content": "あなたは広告のプロです。"},
-                                                {"role": "user", "content": [
-                                                    {"type": "text", "text": ai_prompt_text},
-                                                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_str_a}"}}
-                                                ]}
-                                            ],
-                                            max_tokens=600
-                                        )
-                                        content_a = response_a.choices[0].message.content
-                                    else:
-                                        content_a = "---\nスコア：A+\n改善コメント：プロフェッショナルなデザインで非常に優秀です。\n予想CTR：5.5%\n---"
-                                    st.session_state.ai_response_a = content_a
-
-                                    score_match_a = re.search(r"スコア[:：]\s*(.+)", content_a)
-                                    comment_match_a = re.search(r"改善コメント[:：]\s*(.+)", content_a, re.DOTALL)
-                                    ctr_match_a = re.search(r"予想CTR[:：]\s*(.+)", content_a)
-                                    
-                                    st.session_state.score_a = score_match_a.group(1).strip() if score_match_a else "取得できず"
-                                    st.session_state.comment_a = comment_match_a.group(1).strip() if comment_match_a else "取得できず"
-                                    st.session_state.ctr_a = ctr_match_a.group(1).strip() if ctr_match_a else None
-
-                                    if user_plan in ["Pro", "Team", "Enterprise"]:
-                                        firestore_record_data = {
-                                            "user_name": sanitize(user_name), "banner_name": sanitize(banner_name), "pattern": "A",
-                                            "platform": sanitize(platform), "category": sanitize(category), "industry": sanitize(industry),
-                                            "age_group": sanitize(age_group), "purpose": sanitize(purpose), "genre": sanitize(genre),
-                                            "score": sanitize(st.session_state.score_a), "comment": sanitize(st.session_state.comment_a),
-                                            "predicted_ctr": sanitize(st.session_state.ctr_a) if add_ctr else "N/A",
-                                            "result": sanitize(result_input), "follower_gain": sanitize(follower_gain_input), "memo": sanitize(memo_input),
-                                            "image_url": image_url_a
-                                        }
-                                        if auth_utils.add_diagnosis_record_to_firestore(st.session_state["user"], firestore_record_data):
-                                            st.success("診断結果を実績記録ページに記録しました！")
-                                        else:
-                                            st.error("診断結果の記録に失敗しました。")
-
-                                except Exception as e:
-                                    st.error(f"AI採点中にエラーが発生しました（Aパターン）: {str(e)}")
-                                    st.session_state.score_a = "エラー"
-                                    st.session_state.comment_a = "AI応答エラー"
-                        else:
-                            st.error("画像アップロードに失敗したため、採点を行いませんでした。")
-                    else:
-                        st.error("利用回数の更新に失敗しました。")
-                st.rerun() 
-        
-        with result_col_a:
-            if st.session_state.score_a:
-                st.markdown("### 🎯 Aパターン診断結果")
-                st.metric("総合スコア", st.session_state.score_a)
-                if st.session_state.get("ctr_a"):
-                    st.metric("予想CTR", st.session_state.ctr_a)
-                st.info(f"**改善コメント:** {st.session_state.comment_a}")
-                
+    def render_diagnosis_result(slot, pattern):
+        """セッションに保存された診断結果を指定の枠に描画する"""
+        key = pattern.lower()
+        with slot.container():
+            if st.session_state.get(f"score_{key}"):
+                st.markdown(f"### 🎯 {pattern}パターン診断結果")
+                st.metric("総合スコア", st.session_state[f"score_{key}"])
+                if st.session_state.get(f"ctr_{key}") is not None:
+                    st.metric("予想CTR", diagnosis.format_ctr(st.session_state[f"ctr_{key}"]))
+                st.info(f"**改善コメント:** {st.session_state[f'comment_{key}']}")
+                sub_scores = st.session_state.get(f"sub_scores_{key}")
+                if sub_scores:
+                    with st.expander("評価基準ごとのスコア"):
+                        for criterion, label in diagnosis.CRITERIA.items():
+                            st.progress(sub_scores.get(criterion, 0) / 100, text=f"{label}: {sub_scores.get(criterion, 0)}点")
+                stats = st.session_state.get(f"payload_stats_{key}")
+                if stats:
+                    st.caption(
+                        f"送信画像: {stats['original_bytes'] / 1024:.0f}KB → {stats['optimized_bytes'] / 1024:.0f}KB"
+                        f"（{stats['bytes_saved'] / 1024:.0f}KB削減）"
+                    )
+
                 if industry in ["美容", "健康・フィットネス"]:
                     st.warning("【薬機法】美容・健康系の広告では、効果効能を保証する表現にご注意ください。")
 
-    # --- B Pattern Processing ---
-    if uploaded_file_b:
-        st.markdown("---")
-        st.markdown("#### 🔷 Bパターン診断")
-        
-        img_col_b, result_col_b = st.columns([1, 2])
-
-        with img_col_b:
-            st.image(Image.open(uploaded_file_b), caption="Bパターン画像", use_container_width=True)
-            if st.button("Bパターンを採点", key="score_b_button"):
-                if remaining_uses <= 0:
-                    st.warning(f"残り回数がありません。（{user_plan}プラン）")
-                    st.info("利用回数を増やすには、プランのアップグレードが必要です。")
+    # 実績記録に残す共通項目（Proプラン以上のみ記録）
+    record_data = None
+    if user_plan in ["Pro", "Team", "Enterprise"]:
+        record_data = {
+            "user_name": sanitize(user_name), "banner_name": sanitize(banner_name),
+            "platform": sanitize(platform), "category": sanitize(category), "industry": sanitize(industry),
+            "age_group": sanitize(age_group), "purpose": sanitize(purpose), "genre": sanitize(genre),
+            "result": sanitize(result_input), "follower_gain": sanitize(follower_gain_input), "memo": sanitize(memo_input),
+        }
+
+    def show_diagnosis_result(result):
+        """確定した診断結果をセッションに保存し、結果欄に描画する"""
+        key = result["pattern"].lower()
+        if result["error"]:
+            st.error(result["error"])
+            st.session_state[f"score_{key}"] = "エラー"
+            st.session_state[f"comment_{key}"] = "AI応答エラー"
+        else:
+            if result["warning"]:
+                st.warning(result["warning"])
+            if result["cached"]:
+                st.toast(f"{result['pattern']}パターンは同じ条件で採点済みのため、前回の結果を表示しました。")
+
+            st.session_state[f"ai_response_{key}"] = result["ai_response"]
+            st.session_state[f"score_{key}"] = result["score"]
+            st.session_state[f"comment_{key}"] = result["comment"]
+            st.session_state[f"ctr_{key}"] = result["ctr"]
+            st.session_state[f"sub_scores_{key}"] = result.get("sub_scores")
+            st.session_state[f"payload_stats_{key}"] = result.get("payload_stats")
+            if record_data is not None:
+                if result["saved"]:
+                    st.toast(f"{result['pattern']}パターンの診断結果を実績記録ページに記録しました！")
                 else:
-                    if auth_utils.update_user_uses_in_firestore(st.session_state["user"]):
-                        st.session_state.remaining_uses -= 1
-                        image_b_bytes = io.BytesIO()
-                        Image.open(uploaded_file_b).save(image_b_bytes, format="PNG")
-                        image_filename_b = f"banner_B_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-                        
-                        image_url_b = auth_utils.upload_image_to_firebase_storage(
-                            st.session_state["user"], image_b_bytes, image_filename_b
-                        )
-
-                        if image_url_b:
-                            with st.spinner("AIがBパターンを採点中です..."):
-                                try:
-                                    # (Aパターンと同様のAIプロンプトと処理)
-                                    # ...
-                                    pass # ここにBパターン用の処理を実装
-                                except Exception as e:
-                                    st.error(f"AI採点中にエラーが発生しました（Bパターン）: {str(e)}")
-
-                        else:
-                            st.error("画像アップロードに失敗したため、採点を行いませんでした。")
-                    else:
-                        st.error("利用回数の更新に失敗しました。")
-                st.rerun()
-
-        with result_col_b:
-            if st.session_state.score_b:
-                st.markdown("### 🎯 Bパターン診断結果")
-                # ... (Bパターンの結果表示)
-    
+                    st.error("診断結果の記録に失敗しました。")
+        render_diagnosis_result(result_slots[result["pattern"]], result["pattern"])
+
+    def upload_phash(uploaded_file):
+        """アップロードごとの知覚ハッシュ（rerunのたびにデコード・縮小し直さない）"""
+        phashes = st.session_state.setdefault("upload_phashes", {})
+        key = image_utils.upload_key(uploaded_file)
+        if key not in phashes:
+            phashes[key] = image_utils.perceptual_hash(uploaded_file.getvalue(), key=key)
+        return phashes[key]
+
+    def reserve_quota(uses_needed, quota_key):
+        """利用回数をトランザクションで予約する。予約できればTrue（不足・障害時はメッセージを表示してFalse）"""
+        if uses_needed == 0:
+            return True
+        if not llm_client.is_available():
+            st.error("AIサービスが一時的に利用できません。利用回数は消費されていません。しばらくしてから再度お試しください。")
+            return False
+        try:
+            return auth_utils.reserve_uses(st.session_state["user"], uses_needed, quota_key) is not None
+        except auth_utils.QuotaExceededError as e:
+            st.warning(f"残り回数が不足しています。（{user_plan}プラン / 必要回数: {uses_needed}回・残り{e.remaining}回）")
+            st.info("利用回数を増やすには、プランのアップグレードが必要です。")
+            return False
+
+    # --- A/B Pattern Processing ---
+    uploaded_files = {"A": uploaded_file_a, "B": uploaded_file_b}
+    result_slots = {}
+    patterns_to_score = []
+
+    # 上限を超える画像はデコードする前に弾き（巨大画像によるメモリ急増を防ぐ）、
+    # ヘッダは正しくても本体が壊れている画像は表示用のデコードで弾く
+    thumbnails = {}
+    for pattern, uploaded_file in list(uploaded_files.items()):
+        if uploaded_file:
+            try:
+                image_utils.validate_image(uploaded_file.getvalue())
+                thumbnails[pattern] = image_utils.upload_thumbnail(uploaded_file)
+                if user_plan in ["Pro", "Team", "Enterprise"]:
+                    upload_phash(uploaded_file)
+            except (image_utils.ImageTooLargeError, OSError) as e:
+                # OSError: 壊れた・途中で切れた・画像でないファイル（UnidentifiedImageError を含む）
+                st.error(f"{pattern}パターン画像を読み込めません: {e}")
+                uploaded_files[pattern] = None
+
+    for pattern, uploaded_file in uploaded_files.items():
+        if not uploaded_file:
+            continue
+        if pattern != "A":
+            st.markdown("---")
+        st.markdown(f"#### 🔷 {pattern}パターン診断")
+
+        img_col, result_col = st.columns([1, 2])
+        with img_col:
+            st.image(thumbnails[pattern], caption=f"{pattern}パターン画像", use_container_width=True)
+            if user_plan in ["Pro", "Team", "Enterprise"]:
+                similar = diagnosis.find_previous_diagnoses(st.session_state["user"], upload_phash(uploaded_file))
+                if similar:
+                    distance, previous = similar[0]
+                    st.info(f"💡 類似バナーを過去に採点済みです：「{previous.get('banner_name') or '名称未設定'}」スコア {previous.get('score')}（差分 {distance}bit）")
+            if st.button(f"{pattern}パターンを採点", key=f"score_{pattern.lower()}_button"):
+                patterns_to_score = [pattern]
+        result_slots[pattern] = result_col.empty()
+        render_diagnosis_result(result_slots[pattern], pattern)
+
+    # 両方アップロードされている場合は同時採点（所要時間は遅い方の1回分）
+    if uploaded_files["A"] and uploaded_files["B"]:
+        st.markdown("---")
+        if st.button("A/Bパターンを同時に採点", key="score_both_button", type="primary"):
+            patterns_to_score = ["A", "B"]
+
+    if patterns_to_score:
+        ai_prompt_text = diagnosis.build_ai_prompt(age_group, purpose, score_format, add_ctr, check_typos)
+        reuse_params = diagnosis.reuse_params(sanitize(age_group), sanitize(purpose), score_format, add_ctr)
+        # 採点済みの画像・条件はキャッシュから返すため、利用回数はキャッシュミス分だけ消費する
+        payloads = {
+            pattern: diagnosis.prepare_payload(
+                uploaded_files[pattern].getvalue(), ai_prompt_text, st.session_state["user"], reuse_params,
+                image_key=image_utils.upload_key(uploaded_files[pattern]), phash=upload_phash(uploaded_files[pattern]),
+            )
+            for pattern in patterns_to_score
+        }
+        uses_needed = diagnosis.uses_required(payloads.values())
+        jobs = [
+            {
+                "client": client, "uid": st.session_state["user"], "pattern": pattern,
+                "file_bytes": uploaded_files[pattern].getvalue(), "prompt": ai_prompt_text,
+                "record_data": record_data, "add_ctr": add_ctr, "payload": payloads[pattern], "score_format": score_format,
+            }
+            for pattern in patterns_to_score
+        ]
+        # 予約はこのボタン押下に対して1回分。実行中の同じ採点への合流（連打）は消費せず、記録も同じ内容なら1件にまとまる
+        quota_key = diagnosis.assign_request_keys(jobs, auth_utils.new_idempotency_key())
+
+        if reserve_quota(uses_needed, quota_key):
+            # 実際に採点できた分だけ確定し、失敗分は返却する（採点の完了時にワーカー側で行うので、画面のrerunに左右されない）
+            quota = (st.session_state["user"], quota_key) if uses_needed else None
+            with st.spinner(f"AIが{'・'.join(patterns_to_score)}パターンを採点中です..."):
+                # 応答は届いた分から結果欄に流し込み、終わったパターンから順に確定表示する
+                for event, pattern, result in diagnosis.stream_diagnoses_concurrently(jobs, quota=quota):
+                    if event == "delta":
+                        result_slots[pattern].markdown(f"### ✍️ {pattern}パターン採点中...\n\n{diagnosis.partial_comment(result)}")
+                        continue
+                    show_diagnosis_result(result)
+            st.rerun()
+
+    # --- Batch Diagnosis (Team / Enterprise) ---
+    if user_plan in ["Team", "Enterprise"]:
+        st.markdown("---")
+        st.subheader("📦 一括診断（Team / Enterpriseプラン）")
+        st.caption(f"複数の画像、またはZIPファイルをまとめて採点します（1回あたり最大{diagnosis.BATCH_MAX_FILES}枚）。")
+        batch_files = st.file_uploader(
+            "バナー画像（複数可）またはZIPをアップロード", type=["png", "jpg", "jpeg", "zip"],
+            accept_multiple_files=True, key="batch_upload"
+        )
+
+        if batch_files and st.button("一括診断を開始", key="score_batch_button"):
+            batch_images, skipped_files = diagnosis.extract_batch_images(batch_files)
+            if skipped_files:
+                st.warning(f"サイズ・解像度の上限を超えたため、{len(skipped_files)}件をスキップしました: {'、'.join(skipped_files)}")
+            if not batch_images:
+                st.warning("診断できる画像が見つかりませんでした。")
+            else:
+                ai_prompt_text = diagnosis.build_ai_prompt(age_group, purpose, score_format, add_ctr, check_typos)
+                with st.spinner(f"{len(batch_images)}枚の画像を準備中です..."):
+                    batch_payloads = diagnosis.prepare_payloads(
+                        [file_bytes for _, file_bytes in batch_images], ai_prompt_text, st.session_state["user"],
+                        diagnosis.reuse_params(sanitize(age_group), sanitize(purpose), score_format, add_ctr),
+                    )
+                # バッチ全体の利用回数を先にまとめて確保する
+                uses_needed = diagnosis.uses_required(batch_payloads)
+                jobs = []
+                for i, ((file_name, file_bytes), payload) in enumerate(zip(batch_images, batch_payloads)):
+                    batch_record = None
+                    if record_data is not None:
+                        batch_record = {**record_data, "banner_name": os.path.splitext(file_name)[0], "pattern": "一括"}
+                    jobs.append({
+                        "client": client, "uid": st.session_state["user"], "pattern": f"batch{i:03d}",
+                        "file_bytes": file_bytes, "prompt": ai_prompt_text, "record_data": batch_record,
+                        "add_ctr": add_ctr, "payload": payload, "label": file_name, "defer_save": True,
+                        "score_format": score_format,
+                    })
+                quota_key = diagnosis.assign_request_keys(jobs, auth_utils.new_idempotency_key())
+
+                if reserve_quota(uses_needed, quota_key):
+                    progress = st.progress(0.0, text="一括診断を実行中...")
+                    table_slot = st.empty()
+                    batch_rows = []
+                    batch_results = []
+                    # 失敗した画像の分は、全件の完了時にワーカー側で返却される
+                    quota = (st.session_state["user"], quota_key) if uses_needed else None
+                    # 完了した順に結果テーブルへ行を追加していく
+                    for result in diagnosis.run_diagnoses_concurrently(jobs, batch=True, quota=quota):
+                        batch_results.append(result)
+                        batch_rows.append({
+                            "ファイル名": result["label"],
+                            "スコア": "エラー" if result["error"] else result["score"],
+                            "予想CTR": diagnosis.format_ctr(result.get("ctr")) or "-",
+                            "改善コメント": result["error"] or result["comment"],
+                            "キャッシュ": "✅" if result.get("cached") else "",
+                        })
+                        table_slot.dataframe(batch_rows, use_container_width=True)
+                        progress.progress(len(batch_results) / len(jobs), text=f"{len(batch_results)} / {len(jobs)} 件完了")
+
+                    if record_data is not None:
+                        saved_count = diagnosis.save_batch_records(st.session_state["user"], batch_results)
+                        st.success(f"{saved_count}件の診断結果を実績記録ページに記録しました！")
+                    st.session_state.batch_rows = batch_rows
+        elif st.session_state.get("batch_rows"):
+            st.markdown("#### 前回の一括診断結果")
+            st.dataframe(st.session_state.batch_rows, use_container_width=True)
+
 with col2:
     st.markdown("### 採点基準はこちら")
     with st.container():
@@ -0,0 +1,239 @@
+# stripe_webhook.py
+# Stripe Webhook受信サービス（署名検証・イベントIDによる冪等処理・顧客IDの逆引き索引・有界キュー）
+#
+#   起動:   gunicorn -w 1 --threads 4 -b 0.0.0.0:8080 stripe_webhook:app
+#   再処理: python stripe_webhook.py replay event1.json [event2.json ...]   （記録済みのイベントJSONを処理）
+#           python stripe_webhook.py replay --event-id evt_xxx              （Stripeから取り直して処理）
+#
+# 受信したイベントは署名を検証したらキューに積んで即座に200を返し、Firestoreへの書き込みは
+# バックグラウンドのワーカーが行う（Stripeの応答待ちタイムアウトを起こさない）。
+# キューが満杯のときは503を返し、Stripe側の再送に任せる。
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+import stripe
+from firebase_admin import firestore
+from flask import Flask, jsonify, request
+
+import firestore_client
+
+# --- 設定（環境変数で上書き可能） ---
+STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+# 価格ID・Payment Link ID → プラン名（JSON）。Payment Linkのメタデータ "plan" があればそちらを優先する
+STRIPE_PLAN_BY_PRICE = json.loads(os.getenv("STRIPE_PLAN_BY_PRICE", "{}"))
+STRIPE_PLAN_BY_PAYMENT_LINK = json.loads(os.getenv("STRIPE_PLAN_BY_PAYMENT_LINK", "{}"))
+
+# 処理済みイベントの台帳（stripe_events/{event_id}）
+EVENTS_COLLECTION = "stripe_events"
+ACTIVE_SUBSCRIPTION_STATUSES = {"active", "trialing"}
+SUBSCRIPTION_EVENTS = ("customer.subscription.created", "customer.subscription.updated", "customer.subscription.deleted")
+# 支払い済みのチェックアウトだけプランを反映する。銀行振込などの遅延決済は completed の時点では "unpaid" で、
+# 入金されると async_payment_succeeded が届く
+CHECKOUT_EVENTS = ("checkout.session.completed", "checkout.session.async_payment_succeeded")
+PAID_CHECKOUT_STATUSES = ("paid", "no_payment_required")
+
+stripe.api_key = STRIPE_API_KEY
+app = Flask(__name__)
+_events = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+
+class UnknownCustomerError(Exception):
+    """顧客IDに対応するユーザーがまだ分からない（checkout.session.completed より先に届いたサブスクリプションのイベント等）"""
+
+
+def _plan_for_checkout(session):
+    """Payment Linkのメタデータ・Payment Link ID・サブスクリプションの価格IDの順にプランを決める"""
+    plan = (session.get("metadata") or {}).get("plan") or STRIPE_PLAN_BY_PAYMENT_LINK.get(session.get("payment_link"))
+    if plan or not session.get("subscription"):
+        return plan
+    # 価格IDの対応表だけを設定している場合は、購入されたサブスクリプションの価格から決める
+    subscription = stripe.Subscription.retrieve(session["subscription"])
+    return _plan_for_subscription(json.loads(str(subscription)))
+
+
+def _plan_for_subscription(subscription):
+    for item in (subscription.get("items") or {}).get("data", []):
+        plan = STRIPE_PLAN_BY_PRICE.get((item.get("price") or {}).get("id"))
+        if plan:
+            return plan
+    return (subscription.get("metadata") or {}).get("plan")
+
+
+def _plan_update(plan):
+    return {
+        "plan": plan,
+        "remaining_uses": firestore_client.PLAN_MONTHLY_USES.get(plan, 0),
+        "plan_updated_at": firestore.SERVER_TIMESTAMP,
+    }
+
+
+def process_event(event):
+    """
+    イベントを1件処理する。台帳の確認・ユーザーの更新・台帳への記録を1つのトランザクションで行うため、
+    同じイベントが何度届いても反映は1回だけになる。戻り値は処理結果の短い説明。
+    顧客IDからユーザーが分からないサブスクリプションのイベントは台帳に記録せず UnknownCustomerError を送出する
+    （checkout.session.completed の処理後に再試行すれば反映される）。
+    """
+    db = firestore_client.get_firestore_db()
+    event_ref = db.collection(EVENTS_COLLECTION).document(event["id"])
+    if event_ref.get().exists:
+        return "duplicate"
+    event_type = event["type"]
+    obj = event["data"]["object"]
+
+    # ユーザーの特定とプランの判定（Stripe API・索引の補完を含む）はトランザクションの外で済ませる
+    uid = plan = None
+    paid = obj.get("payment_status") in PAID_CHECKOUT_STATUSES
+    if event_type in CHECKOUT_EVENTS:
+        customer_id = obj.get("customer")
+        # Payment Linkに付けた client_reference_id（ユーザーID）で顧客とユーザーを結びつける
+        uid = obj.get("client_reference_id") or (customer_id and firestore_client.find_uid_by_customer(customer_id))
+        plan = _plan_for_checkout(obj) if uid and paid else None
+    elif event_type == "checkout.session.async_payment_failed":
+        logging.warning("Stripe checkout %s payment failed (customer %s)", obj.get("id"), obj.get("customer"))
+    elif event_type in SUBSCRIPTION_EVENTS:
+        uid = firestore_client.find_uid_by_customer(obj.get("customer"))
+        if not uid:
+            raise UnknownCustomerError(f"No user is linked to Stripe customer {obj.get('customer')}")
+        active = event_type != "customer.subscription.deleted" and obj.get("status") in ACTIVE_SUBSCRIPTION_STATUSES
+        plan = _plan_for_subscription(obj) if active else "Free"
+
+    @firestore.transactional
+    def _apply(transaction):
+        if event_ref.get(transaction=transaction).exists:
+            return "duplicate"
+
+        outcome = "ignored"
+        if event_type in CHECKOUT_EVENTS:
+            if not uid:
+                outcome = "unknown_user"
+            else:
+                if obj.get("customer"):
+                    firestore_client.link_stripe_customer(uid, obj["customer"], transaction)
+                if plan:
+                    transaction.set(db.collection('users').document(uid), _plan_update(plan), merge=True)
+                    outcome = f"plan:{plan}"
+                elif not paid:
+                    # 入金待ち。async_payment_succeeded が届いたときに反映する
+                    outcome = "awaiting_payment"
+                else:
+                    outcome = "linked"
+        elif event_type == "checkout.session.async_payment_failed":
+            outcome = "payment_failed"
+        elif event_type in SUBSCRIPTION_EVENTS and plan:
+            user_ref = db.collection('users').document(uid)
+            current_plan = (user_ref.get(transaction=transaction).to_dict() or {}).get("plan")
+            if current_plan == plan:
+                # 更新・解約予約の切り替え・メタデータ編集などでは残回数を補充しない（月初のリセットに任せる）
+                outcome = "unchanged"
+            else:
+                transaction.set(user_ref, _plan_update(plan), merge=True)
+                outcome = f"plan:{plan}"
+
+        transaction.set(event_ref, {
+            "type": event_type, "outcome": outcome, "processed_at": firestore.SERVER_TIMESTAMP,
+        })
+        return outcome
+
+    return _apply(db.transaction())
+
+
+def _worker():
+    while True:
+        event = _events.get()
+        try:
+            for attempt in range(WEBHOOK_MAX_ATTEMPTS):
+                try:
+                    outcome = process_event(event)
+                    logging.info("Stripe event %s (%s): %s", event["id"], event["type"], outcome)
+                    break
+                except Exception as e:
+                    if attempt + 1 >= WEBHOOK_MAX_ATTEMPTS:
+                        # 200を返した後なのでStripeからは再送されない。replay で再処理できるようIDを残す
+                        logging.exception("Giving up Stripe event %s; replay with --event-id: %s", event["id"], e)
+                    else:
+                        time.sleep(min(30, 2 ** attempt))
+        finally:
+            _events.task_done()
+
+
+_workers_started = False
+_workers_lock = threading.Lock()
+
+
+def _ensure_workers():
+    """最初のイベント受信時にワーカーを起動する（import しただけではスレッドを作らない）"""
+    global _workers_started
+    with _workers_lock:
+        if _workers_started:
+            return
+        for i in range(WEBHOOK_WORKERS):
+            threading.Thread(target=_worker, name=f"stripe-webhook-{i}", daemon=True).start()
+        _workers_started = True
+
+
+@app.post("/stripe/webhook")
+def stripe_webhook():
+    payload = request.get_data()
+    signature = request.headers.get("Stripe-Signature", "")
+    try:
+        stripe.Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logging.warning("Rejected Stripe webhook: %s", e)
+        return jsonify({"error": "invalid signature"}), 400
+
+    _ensure_workers()
+    try:
+        # 検証済みのペイロードをそのままdictにして渡す（記録済みのイベントJSONと同じ形）
+        _events.put_nowait(json.loads(payload))
+    except queue.Full:
+        # 受け付けられない場合は失敗を返し、Stripeの再送に任せる
+        return jsonify({"error": "busy"}), 503
+    return jsonify({"received": True}), 200
+
+
+@app.get("/healthz")
+def healthz():
+    return jsonify({"queue": _events.qsize(), "capacity": WEBHOOK_QUEUE_SIZE}), 200
+
+
+def _replay(paths, event_ids):
+    """記録済みのイベントJSON、またはStripeから取り直したイベントを同期的に処理する（署名検証は行わない）"""
+    events = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            events.append(json.load(f))
+    for event_id in event_ids:
+        events.append(json.loads(str(stripe.Event.retrieve(event_id))))
+    for event in events:
+        print(f"{event['id']} {event['type']}: {process_event(event)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stripe Webhookイベントの再処理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay = subparsers.add_parser("replay", help="イベントを再処理する（処理済みのものは duplicate になる）")
+    replay.add_argument("paths", nargs="*", help="イベントJSONファイル")
+    replay.add_argument("--event-id", action="append", default=[], help="Stripeから取得するイベントID")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "replay":
+        if not args.paths and not args.event_id:
+            parser.error("イベントJSONファイルか --event-id を指定してください")
+        _replay(args.paths, args.event_id)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+# user_listener.py
+# ユーザードキュメント（plan / remaining_uses）のリアルタイム監視
+#
+# プロセス全体で1ユーザーにつき1つの on_snapshot リスナーを共有し、そのユーザーでログイン中のセッション数で参照カウントする。
+# コールバックはFirestoreのバックグラウンドスレッドで呼ばれるため st.session_state には書かず、最新の内容と版番号をここに保持する。
+# 各セッションは描画時に自分が取り込んだ版と比べて反映するだけなので、rerun のたびにFirestoreを読むことはない。
+# 終了したセッションは定期的な掃除で外し、参照がなくなったリスナーは止める。
+import logging
+import os
+import threading
+import time
+
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# --- 設定（環境変数で上書き可能） ---
+LISTENER_SWEEP_INTERVAL_SECONDS = float(os.getenv("USER_LISTENER_SWEEP_INTERVAL_SECONDS", "60"))
+
+_watches = {}  # uid -> {"watch", "sessions": set, "data", "version"}
+_session_uids = {}  # session_id -> uid
+_lock = threading.Lock()
+_sweeper_started = False
+
+
+def current_session_id():
+    """実行中のStreamlitセッションのID（スクリプト外から呼ばれた場合はNone）"""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+
+def _on_snapshot(uid):
+    def _callback(doc_snapshots, changes, read_time):
+        snapshot = doc_snapshots[0] if doc_snapshots else None
+        data = snapshot.to_dict() if snapshot is not None and snapshot.exists else None
+        with _lock:
+            entry = _watches.get(uid)
+            if entry is not None:
+                entry["data"] = data
+                entry["version"] += 1
+    return _callback
+
+
+def _stop(entry):
+    watch = entry.get("watch")
+    if watch is None:
+        return
+    try:
+        watch.unsubscribe()
+    except Exception as e:
+        logging.warning("Failed to stop user listener: %s", e)
+
+
+def _release(session_id):
+    """セッションの参照を外し、最後の参照ならリスナーのエントリを返す（_lock 保持中に呼ぶ）"""
+    uid = _session_uids.pop(session_id, None)
+    entry = _watches.get(uid)
+    if entry is None:
+        return None
+    entry["sessions"].discard(session_id)
+    if entry["sessions"]:
+        return None
+    del _watches[uid]
+    return entry
+
+
+def subscribe(session_id, uid, doc_ref):
+    """セッションを uid のリスナーに登録する。最初の登録でだけ on_snapshot を開始する"""
+    _ensure_sweeper()
+    with _lock:
+        if _session_uids.get(session_id) == uid:
+            return
+        released = _release(session_id)  # 別のユーザーで入り直した場合
+        _session_uids[session_id] = uid
+        entry = _watches.get(uid)
+        start = entry is None
+        if start:
+            entry = _watches[uid] = {"watch": None, "sessions": set(), "data": None, "version": 0}
+        entry["sessions"].add(session_id)
+    if released:
+        _stop(released)
+    if not start:
+        return
+
+    try:
+        watch = doc_ref.on_snapshot(_on_snapshot(uid))
+    except Exception as e:
+        # 監視できなくてもログイン時に読んだ値は表示できるので、登録を取り消して続行する
+        logging.warning("Failed to start user listener for %s: %s", uid, e)
+        with _lock:
+            if _watches.get(uid) is entry:
+                del _watches[uid]
+            for sid in entry["sessions"]:
+                _session_uids.pop(sid, None)
+        return
+    with _lock:
+        if _watches.get(uid) is entry:
+            entry["watch"] = watch
+            return
+    # 開始までの間に全セッションが抜けていた
+    _stop({"watch": watch})
+
+
+def unsubscribe(session_id):
+    """セッションの登録を外す（ログアウト時など）。参照がなくなればリスナーを止める"""
+    with _lock:
+        released = _release(session_id)
+    if released:
+        _stop(released)
+
+
+def latest(uid):
+    """リスナーが受け取った最新のユーザードキュメントを (版番号, dict) で返す。未受信なら (0, None)"""
+    with _lock:
+        entry = _watches.get(uid)
+        if entry is None:
+            return 0, None
+        return entry["version"], entry["data"]
+
+
+def sweep():
+    """終了したセッション（タブを閉じた・タイムアウトした）の登録を外す"""
+    if not runtime.exists():
+        return
+    instance = runtime.get_instance()
+    with _lock:
+        session_ids = list(_session_uids)
+    for session_id in session_ids:
+        if not instance.is_active_session(session_id):
+            unsubscribe(session_id)
+
+
+def _sweeper():
+    while True:
+        time.sleep(LISTENER_SWEEP_INTERVAL_SECONDS)
+        try:
+            sweep()
+        except Exception as e:
+            logging.warning("User listener sweep failed: %s", e)
+
+
+def _ensure_sweeper():
+    """最初の登録時に掃除用スレッドを起動する（import しただけではスレッドを作らない）"""
+    global _sweeper_started
+    with _lock:
+        if _sweeper_started:
+            return
+        _sweeper_started = True
+    threading.Thread(target=_sweeper, name="user-listener-sweeper", daemon=True).start()